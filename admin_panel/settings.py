@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'corsheaders',
@@ -50,6 +51,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первым, чтобы замерять полное время запроса
+    'catalog.middleware.PerformanceMiddleware',
+    # Сжатие - до всех, кто читает или меняет тело ответа
+    'catalog.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -97,6 +102,12 @@ WSGI_APPLICATION = 'admin_panel.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
+# Connection reuse: a worker keeps its connection for DB_CONN_MAX_AGE seconds
+# (0 = new connection per request). DB_POOL=True uses a psycopg 3 connection
+# pool instead of persistent connections (CONN_MAX_AGE is then 0). With
+# DB_CONN_HEALTH_CHECKS a reused connection is checked before use.
+DB_POOL = os.getenv('DB_POOL', 'False') == 'True'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -105,12 +116,48 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD', 'okurmen123'),
         'HOST': os.getenv('DB_HOST', 'db'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'True') == 'True',
         'OPTIONS': {
             'connect_timeout': 10,
         },
     }
 }
 
+if DB_POOL:
+    # Per process: keep workers * DB_POOL_MAX_SIZE below max_connections
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        # Seconds to wait for a free connection before the request fails
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', '600')),
+        'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+    }
+
+# Read replicas: comma-separated host[:port] list, same database and
+# credentials as the primary. Each becomes a "replica<N>" alias; safe requests
+# to catalog viewsets read from a random replica (catalog.replicas).
+for index, address in enumerate(
+    filter(None, map(str.strip, os.getenv('DB_REPLICA_HOSTS', '').split(','))), 1
+):
+    host, _, port = address.partition(':')
+    DATABASES[f'replica{index}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        # Tests read the primary's test database through this alias
+        'TEST': {'MIRROR': 'default'},
+    }
+
+CATALOG_DB_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+# After a write the user reads from the primary for this many seconds
+# (read-your-writes); keep it above the usual replication lag
+CATALOG_REPLICA_PIN_SECONDS = int(os.getenv('CATALOG_REPLICA_PIN_SECONDS', '5'))
+
+DATABASE_ROUTERS = ['catalog.replicas.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -156,12 +203,16 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'catalog.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'catalog.renderers.CatalogJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
@@ -170,6 +221,87 @@ REST_FRAMEWORK = {
 # Max upload size for images (5MB)
 MAX_UPLOAD_SIZE = 5 * 1024 * 1024
 
+# Cache (locmem by default; set CACHE_BACKEND/CACHE_LOCATION for Redis or files,
+# e.g. django.core.cache.backends.redis.RedisCache + redis://redis:6379/1).
+# docker-compose runs Redis: with several workers the catalog cache must be shared
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'catalog'),
+    }
+}
+
+# Backends that live inside one process: each gunicorn worker would have its
+# own copy, and a write would only invalidate the worker that handled it
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# Read-through cache of catalog GET responses (0 disables it). Enabled by
+# default only when the catalog cache alias is shared between workers.
+CATALOG_CACHE_ALIAS = os.getenv('CATALOG_CACHE_ALIAS', 'default')
+CATALOG_CACHE_TIMEOUT = int(os.getenv(
+    'CATALOG_CACHE_TIMEOUT',
+    '0' if CACHES[CATALOG_CACHE_ALIAS]['BACKEND'] in LOCAL_CACHE_BACKENDS else '300'
+))
+
+# Full-text search configuration (PostgreSQL text search config name)
+CATALOG_SEARCH_CONFIG = os.getenv('CATALOG_SEARCH_CONFIG', 'russian')
+
+# Token authentication cache: in-process LRU (size, TTL in seconds) or,
+# when CATALOG_TOKEN_CACHE_ALIAS names a cache from CACHES, a shared cache.
+# Defaults to the catalog cache when it is shared between workers, so a
+# deleted token stops working in every worker at once.
+CATALOG_TOKEN_CACHE_SIZE = int(os.getenv('CATALOG_TOKEN_CACHE_SIZE', '1024'))
+CATALOG_TOKEN_CACHE_TTL = int(os.getenv('CATALOG_TOKEN_CACHE_TTL', '60'))
+CATALOG_TOKEN_CACHE_ALIAS = os.getenv(
+    'CATALOG_TOKEN_CACHE_ALIAS',
+    '' if CACHES[CATALOG_CACHE_ALIAS]['BACKEND'] in LOCAL_CACHE_BACKENDS
+    else CATALOG_CACHE_ALIAS
+)
+
+# Performance instrumentation (Server-Timing header, slow request log, /metrics).
+# Under gunicorn with several workers set CATALOG_METRICS_DIR to a shared
+# writable directory so /metrics aggregates all workers. With DEBUG=False
+# /metrics requires CATALOG_METRICS_TOKEN and returns 404 while it is empty.
+CATALOG_METRICS_ENABLED = os.getenv('CATALOG_METRICS_ENABLED', 'True') == 'True'
+CATALOG_METRICS_DIR = os.getenv('CATALOG_METRICS_DIR', '')
+CATALOG_METRICS_FLUSH_INTERVAL = int(os.getenv('CATALOG_METRICS_FLUSH_INTERVAL', '5'))
+CATALOG_METRICS_TOKEN = os.getenv('CATALOG_METRICS_TOKEN', '')
+CATALOG_SLOW_REQUEST_MS = int(os.getenv('CATALOG_SLOW_REQUEST_MS', '500'))
+
+# Async read path for catalog endpoints (enable when served by an ASGI worker);
+# independent queries of one request run in parallel on pooled connections
+CATALOG_ASYNC_VIEWS = os.getenv('CATALOG_ASYNC_VIEWS', 'False') == 'True'
+CATALOG_ASYNC_PARALLEL_QUERIES = os.getenv('CATALOG_ASYNC_PARALLEL_QUERIES', 'True') == 'True'
+
+# Response compression (gzip, brotli if installed): bodies smaller than
+# CATALOG_COMPRESS_MIN_SIZE bytes are sent as is
+CATALOG_COMPRESS_MIN_SIZE = int(os.getenv('CATALOG_COMPRESS_MIN_SIZE', '1024'))
+CATALOG_GZIP_LEVEL = int(os.getenv('CATALOG_GZIP_LEVEL', '6'))
+CATALOG_BROTLI_QUALITY = int(os.getenv('CATALOG_BROTLI_QUALITY', '5'))
+
+# Product/category lists are built from .values() rows instead of serializers
+CATALOG_FAST_LIST = os.getenv('CATALOG_FAST_LIST', 'True') == 'True'
+
+# Batch product API: max number of operations in one request
+CATALOG_BATCH_MAX_OPERATIONS = int(os.getenv('CATALOG_BATCH_MAX_OPERATIONS', '10000'))
+
+# Image derivatives: size of the Pillow process pool (0 = build synchronously)
+CATALOG_IMAGE_WORKERS = int(os.getenv('CATALOG_IMAGE_WORKERS', '2'))
+
+# Chunked photo uploads: received bytes are kept in CATALOG_UPLOAD_DIR
+# (outside MEDIA_ROOT, shared by all workers) until the upload is completed;
+# one PATCH request carries at most CATALOG_UPLOAD_CHUNK_SIZE bytes
+CATALOG_UPLOAD_DIR = os.getenv('CATALOG_UPLOAD_DIR', str(BASE_DIR / 'uploads'))
+CATALOG_UPLOAD_CHUNK_SIZE = int(os.getenv('CATALOG_UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+
+# Faceted search: max number of per-category indexes kept in each worker
+CATALOG_FACET_INDEX_SIZE = int(os.getenv('CATALOG_FACET_INDEX_SIZE', '64'))
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     origin.strip() for origin in os.getenv(
@@ -1,20 +1,39 @@
 from django.contrib import admin
+from django.core.exceptions import ValidationError
+from django.forms.models import BaseInlineFormSet
 from .models import (
     Category, Product, ProductPhoto, ProductTab,
     Filter, FilterValue
 )
+from .search import search_products
 
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ['name', 'parent', 'is_active', 'created_at']
+    list_display = [
+        'name', 'parent', 'is_active', 'children_count',
+        'products_total', 'created_at'
+    ]
     list_filter = ['is_active', 'created_at']
     search_fields = ['name']
     list_editable = ['is_active']
 
 
+class ProductPhotoInlineFormSet(BaseInlineFormSet):
+    def clean(self):
+        super().clean()
+        # Каждая форма проверяет ограничение только по сохраненным фото
+        main = [
+            form for form in self.forms
+            if form.cleaned_data.get('is_main') and not self._should_delete_form(form)
+        ]
+        if len(main) > 1:
+            raise ValidationError('У товара может быть только одно главное фото')
+
+
 class ProductPhotoInline(admin.TabularInline):
     model = ProductPhoto
+    formset = ProductPhotoInlineFormSet
     extra = 1
     fields = ['image', 'is_main', 'order']
 
@@ -48,6 +67,12 @@ class ProductAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_search_results(self, request, queryset, search_term):
+        """Поиск по индексу вместо icontains (см. catalog.search)"""
+        if not search_term:
+            return queryset, False
+        return search_products(queryset, search_term), False
+
 
 @admin.register(ProductPhoto)
 class ProductPhotoAdmin(admin.ModelAdmin):
@@ -0,0 +1,83 @@
+"""
+Выборки из БД для асинхронных представлений каталога.
+
+Async ORM Django выполняет запросы в потоке запроса по очереди, даже если
+их ждут через ``asyncio.gather``. Независимые выборки (страница и
+``COUNT(*)``, товар и его фото/вкладки) здесь выполняются в пуле потоков
+с отдельным соединением у каждого потока, поэтому идут к БД параллельно.
+
+Соединения потоков пула живут по тем же правилам ``CONN_MAX_AGE``, что и
+соединения запросов: при ``CONN_MAX_AGE = 0`` без пула соединений
+(``DB_POOL``) каждая выборка открывает новое соединение, и параллельность
+окупается только на медленных запросах. С пулом поток берет готовое
+соединение и возвращает его после выборки; перед этим поток запроса
+возвращает в пул свое соединение (``release_request_connections``), иначе
+запросы, держащие все соединения пула, ждали бы соединений для своих же
+выборок до ``DB_POOL_TIMEOUT``.
+``CATALOG_ASYNC_PARALLEL_QUERIES = False`` возвращает выборки в поток
+запроса.
+"""
+import asyncio
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .middleware import current_recorder
+
+
+def run(function, queryset):
+    """Выполнить ``function(queryset)`` в потоке пула со своим соединением"""
+    close_old_connections()
+    recorder = current_recorder.get()
+    connection = connections[queryset.db]
+    try:
+        with connection.execute_wrapper(recorder) if recorder else nullcontext():
+            return function(queryset)
+    finally:
+        close_old_connections()
+
+
+def release_request_connections():
+    """Вернуть в пул соединения потока запроса вне транзакции"""
+    for connection in connections.all(initialized_only=True):
+        pooled = connection.settings_dict.get('OPTIONS', {}).get('pool')
+        if pooled and connection.connection is not None and not connection.in_atomic_block:
+            connection.close()
+
+
+async def fetch(queryset):
+    """Список объектов выборки (вместе с ``prefetch_related``)"""
+    if not settings.CATALOG_ASYNC_PARALLEL_QUERIES:
+        return [obj async for obj in queryset]
+    await sync_to_async(release_request_connections)()
+    return await sync_to_async(run, thread_sensitive=False)(list, queryset)
+
+
+async def fetch_count(queryset):
+    if not settings.CATALOG_ASYNC_PARALLEL_QUERIES:
+        return await queryset.acount()
+    await sync_to_async(release_request_connections)()
+    return await sync_to_async(run, thread_sensitive=False)(
+        lambda queryset: queryset.count(), queryset
+    )
+
+
+async def gather(*awaitables):
+    """Дождаться независимых выборок, выполняя их одновременно"""
+    return await asyncio.gather(*awaitables)
+
+
+def attach_prefetched(instance, name, queryset, objects):
+    """Подставить выбранные объекты как результат ``prefetch_related(name)``
+
+    ``queryset`` - выборка связанного менеджера (``instance.<name>.all()``),
+    поэтому сериализатор получает те же объекты в том же порядке, что и
+    при ``prefetch_related``, без обращения к БД.
+    """
+    queryset._result_cache = objects
+    queryset._prefetch_done = True
+    if not hasattr(instance, '_prefetched_objects_cache'):
+        instance._prefetched_objects_cache = {}
+    instance._prefetched_objects_cache[name] = queryset
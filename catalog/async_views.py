@@ -0,0 +1,94 @@
+"""
+Асинхронное чтение каталога под ASGI.
+
+DRF вызывает обработчики ViewSet синхронно, поэтому под ASGI каждый
+запрос занимает поток, пока ждет БД. ``async_patterns`` заменяет view
+маршрутов роутера обертками: ``GET``/``HEAD`` действия, у которого есть
+асинхронная версия (``alist``, ``aretrieve``, ``atree``), выполняются в
+цикле событий через async ORM, а все остальное (запись, действия без
+async-версии, параметры из ``async_unsupported_params``) передается
+исходному синхронному view.
+
+Аутентификация, права, согласование формата, обработка ошибок и
+рендеринг - те же, что у DRF, поэтому ответы совпадают байт в байт.
+Включается ``CATALOG_ASYNC_VIEWS = True`` при запуске через ASGI-сервер.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.urls import URLPattern
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def get_actions(callback):
+    actions = dict(callback.actions)
+    if 'get' in actions and 'head' not in actions:
+        actions['head'] = actions['get']
+    return actions
+
+
+def async_view(callback):
+    """Обертка view роутера: чтение - асинхронно, остальное - синхронно"""
+    sync_view = sync_to_async(callback)
+    viewset_class = callback.cls
+    actions = get_actions(callback)
+
+    @wraps(callback)
+    async def view(request, *args, **kwargs):
+        action = actions.get(request.method.lower())
+        if (
+            request.method not in SAFE_METHODS or
+            not hasattr(viewset_class, f'a{action}') or
+            any(
+                param in request.GET
+                for param in getattr(viewset_class, 'async_unsupported_params', ())
+            )
+        ):
+            return await sync_view(request, *args, **kwargs)
+
+        viewset = viewset_class(**callback.initkwargs)
+        viewset.action_map = actions
+        for method, name in actions.items():
+            setattr(viewset, method, getattr(viewset, name))
+        return await dispatch(viewset, request, *args, **kwargs)
+    return view
+
+
+async def dispatch(viewset, request, *args, **kwargs):
+    """``APIView.dispatch`` с асинхронным обработчиком действия"""
+    viewset.args = args
+    viewset.kwargs = kwargs
+    request = viewset.initialize_request(request, *args, **kwargs)
+    viewset.request = request
+    viewset.headers = viewset.default_response_headers
+    try:
+        # Аутентификация (при промахе кэша токенов) и права могут
+        # обращаться к БД
+        await sync_to_async(viewset.initial)(request, *args, **kwargs)
+        handler = getattr(viewset, f'a{viewset.action}')
+        response = await handler(request, *args, **kwargs)
+    except Exception as exc:
+        response = viewset.handle_exception(exc)
+    viewset.response = viewset.finalize_response(
+        request, response, *args, **kwargs
+    )
+    return viewset.response
+
+
+def async_patterns(patterns):
+    """Маршруты роутера DRF с асинхронными обработчиками чтения"""
+    result = []
+    for pattern in patterns:
+        callback = pattern.callback
+        viewset_class = getattr(callback, 'cls', None)
+        actions = getattr(callback, 'actions', None) or {}
+        if viewset_class is not None and any(
+            hasattr(viewset_class, f'a{action}') for action in actions.values()
+        ):
+            pattern = URLPattern(
+                pattern.pattern, async_view(callback),
+                pattern.default_args, pattern.name,
+            )
+        result.append(pattern)
+    return result
@@ -0,0 +1,176 @@
+"""
+Аутентификация по токену с кэшем пользователя.
+
+``TokenAuthentication`` DRF на каждый запрос выполняет запрос
+``Token JOIN User``. Здесь соответствие токен -> пользователь (id, имя,
+``is_staff``, ``is_superuser``, ``is_active``) хранится в ограниченном
+LRU-кэше процесса с TTL или, если задан ``CATALOG_TOKEN_CACHE_ALIAS``,
+в общем кэше Django (Redis и т.п.), общем для всех воркеров.
+
+Пользователь восстанавливается через ``User.from_db`` с отложенными
+остальными полями: обращение, например, к ``email`` загрузит их из БД.
+Запись удаляется при удалении/изменении токена и при изменении или
+удалении пользователя (сигналы в ``catalog.signals``); в LRU процесса
+изменения из других воркеров видны не позже ``CATALOG_TOKEN_CACHE_TTL``.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+USER_FIELDS = ('id', 'username', 'is_staff', 'is_superuser', 'is_active')
+
+
+class TokenLRUCache:
+    """Потокобезопасный LRU с ограничением по размеру и времени жизни"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SharedTokenCache:
+    """Те же операции поверх кэша Django
+
+    Кэш может быть общим с другими данными (кэш ответов каталога), поэтому
+    ``clear`` не очищает его целиком, а увеличивает поколение: запись
+    хранится вместе с поколением, при котором была сделана, и записи
+    прежних поколений не используются. Поколение читается тем же
+    ``get_many``, что и запись.
+    """
+    prefix = 'catalog:token:'
+    generation_key = 'catalog:token-generation'
+
+    def __init__(self, alias, ttl):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_generation(self):
+        cache = self.cache
+        generation = cache.get(self.generation_key)
+        if generation is None:
+            cache.add(self.generation_key, time.time_ns(), timeout=None)
+            generation = cache.get(self.generation_key)
+        return generation
+
+    def get(self, key):
+        values = self.cache.get_many([self.generation_key, self.prefix + key])
+        entry = values.get(self.prefix + key)
+        if entry is None:
+            return None
+        generation, value = entry
+        if generation != values.get(self.generation_key):
+            return None
+        return value
+
+    def set(self, key, value):
+        self.cache.set(
+            self.prefix + key, (self.get_generation(), value), self.ttl
+        )
+
+    def delete_many(self, keys):
+        self.cache.delete_many([self.prefix + key for key in keys])
+
+    def clear(self):
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            self.cache.set(self.generation_key, time.time_ns(), timeout=None)
+
+
+if settings.CATALOG_TOKEN_CACHE_ALIAS:
+    token_cache = SharedTokenCache(
+        settings.CATALOG_TOKEN_CACHE_ALIAS, settings.CATALOG_TOKEN_CACHE_TTL
+    )
+else:
+    token_cache = TokenLRUCache(
+        settings.CATALOG_TOKEN_CACHE_SIZE, settings.CATALOG_TOKEN_CACHE_TTL
+    )
+
+
+def forget_tokens(keys):
+    """Удалить токены из кэша сейчас и еще раз после коммита
+
+    Повторное удаление нужно, если параллельный запрос успел положить
+    в кэш старые данные до коммита транзакции.
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    token_cache.delete_many(keys)
+    transaction.on_commit(lambda: token_cache.delete_many(keys))
+
+
+def forget_user(user_id):
+    forget_tokens(
+        Token.objects.filter(user_id=user_id).values_list('key', flat=True)
+    )
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """``TokenAuthentication`` без запроса к БД при попадании в кэш"""
+
+    def authenticate_credentials(self, key):
+        User = get_user_model()
+        # from_db ожидает значения в порядке полей модели
+        field_names = [
+            field.attname for field in User._meta.concrete_fields
+            if field.attname in USER_FIELDS
+        ]
+        values = token_cache.get(key)
+        if values is None:
+            values = Token.objects.filter(key=key).values_list(
+                *[f'user__{field}' for field in field_names]
+            ).first()
+            if values is None:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            token_cache.set(key, values)
+
+        user = User.from_db(None, field_names, values)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        token = Token.from_db(None, ('key', 'user_id'), (key, user.pk))
+        token.user = user
+        return user, token
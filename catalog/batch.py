@@ -0,0 +1,390 @@
+"""
+Пакетное создание, изменение и удаление товаров.
+
+Операции пакета::
+
+    {"op": "create", "data": {"name": "...", "category": 1, "price": "10.00"}}
+    {"op": "update", "id": 5, "data": {"price": "9.90"}}
+    {"op": "update", "external_id": "SKU-1", "data": {"quantity": 0}}
+    {"op": "delete", "id": 7}
+
+Поля ``data`` проверяются по правилам ``ProductSerializer``, изменение
+частичное. Товары, категории и значения фильтров выбираются пакетно,
+поэтому проверка операции не обращается к БД. Все изменения записываются
+в одной транзакции: ``bulk_create``, ``bulk_update`` (по группам с
+одинаковым набором полей, одним ``UPDATE ... FROM (VALUES ...)`` на пакет)
+и одно удаление. Счетчики категорий
+обновляются по дельтам, поисковые векторы - только при изменении текста.
+
+В атомарном режиме (по умолчанию) ошибка любой операции отменяет весь
+пакет, иначе ошибочные операции пропускаются, а остальные применяются.
+"""
+from collections import defaultdict
+
+from django.db import IntegrityError, connections, router, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from . import caching
+from .models import Category, FilterValue, Product
+from .search import update_search_vectors
+from .serializers import ProductImportSerializer
+
+OPERATIONS = ('create', 'update', 'delete')
+TEXT_FIELDS = {'name', 'description'}
+
+
+def bulk_update_rows(model, instances, fields, batch_size):
+    """``bulk_update`` одним ``UPDATE ... FROM`` по таблице значений
+
+    Django строит для ``bulk_update`` выражение ``CASE WHEN`` на каждый
+    объект и поле, и для тысяч строк его компиляция занимает на порядок
+    больше времени, чем сам запрос. Здесь значения передаются параметрами
+    в ``WITH v(...) AS (VALUES ...)`` (PostgreSQL и SQLite 3.33+).
+    """
+    connection = connections[router.db_for_write(model)]
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        model._default_manager.bulk_update(instances, fields, batch_size=batch_size)
+        return
+
+    meta = model._meta
+    columns = [meta.pk] + [meta.get_field(name) for name in fields]
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+
+    def value(field):
+        column = f'v.{quote(field.column)}'
+        if connection.vendor == 'postgresql':
+            # Параметры VALUES без явного типа PostgreSQL считает текстом
+            return f'CAST({column} AS {field.db_type(connection)})'
+        return column
+
+    sql = (
+        f"WITH v({', '.join(quote(field.column) for field in columns)}) "
+        'AS (VALUES {rows}) '
+        f'UPDATE {table} SET ' + ', '.join(
+            f'{quote(field.column)} = {value(field)}' for field in columns[1:]
+        ) + f' FROM v WHERE {table}.{quote(meta.pk.column)} = {value(meta.pk)}'
+    )
+    row = '(' + ', '.join(['%s'] * len(columns)) + ')'
+    batch_size = min(
+        batch_size, connection.ops.bulk_batch_size(columns, instances) or batch_size
+    )
+    with connection.cursor() as cursor:
+        for start in range(0, len(instances), batch_size):
+            chunk = instances[start:start + batch_size]
+            params = [
+                field.get_db_prep_save(getattr(instance, field.attname), connection)
+                for instance in chunk
+                for field in columns
+            ]
+            cursor.execute(sql.format(rows=', '.join([row] * len(chunk))), params)
+
+
+class BatchResult:
+    """Результаты операций пакета в порядке запроса"""
+
+    def __init__(self, size):
+        self.items = [{'index': index} for index in range(size)]
+        self.error_count = 0
+        self.rejected = False
+
+    def set(self, index, status, **extra):
+        self.items[index].update(status=status, **extra)
+
+    def add_error(self, index, errors):
+        self.error_count += 1
+        self.set(index, 'error', errors=errors)
+
+    def count(self, status):
+        return sum(1 for item in self.items if item.get('status') == status)
+
+    def as_dict(self):
+        return {
+            'created': self.count('created'),
+            'updated': self.count('updated'),
+            'deleted': self.count('deleted'),
+            'error_count': self.error_count,
+            'results': self.items,
+        }
+
+
+class Operation:
+    """Разобранная операция пакета"""
+
+    def __init__(self, index, op, pk=None, key=None, data=None):
+        self.index = index
+        self.op = op
+        self.pk = pk
+        self.key = key
+        self.data = data or {}
+        self.instance = None
+        self.category_id = None
+        self.filter_values = None
+        self.values = None
+        self.errors = {}
+
+
+class ProductBatch:
+    """Применение пакета операций с товарами"""
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        # Поля сериализатора строятся один раз на пакет, а не на операцию
+        self.serializers = {
+            False: ProductImportSerializer(),
+            True: ProductImportSerializer(partial=True),
+        }
+
+    def run(self, raw_operations, atomic=True):
+        result = BatchResult(len(raw_operations))
+        operations = [
+            self.parse(index, raw) for index, raw in enumerate(raw_operations)
+        ]
+        self.load(operations)
+        for operation in operations:
+            if not operation.errors:
+                self.validate(operation)
+
+        valid = []
+        for operation in operations:
+            if operation.errors:
+                result.add_error(operation.index, operation.errors)
+            else:
+                valid.append(operation)
+        if atomic and result.error_count:
+            result.rejected = True
+            for operation in valid:
+                result.set(operation.index, 'skipped')
+            return result
+        if not valid:
+            return result
+
+        try:
+            with transaction.atomic():
+                self.write(valid)
+        except IntegrityError as exc:
+            for operation in valid:
+                result.add_error(operation.index, {'non_field_errors': [str(exc)]})
+            result.rejected = atomic
+            return result
+
+        for operation in valid:
+            status = {'create': 'created', 'update': 'updated'}.get(
+                operation.op, 'deleted'
+            )
+            result.set(operation.index, status, id=operation.instance.pk)
+        return result
+
+    @staticmethod
+    def parse(index, raw):
+        """Проверить структуру операции (без обращения к БД)"""
+        if not isinstance(raw, dict):
+            operation = Operation(index, None)
+            operation.errors = {'non_field_errors': ['Ожидается объект операции']}
+            return operation
+
+        op = raw.get('op')
+        operation = Operation(index, op, raw.get('id'), raw.get('external_id'))
+        if op not in OPERATIONS:
+            operation.errors['op'] = [f"Ожидается одно из: {', '.join(OPERATIONS)}"]
+            return operation
+
+        data = raw.get('data', {})
+        if not isinstance(data, dict):
+            operation.errors['data'] = ['Ожидается объект с полями товара']
+        elif op == 'delete' and data:
+            operation.errors['data'] = ['Удаление не принимает данных']
+        operation.data = data if isinstance(data, dict) else {}
+
+        if op == 'create':
+            if operation.pk is not None or operation.key is not None:
+                operation.errors['non_field_errors'] = [
+                    'Для создания id и external_id передаются в data'
+                ]
+        elif (operation.pk is None) == (operation.key is None):
+            operation.errors['non_field_errors'] = [
+                'Укажите id или external_id товара'
+            ]
+        elif operation.pk is not None and (
+            isinstance(operation.pk, bool) or not isinstance(operation.pk, int)
+        ):
+            operation.errors['id'] = ['Ожидается целое число']
+        elif operation.key is not None:
+            operation.key = str(operation.key)
+
+        if 'filter_values' in operation.data:
+            value_ids = operation.data['filter_values']
+            if not isinstance(value_ids, list) or not all(
+                isinstance(value_id, int) and not isinstance(value_id, bool)
+                for value_id in value_ids
+            ):
+                operation.errors['filter_values'] = ['Ожидается список id']
+            else:
+                operation.filter_values = set(value_ids)
+        return operation
+
+    def load(self, operations):
+        """Выбрать товары, категории и значения фильтров всех операций сразу"""
+        ids, keys, external_ids, category_ids, value_ids = (
+            set(), set(), set(), set(), set()
+        )
+        for operation in operations:
+            if operation.errors:
+                continue
+            if operation.pk is not None:
+                ids.add(operation.pk)
+            if operation.key is not None:
+                keys.add(operation.key)
+            external_id = operation.data.get('external_id')
+            if external_id:
+                external_ids.add(str(external_id))
+            category = operation.data.get('category')
+            if isinstance(category, int) and not isinstance(category, bool):
+                category_ids.add(category)
+            value_ids |= operation.filter_values or set()
+
+        # Описание и поисковый вектор не нужны для проверки и записи
+        products = Product.objects.defer('description', 'search_vector')
+        self.by_id = products.in_bulk(ids)
+        self.by_key = products.in_bulk(keys, field_name='external_id')
+        self.taken_keys = dict(
+            Product.objects.filter(
+                external_id__in=external_ids
+            ).values_list('external_id', 'id')
+        )
+        self.categories = set(
+            Category.objects.filter(pk__in=category_ids).values_list('id', flat=True)
+        )
+        self.known_values = set(
+            FilterValue.objects.filter(pk__in=value_ids).values_list('id', flat=True)
+        )
+        self.seen = set()
+
+    def validate(self, operation):
+        errors = operation.errors
+        if operation.op != 'create':
+            if operation.pk is not None:
+                operation.instance = self.by_id.get(operation.pk)
+            else:
+                operation.instance = self.by_key.get(operation.key)
+            if operation.instance is None:
+                errors['non_field_errors'] = ['Товар не найден']
+                return
+            if operation.instance.pk in self.seen:
+                errors['non_field_errors'] = [
+                    'Товар уже изменяется другой операцией пакета'
+                ]
+                return
+            self.seen.add(operation.instance.pk)
+            if operation.op == 'delete':
+                return
+
+        data = dict(operation.data)
+        data.pop('filter_values', None)
+        if 'category' in data:
+            category = data.pop('category')
+            if category not in self.categories:
+                errors['category'] = ['Категория не найдена']
+            operation.category_id = category
+        elif operation.instance is None:
+            errors['category'] = ['Обязательное поле.']
+
+        if operation.filter_values and not operation.filter_values <= self.known_values:
+            missing = sorted(operation.filter_values - self.known_values)
+            errors['filter_values'] = [f'Значения фильтров не найдены: {missing}']
+
+        if data.get('external_id'):
+            data['external_id'] = str(data['external_id'])
+            owner = self.taken_keys.get(data['external_id'])
+            current = operation.instance.pk if operation.instance else None
+            if owner is not None and owner != current:
+                errors['external_id'] = ['Товар с таким external_id уже существует']
+            else:
+                # Второй операции пакета с тем же кодом это значение недоступно
+                self.taken_keys[data['external_id']] = current or -operation.index - 1
+
+        serializer = self.serializers[operation.instance is not None]
+        try:
+            operation.values = serializer.run_validation(data)
+        except ValidationError as exc:
+            errors.update(exc.detail)
+
+    def write(self, operations):
+        counters = defaultdict(lambda: [0, 0])
+        touched_facets = set()
+        creates = []
+        updates = defaultdict(list)
+        searchable = []
+        links = []
+        deletes = []
+        now = timezone.now()
+
+        for operation in operations:
+            if operation.op == 'delete':
+                deletes.append(operation.instance.pk)
+                continue
+            values = dict(operation.values)
+            if operation.category_id is not None:
+                values['category_id'] = operation.category_id
+            if operation.op == 'create':
+                operation.instance = Product(**values)
+                creates.append(operation.instance)
+                counters[operation.instance.category_id][0] += 1
+                counters[operation.instance.category_id][1] += int(
+                    operation.instance.is_active
+                )
+            else:
+                instance = operation.instance
+                old = (instance.category_id, instance.is_active)
+                for field, value in values.items():
+                    setattr(instance, field, value)
+                if old != (instance.category_id, instance.is_active):
+                    touched_facets.update((old[0], instance.category_id))
+                    counters[old[0]][0] -= 1
+                    counters[old[0]][1] -= int(old[1])
+                    counters[instance.category_id][0] += 1
+                    counters[instance.category_id][1] += int(instance.is_active)
+                instance.updated_at = now
+                updates[frozenset(values) | {'updated_at'}].append(instance)
+                if TEXT_FIELDS & set(values):
+                    searchable.append(instance)
+                if operation.filter_values is not None:
+                    touched_facets.add(instance.category_id)
+            if operation.filter_values is not None:
+                links.append((operation.instance, operation.filter_values))
+
+        Product.objects.bulk_create(creates, batch_size=self.batch_size)
+        for fields, instances in updates.items():
+            bulk_update_rows(Product, instances, sorted(fields), self.batch_size)
+        if deletes:
+            # Через ORM: сигналы удаляют файлы фото и обновляют счетчики
+            Product.objects.filter(pk__in=deletes).delete()
+        if links:
+            through = Product.filter_values.through
+            through.objects.filter(
+                product_id__in=[instance.pk for instance, _ in links]
+            ).delete()
+            through.objects.bulk_create(
+                [
+                    through(product_id=instance.pk, filtervalue_id=value_id)
+                    for instance, value_ids in links
+                    for value_id in value_ids
+                ],
+                batch_size=self.batch_size,
+            )
+
+        searchable += creates
+        if searchable:
+            update_search_vectors(Product.objects.filter(
+                pk__in=[instance.pk for instance in searchable]
+            ))
+        # bulk-операции обходят сигналы: счетчики категорий меняются на
+        # дельты, фасетные индексы затронутых категорий сбрасываются
+        for category_id, (products, active) in counters.items():
+            Category.adjust_product_counters(
+                category_id, products=products, active=active
+            )
+        if touched_facets:
+            Category.bump_facet_version(touched_facets)
+        caching.invalidate()
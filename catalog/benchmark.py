@@ -0,0 +1,575 @@
+"""
+Замер производительности маршрутов ``catalog.urls``.
+
+Каждый маршрут вызывается через тестовый клиент Django (полный стек
+middleware, аутентификация по токену) ``warmup`` раз вхолостую и
+``iterations`` раз с замером: время ответа (p50/p95/p99, среднее),
+количество SQL-запросов и пиковая память Python (отдельный проход под
+``tracemalloc``, чтобы трассировка не искажала время). Идентификаторы
+берутся из текущей БД - обычно каталога, созданного ``seed_catalog``.
+
+Записывающие маршруты выполняются внутри транзакции, которая
+откатывается после каждого вызова, так что каталог не меняется. Кэш
+ответов по умолчанию отключен, чтобы мерить обработку, а не попадания.
+
+Маршруты с суффиксом ``-serializer`` повторяют списки с
+``CATALOG_FAST_LIST = False``: их сравнение с парным маршрутом показывает
+выигрыш сериализации строк (``catalog.fastlist``) в том же прогоне.
+
+Результат - JSON, который можно сравнить с результатом другого коммита.
+"""
+import http.client
+import json
+import platform
+import subprocess
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from secrets import token_hex
+from urllib.parse import urlencode, urlsplit
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from . import compression
+from .middleware import QueryRecorder
+from .models import (
+    Category, Filter, FilterValue, Product, ProductPhoto, ProductTab
+)
+
+USERNAME = 'catalog-benchmark'
+QUANTILES = {'p50_ms': 0.5, 'p95_ms': 0.95, 'p99_ms': 0.99}
+
+Route = namedtuple(
+    'Route', 'name method path data settings', defaults=(None, None)
+)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def percentile(values, q):
+    """Квантиль с линейной интерполяцией между соседними значениями"""
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def default_host():
+    """Хост из ``ALLOWED_HOSTS``, который пропустит ``CommonMiddleware``"""
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.') or 'localhost'
+    return 'localhost'
+
+
+class BenchmarkRunner:
+    """Прогон маршрутов каталога с замером времени, SQL и памяти"""
+
+    def __init__(self, iterations=20, warmup=2, include_writes=False,
+                 use_cache=False, host=None, log=None):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.include_writes = include_writes
+        self.use_cache = use_cache
+        self.host = host or default_host()
+        self.log = log or (lambda message: None)
+
+    def run(self, only=None):
+        """Прогнать маршруты (все или с именами из ``only``)"""
+        samples = self.get_samples()
+        user_model = get_user_model()
+        password = token_hex(16)
+        user, _ = user_model.objects.get_or_create(
+            username=USERNAME,
+            defaults={'is_staff': True, 'is_superuser': True},
+        )
+        user.set_password(password)
+        user.save()
+        token, _ = Token.objects.get_or_create(user=user)
+        self.token = token.key
+        client = Client(
+            HTTP_HOST=self.host, HTTP_AUTHORIZATION=f'Token {token.key}'
+        )
+        samples['username'] = USERNAME
+        samples['password'] = password
+
+        routes = self.read_routes(samples, client)
+        if self.include_writes:
+            routes += self.write_routes(samples)
+        if only:
+            routes = [route for route in routes if route.name in only]
+
+        results = {}
+        overrides = {} if self.use_cache else {'CATALOG_CACHE_TIMEOUT': 0}
+        try:
+            with override_settings(**overrides):
+                for route in routes:
+                    self.log(f'{route.name}: {route.method} {route.path}')
+                    results[route.name] = self.measure(client, route)
+        finally:
+            user.delete()
+        return {'meta': self.get_meta(), 'routes': results}
+
+    def get_samples(self):
+        """Идентификаторы объектов для маршрутов с параметрами"""
+        category = Category.objects.filter(
+            children_count=0
+        ).order_by('-products_count', 'pk').first()
+        product = Product.objects.filter(category=category).order_by('pk').first()
+        if product is None:
+            raise BenchmarkError(
+                'Каталог пуст, сначала выполните seed_catalog'
+            )
+        photo = ProductPhoto.objects.filter(product=product).first()
+        tab = ProductTab.objects.filter(product=product).first()
+        filter_value = product.filter_values.order_by('pk').first()
+        return {
+            'category': category.pk,
+            'product': product.pk,
+            'search': product.name.split()[0],
+            'photo': photo.pk if photo else None,
+            'tabs': list(
+                ProductTab.objects.filter(product=product).values_list(
+                    'pk', flat=True
+                )
+            ),
+            'tab': tab.pk if tab else None,
+            'batch': list(
+                Product.objects.order_by('pk').values_list('pk', flat=True)[:1000]
+            ),
+            'filter': filter_value.filter_id if filter_value else None,
+            'filter_value': filter_value.pk if filter_value else None,
+        }
+
+    def read_routes(self, samples, client):
+        category = samples['category']
+        product = samples['product']
+        routes = [
+            Route('category-list', 'get', '/api/categories/'),
+            Route('category-detail', 'get', f'/api/categories/{category}/'),
+            Route(
+                'category-list-serializer', 'get', '/api/categories/',
+                settings={'CATALOG_FAST_LIST': False}
+            ),
+            Route('category-tree', 'get', '/api/categories/tree/'),
+            Route('product-list', 'get', '/api/products/'),
+            Route(
+                'product-list-serializer', 'get', '/api/products/',
+                settings={'CATALOG_FAST_LIST': False}
+            ),
+            Route(
+                'product-list-cursor-200', 'get',
+                '/api/products/?pagination=cursor&page_size=200'
+            ),
+            Route(
+                'product-list-cursor-200-serializer', 'get',
+                '/api/products/?pagination=cursor&page_size=200',
+                settings={'CATALOG_FAST_LIST': False}
+            ),
+            Route(
+                'product-list-category', 'get',
+                f'/api/products/?category={category}'
+            ),
+            Route(
+                'product-list-page-size', 'get', '/api/products/?page_size=200'
+            ),
+            Route(
+                'product-list-search', 'get',
+                '/api/products/?' + urlencode({'search': samples['search']})
+            ),
+            Route(
+                'product-list-fields', 'get',
+                '/api/products/?page_size=200&fields=id,name,price'
+            ),
+            Route('product-detail', 'get', f'/api/products/{product}/'),
+            Route(
+                'product-detail-fields', 'get',
+                f'/api/products/{product}/?fields=id,name,price,tabs.title'
+            ),
+            Route(
+                'product-export', 'get',
+                f'/api/products/export/?category={category}'
+            ),
+            Route('product-photo-list', 'get', '/api/product-photos/'),
+            Route('product-tab-list', 'get', '/api/product-tabs/'),
+            Route('filter-list', 'get', '/api/filters/'),
+            Route('filter-value-list', 'get', '/api/filter-values/'),
+            Route('cache-stats', 'get', '/api/cache/stats/'),
+        ]
+
+        # Вторая страница курсорной пагинации - по ссылке из первой
+        response = client.get('/api/products/?pagination=cursor')
+        next_url = response.json().get('next') if response.status_code == 200 else None
+        if next_url:
+            routes.append(Route(
+                'product-list-cursor', 'get',
+                next_url.split(self.host, 1)[-1]
+            ))
+        if samples['filter_value']:
+            value = samples['filter_value']
+            routes += [
+                Route(
+                    'product-list-filter-values', 'get',
+                    f'/api/products/?fv={value}'
+                ),
+                Route(
+                    'product-list-facets', 'get',
+                    f'/api/products/?category={category}&fv={value}&facets=true'
+                ),
+                Route('filter-detail', 'get', f"/api/filters/{samples['filter']}/"),
+                Route('filter-value-detail', 'get', f'/api/filter-values/{value}/'),
+            ]
+        if samples['photo']:
+            routes.append(Route(
+                'product-photo-detail', 'get',
+                f"/api/product-photos/{samples['photo']}/"
+            ))
+        if samples['tab']:
+            routes.append(Route(
+                'product-tab-detail', 'get',
+                f"/api/product-tabs/{samples['tab']}/"
+            ))
+        return routes
+
+    def write_routes(self, samples):
+        category = samples['category']
+        product = samples['product']
+
+        def import_file():
+            row = {
+                'external_id': 'benchmark-import', 'name': 'Импорт',
+                'category': category, 'price': '10.00',
+            }
+            return {'file': SimpleUploadedFile(
+                'feed.jsonl', json.dumps(row).encode()
+            )}
+
+        routes = [
+            Route('auth-login', 'post', '/api/auth/login/', lambda: {
+                'username': samples['username'],
+                'password': samples['password'],
+            }),
+            Route('product-create', 'post', '/api/products/', lambda: {
+                'name': 'Новый товар', 'category': category, 'price': '99.90',
+            }),
+            Route(
+                'product-update', 'patch', f'/api/products/{product}/',
+                lambda: {'price': '100.00'}
+            ),
+            Route(
+                'product-toggle-active', 'post',
+                f'/api/products/{product}/toggle_active/'
+            ),
+            Route('product-delete', 'delete', f'/api/products/{product}/'),
+            Route('product-import', 'post', '/api/products/import/', import_file),
+            Route(
+                'product-batch-update', 'post', '/api/products/batch/',
+                lambda: {'operations': [
+                    {'op': 'update', 'id': pk, 'data': {'price': '100.00'}}
+                    for pk in samples['batch']
+                ]},
+            ),
+            Route(
+                'category-toggle-active', 'post',
+                f'/api/categories/{category}/toggle_active/'
+            ),
+        ]
+        if samples['photo']:
+            routes.append(Route(
+                'product-photo-set-main', 'post',
+                f"/api/product-photos/{samples['photo']}/set_main/"
+            ))
+        if samples['tabs']:
+            routes.append(Route(
+                'product-tab-reorder', 'post', '/api/product-tabs/reorder/',
+                lambda: {'product': product, 'orders': [
+                    {'id': pk, 'order': order}
+                    for order, pk in enumerate(reversed(samples['tabs']))
+                ]},
+            ))
+        return routes
+
+    def call(self, client, route, recorder=None):
+        """Один вызов маршрута; для записи - с откатом транзакции"""
+        kwargs = {}
+        if route.data is not None:
+            kwargs['data'] = route.data()
+            if route.name != 'product-import':
+                kwargs['data'] = json.dumps(kwargs['data'])
+                kwargs['content_type'] = 'application/json'
+
+        with ExitStack() as stack:
+            if route.settings:
+                stack.enter_context(override_settings(**route.settings))
+            if route.method != 'get':
+                stack.enter_context(transaction.atomic())
+            if recorder is not None:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(recorder))
+            response = getattr(client, route.method)(route.path, **kwargs)
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response.streaming_content)
+            else:
+                size = len(response.content)
+            if route.method != 'get':
+                transaction.set_rollback(True)
+        return response, size
+
+    def measure(self, client, route):
+        for _ in range(self.warmup):
+            self.call(client, route)
+
+        durations = []
+        queries = []
+        for _ in range(self.iterations):
+            recorder = QueryRecorder()
+            start = time.perf_counter()
+            response, size = self.call(client, route, recorder)
+            durations.append((time.perf_counter() - start) * 1000)
+            queries.append(recorder.count)
+
+        tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            self.call(client, route)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        result = {
+            'method': route.method.upper(),
+            'path': route.path,
+            'status': response.status_code,
+            'bytes': size,
+            'mean_ms': round(sum(durations) / len(durations), 3),
+        }
+        for name, q in QUANTILES.items():
+            result[name] = round(percentile(durations, q), 3)
+        result['queries'] = round(sum(queries) / len(queries), 1)
+        result['peak_memory_kb'] = round(peak / 1024, 1)
+        return result
+
+    def get_meta(self):
+        return {
+            'revision': git_revision(),
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'iterations': self.iterations,
+            'warmup': self.warmup,
+            'cache': self.use_cache,
+            'counts': {
+                model._meta.model_name: model.objects.count()
+                for model in (
+                    Category, Product, ProductPhoto, ProductTab, Filter,
+                    FilterValue,
+                )
+            },
+        }
+
+
+class LoadRunner(BenchmarkRunner):
+    """
+    Пропускная способность маршрутов чтения запущенного сервера.
+
+    На каждый маршрут ``concurrency`` потоков в течение ``duration`` секунд
+    отправляют запросы по HTTP (keep-alive, если сервер его держит), сразу
+    следующий после ответа на предыдущий. Так сравниваются конфигурации
+    развертывания (WSGI и ASGI, количество воркеров) на одной БД: сервер
+    должен работать с той же БД, что и команда. Кэш ответов и прочие
+    настройки определяет сервер.
+    """
+
+    def __init__(self, url, concurrency=50, duration=10, **kwargs):
+        super().__init__(**kwargs)
+        parts = urlsplit(url)
+        self.url = url
+        self.connection_class = (
+            http.client.HTTPSConnection if parts.scheme == 'https'
+            else http.client.HTTPConnection
+        )
+        self.netloc = parts.netloc
+        self.concurrency = concurrency
+        self.duration = duration
+
+    def write_routes(self, samples):
+        return []
+
+    def read_routes(self, samples, client):
+        # Настройки сервера из команды не переопределить
+        return [
+            route for route in super().read_routes(samples, client)
+            if not route.settings
+        ]
+
+    def measure(self, client, route):
+        barrier = threading.Barrier(self.concurrency + 1)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(self.worker, route, barrier)
+                for _ in range(self.concurrency)
+            ]
+            barrier.wait()
+            started = time.perf_counter()
+            results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - started
+
+        durations = [value for values, _, _ in results for value in values]
+        errors = sum(failures for _, failures, _ in results)
+        statuses = {}
+        for _, _, counts in results:
+            for code, value in counts.items():
+                statuses[code] = statuses.get(code, 0) + value
+        result = {
+            'method': 'GET',
+            'path': route.path,
+            'status': max(statuses, key=statuses.get) if statuses else None,
+            'requests': len(durations),
+            'errors': errors,
+            'rps': round(len(durations) / elapsed, 1),
+            'mean_ms': round(sum(durations) / len(durations), 3) if durations else None,
+        }
+        for name, q in QUANTILES.items():
+            result[name] = round(percentile(durations, q), 3) if durations else None
+        return result
+
+    def worker(self, route, barrier):
+        """Запросы одного клиента: ``(время ответов, ошибки, коды ответов)``"""
+        connection = self.connection_class(self.netloc, timeout=60)
+        headers = {'Authorization': f'Token {self.token}'}
+        durations = []
+        failures = 0
+        statuses = {}
+
+        def request():
+            response = None
+            try:
+                connection.request('GET', route.path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+            return response
+
+        for _ in range(self.warmup):
+            request()
+        barrier.wait()
+        deadline = time.perf_counter() + self.duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = request()
+            durations.append((time.perf_counter() - start) * 1000)
+            if response is None or response.status >= 400:
+                failures += 1
+            if response is not None:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        connection.close()
+        return durations, failures, statuses
+
+    def get_meta(self):
+        meta = super().get_meta()
+        del meta['iterations'], meta['cache']
+        meta.update({
+            'mode': 'load',
+            'url': self.url,
+            'concurrency': self.concurrency,
+            'duration': self.duration,
+        })
+        return meta
+
+
+class CompressionRunner(BenchmarkRunner):
+    """
+    Стоимость сжатия ответов против сэкономленных байт.
+
+    Тело ответа каждого маршрута (без сжатия, кэш отключен) сжимается
+    ``iterations`` раз каждой доступной кодировкой на нескольких уровнях:
+    время сжатия (p50/p95) и размер результата. По нему подбираются
+    ``CATALOG_GZIP_LEVEL``, ``CATALOG_BROTLI_QUALITY`` и
+    ``CATALOG_COMPRESS_MIN_SIZE`` для типичных страниц каталога.
+    """
+    levels = {'gzip': (1, 6, 9), 'br': (1, 4, 5, 8, 11)}
+    default_routes = (
+        'category-list', 'category-tree', 'product-list',
+        'product-list-cursor-200', 'product-list-fields', 'product-detail',
+    )
+
+    def run(self, only=None):
+        return super().run(only=only or self.default_routes)
+
+    def write_routes(self, samples):
+        return []
+
+    def measure(self, client, route):
+        response, _ = self.call(client, route)
+        content = response.content
+        encodings = {}
+        for encoding in compression.ENCODINGS:
+            for level in self.levels[encoding]:
+                durations = []
+                for _ in range(self.warmup + self.iterations):
+                    start = time.perf_counter()
+                    compressed = compression.compress(content, encoding, level)
+                    durations.append((time.perf_counter() - start) * 1000)
+                durations = durations[self.warmup:]
+                result = {
+                    'bytes': len(compressed),
+                    'ratio': round(len(compressed) / len(content), 3)
+                    if content else None,
+                }
+                for name, q in QUANTILES.items():
+                    result[name] = round(percentile(durations, q), 3)
+                encodings[f'{encoding}-{level}'] = result
+        return {
+            'method': route.method.upper(),
+            'path': route.path,
+            'status': response.status_code,
+            'bytes': len(content),
+            'encodings': encodings,
+        }
+
+    def get_meta(self):
+        meta = super().get_meta()
+        meta['mode'] = 'compression'
+        return meta
+
+
+def compare(baseline, current):
+    """Строки сравнения двух результатов: ``(маршрут, метрика, было, стало, %)``"""
+    rows = []
+    for name, result in current['routes'].items():
+        previous = baseline.get('routes', {}).get(name)
+        if previous is None:
+            continue
+        for metric in ('rps', 'p50_ms', 'p95_ms', 'queries', 'peak_memory_kb'):
+            before, after = previous.get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else None
+            rows.append((name, metric, before, after, change))
+    return rows
@@ -0,0 +1,289 @@
+"""
+Кэш ответов GET-запросов каталога (read-through).
+
+Ответ ``list``/``retrieve``/``tree`` сохраняется в кэше Django
+(``CATALOG_CACHE_ALIAS``: locmem, файловый, Redis и т.д.) по ключу из
+текущей версии каталога, хоста, пути и отсортированных параметров
+запроса. Любое изменение каталога (сигналы моделей, массовые операции)
+после коммита увеличивает версию, и все старые ключи перестают
+использоваться - удалять записи по шаблону не нужно, они вытесняются
+по ``CATALOG_CACHE_TIMEOUT``.
+
+Версия читается до выполнения запроса к БД: если запись совпала
+по времени с чтением, ответ сохранится под старой версией и не будет
+отдан после коммита.
+
+Хранятся отрендеренные байты ответа (только JSON: browsable API зависит
+от пользователя), а рядом - сжатые копии (``<ключ>:gzip``, ``<ключ>:br``),
+которые сохраняет ``catalog.compression.CompressionMiddleware``. Попадание
+отдает готовые байты в кодировке клиента без сериализации и сжатия.
+
+Версия каталога хранится в том же кэше, поэтому при нескольких воркерах
+кэш должен быть общим (Redis, Memcached, файлы): в памяти процесса запись
+сбросила бы кэш только своего воркера. С локальным бэкендом кэш ответов
+по умолчанию выключен, а включенный вручную дает предупреждение
+``catalog.W001`` (``catalog.checks``).
+
+Проверка прав выполняется DRF до обращения к кэшу, поэтому закэшированный
+ответ получают только пользователи, прошедшие ``permission_classes``.
+
+С репликами (``catalog.replicas``) пользователь, закрепленный за основной
+БД после записи, читает мимо кэша, а запись, построенная по реплике в
+первые ``CATALOG_REPLICA_PIN_SECONDS`` после изменения каталога, хранится
+только до конца этого окна: реплика могла еще не получить изменение.
+"""
+import hashlib
+import math
+import time
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+from . import compression, replicas
+
+VERSION_KEY = 'catalog:version'
+WRITTEN_AT_KEY = 'catalog:written_at'
+STATS_KEYS = {
+    'hits': 'catalog:stats:hits',
+    'misses': 'catalog:stats:misses',
+}
+
+
+def get_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def is_shared(alias=None):
+    """Общий ли кэш для всех воркеров (не память процесса)"""
+    alias = alias or settings.CATALOG_CACHE_ALIAS
+    return settings.CACHES[alias]['BACKEND'] not in settings.LOCAL_CACHE_BACKENDS
+
+
+def is_enabled():
+    return settings.CATALOG_CACHE_TIMEOUT > 0
+
+
+def is_readable():
+    """Использовать ли кэш в текущем запросе (не закреплен за основной БД)"""
+    return is_enabled() and not replicas.is_pinned()
+
+
+def get_timeout(written_at):
+    """Срок хранения записи, построенной текущим запросом
+
+    ``written_at`` - время последнего изменения каталога из кэша.
+    """
+    timeout = settings.CATALOG_CACHE_TIMEOUT
+    if written_at is None or not replicas.reads_replica():
+        return timeout
+    remaining = written_at + settings.CATALOG_REPLICA_PIN_SECONDS - time.time()
+    if remaining <= 0:
+        return timeout
+    return min(timeout, math.ceil(remaining))
+
+
+def get_version():
+    """Текущая версия каталога
+
+    Начальное значение берется из часов: если ключ версии вытеснен,
+    новая версия все равно больше всех прежних.
+    """
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+aget_version = sync_to_async(get_version)
+
+
+def bump_version():
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+    cache.set(WRITTEN_AT_KEY, time.time(), timeout=None)
+
+
+def invalidate():
+    """Сбросить кэш каталога после коммита текущей транзакции"""
+    if is_enabled():
+        transaction.on_commit(bump_version)
+
+
+def make_key(request, version):
+    params = sorted(
+        (key, value)
+        for key in request.query_params
+        for value in request.query_params.getlist(key)
+    )
+    raw = '|'.join([
+        request.scheme, request.get_host(), request.path,
+        '&'.join(f'{key}={value}' for key, value in params),
+        # Формат ответа (например, ``application/json; indent=4``)
+        getattr(request, 'accepted_media_type', None) or '',
+    ])
+    digest = hashlib.md5(raw.encode()).hexdigest()
+    return f'catalog:response:{version}:{digest}'
+
+
+def memoize(request, suffix, compute):
+    """Значение ``compute()`` для запроса, кэшируемое до изменения каталога"""
+    if not is_readable():
+        return compute()
+    cache = get_cache()
+    key = f'{make_key(request, get_version())}:{suffix}'
+    values = cache.get_many([key, WRITTEN_AT_KEY])
+    value = values.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, get_timeout(values.get(WRITTEN_AT_KEY)))
+    return value
+
+
+async def amemoize(request, suffix, compute):
+    """``memoize`` для асинхронных представлений (``compute`` - корутина)"""
+    if not is_readable():
+        return await compute()
+    cache = get_cache()
+    key = f'{make_key(request, await aget_version())}:{suffix}'
+    values = await cache.aget_many([key, WRITTEN_AT_KEY])
+    value = values.get(key)
+    if value is None:
+        value = await compute()
+        await cache.aset(key, value, get_timeout(values.get(WRITTEN_AT_KEY)))
+    return value
+
+
+def count(name):
+    cache = get_cache()
+    key = STATS_KEYS[name]
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+acount = sync_to_async(count)
+
+
+def get_stats():
+    """Счетчики попаданий/промахов и доля попаданий"""
+    cache = get_cache()
+    values = cache.get_many(STATS_KEYS.values())
+    stats = {
+        name: values.get(key, 0) for name, key in STATS_KEYS.items()
+    }
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / total, 4) if total else None
+    return stats
+
+
+def reset_stats():
+    get_cache().delete_many(STATS_KEYS.values())
+
+
+def is_cacheable(request):
+    return isinstance(getattr(request, 'accepted_renderer', None), JSONRenderer)
+
+
+def get_lookup_keys(key, encoding):
+    """Ключи записей ответа (сначала сжатой копии, затем исходной) и
+    время изменения каталога"""
+    if encoding is None:
+        return [key, WRITTEN_AT_KEY]
+    return [f'{key}:{encoding}', key, WRITTEN_AT_KEY]
+
+
+def build_hit(key, encoding, values):
+    """Ответ из записей кэша или ``None`` при промахе"""
+    if encoding is not None and f'{key}:{encoding}' in values:
+        content_type, content = values[f'{key}:{encoding}']
+        response = HttpResponse(content, content_type=content_type)
+        response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(content))
+        patch_vary_headers(response, ('Accept-Encoding',))
+    elif key in values:
+        content_type, content = values[key]
+        response = HttpResponse(content, content_type=content_type)
+        # Сжатую копию сохранит CompressionMiddleware
+        response.compressed_cache_key = key
+        response.compressed_cache_timeout = get_timeout(
+            values.get(WRITTEN_AT_KEY)
+        )
+    else:
+        return None
+    response['X-Cache'] = 'HIT'
+    return response
+
+
+def store(response, key, timeout):
+    """Сохранить ответ в кэш после рендеринга"""
+    response.compressed_cache_key = key
+    response.compressed_cache_timeout = timeout
+    response.add_post_render_callback(lambda rendered: get_cache().set(
+        key, (rendered['Content-Type'], rendered.content), timeout,
+    ))
+
+
+def cached_response(method):
+    """Декоратор метода ViewSet: отдать ответ из кэша или сохранить его
+
+    Кэшируются только успешные ответы; заголовок ``X-Cache`` показывает,
+    был ли ответ взят из кэша (``HIT``) или построен заново (``MISS``).
+    """
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        if not is_readable() or not is_cacheable(request):
+            return method(self, request, *args, **kwargs)
+
+        key = make_key(request, get_version())
+        encoding = compression.negotiate(request)
+        values = get_cache().get_many(get_lookup_keys(key, encoding))
+        response = build_hit(key, encoding, values)
+        if response is not None:
+            count('hits')
+            return response
+
+        count('misses')
+        response = method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            store(response, key, get_timeout(values.get(WRITTEN_AT_KEY)))
+        response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+
+def acached_response(method):
+    """``cached_response`` для асинхронного метода ViewSet"""
+    @wraps(method)
+    async def wrapper(self, request, *args, **kwargs):
+        if not is_readable() or not is_cacheable(request):
+            return await method(self, request, *args, **kwargs)
+
+        key = make_key(request, await aget_version())
+        encoding = compression.negotiate(request)
+        values = await get_cache().aget_many(get_lookup_keys(key, encoding))
+        response = build_hit(key, encoding, values)
+        if response is not None:
+            await acount('hits')
+            return response
+
+        await acount('misses')
+        response = await method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            # Рендеринг (и запись в кэш) выполняется в потоке
+            store(response, key, get_timeout(values.get(WRITTEN_AT_KEY)))
+        response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
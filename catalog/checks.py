@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+from . import caching
+
+
+def local_cache_warning(alias, users):
+    return Warning(
+        f'Кэш "{alias}" хранится в памяти процесса, а от него зависят: '
+        f'{", ".join(users)}. При нескольких воркерах запись видна только '
+        f'воркеру, который ее выполнил.',
+        hint='Задайте общий CACHE_BACKEND (Redis) или запускайте один воркер.',
+        id='catalog.W001',
+    )
+
+
+@register()
+def check_catalog_cache(app_configs, **kwargs):
+    """Кэш каталога в памяти процесса не согласован между воркерами"""
+    errors = []
+    users = []
+    if caching.is_enabled():
+        users.append('кэш ответов и ETag (CATALOG_CACHE_TIMEOUT)')
+    if settings.CATALOG_DB_REPLICAS:
+        users.append('закрепление за основной БД после записи (CATALOG_DB_REPLICAS)')
+    if users and not caching.is_shared():
+        errors.append(local_cache_warning(settings.CATALOG_CACHE_ALIAS, users))
+
+    alias = settings.CATALOG_TOKEN_CACHE_ALIAS
+    if alias and not caching.is_shared(alias):
+        errors.append(local_cache_warning(
+            alias, ['кэш токенов (CATALOG_TOKEN_CACHE_ALIAS)']
+        ))
+    return errors
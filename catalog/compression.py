@@ -0,0 +1,212 @@
+"""
+Сжатие ответов API (gzip, brotli) с выбором по ``Accept-Encoding``.
+
+``CompressionMiddleware`` сжимает ответы с данными API (JSON, JSONL и CSV
+экспорта) от ``CATALOG_COMPRESS_MIN_SIZE`` байт: brotli, если клиент его
+принимает и установлен пакет ``brotli``, иначе gzip. Потоковые ответы
+(экспорт) сжимаются по частям. HTML (админка, вход, browsable API) не
+сжимается: в нем есть CSRF-токен рядом с данными из запроса, и по
+размеру сжатого ответа его можно подобрать (BREACH).
+
+Кэшируемые ответы каталога (``catalog.caching``) хранятся уже
+отрендеренными, а сжатая копия сохраняется рядом при первом сжатии:
+повторное попадание отдает готовые байты без сериализации и без сжатия.
+
+Байты сжатого ответа отличаются от исходного, поэтому к ETag добавляется
+кодировка (``"<etag>-gzip"``, ``"<etag>-br"``), как делает Apache
+``mod_deflate``. Валидаторы каталога строятся по данным, а не по байтам,
+поэтому во входящих ``If-None-Match`` и ``If-Match`` суффикс отбрасывается:
+строгий ETag деталей, прочитанных в любой кодировке, подходит для
+``If-Match``.
+"""
+import gzip
+import re
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+
+from . import caching
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# В порядке предпочтения сервера при равном q
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# Только данные API: HTML с CSRF-токеном не сжимаем (BREACH)
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/csv')
+
+# Суффикс кодировки в конце ETag: "abc-gzip" или W/"abc-br"
+ETAG_ENCODING_RE = re.compile(r'-(?:br|gzip)"')
+ETAG_HEADERS = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH')
+
+
+def parse_accept_encoding(header):
+    """``'gzip;q=0.5, br'`` -> ``{'gzip': 0.5, 'br': 1.0}``"""
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        name, _, value = params.strip().partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def negotiate(request):
+    """Кодировка ответа для запроса или ``None`` (без сжатия)"""
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if not header:
+        return None
+    accepted = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, level=None):
+    """Сжать байты ответа; ``level`` - степень сжатия вместо настройки"""
+    if encoding == 'br':
+        return brotli.compress(
+            data,
+            mode=brotli.MODE_TEXT,
+            quality=settings.CATALOG_BROTLI_QUALITY if level is None else level,
+        )
+    # mtime=0: одинаковые данные дают одинаковые байты
+    return gzip.compress(
+        data,
+        compresslevel=settings.CATALOG_GZIP_LEVEL if level is None else level,
+        mtime=0,
+    )
+
+
+def compress_stream(chunks, encoding):
+    if encoding == 'gzip':
+        yield from compress_sequence(chunks)
+        return
+    compressor = brotli.Compressor(
+        mode=brotli.MODE_TEXT, quality=settings.CATALOG_BROTLI_QUALITY
+    )
+    for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def tag_etag(response):
+    """Добавить к ETag кодировку сжатого ответа"""
+    encoding = response.get('Content-Encoding')
+    etag = response.get('ETag')
+    if encoding in ('br', 'gzip') and etag and etag.endswith('"'):
+        response['ETag'] = f'{etag[:-1]}-{encoding}"'
+    return response
+
+
+def untag_etags(request):
+    """Убрать суффиксы кодировок из ETag в предусловиях запроса"""
+    for name in ETAG_HEADERS:
+        if name in request.META:
+            request.META[name] = ETAG_ENCODING_RE.sub('"', request.META[name])
+
+
+def is_compressible(response):
+    if response.has_header('Content-Encoding'):
+        return False
+    content_type = response.get('Content-Type', '').lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    """
+    Сжатие ответов по ``Accept-Encoding``.
+
+    Если у ответа есть ``compressed_cache_key`` (ответ из кэша каталога
+    или только что сохраненный в него), сжатые байты сохраняются в кэш
+    под ``<ключ>:<кодировка>``. Поддерживает синхронный и асинхронный
+    стек; должен стоять в ``MIDDLEWARE`` раньше всех, кто читает или
+    меняет тело ответа.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        untag_etags(request)
+        response, entry = self.process(request, self.get_response(request))
+        if entry is not None:
+            caching.get_cache().set(*entry)
+        return response
+
+    async def __acall__(self, request):
+        untag_etags(request)
+        response, entry = self.process(request, await self.get_response(request))
+        if entry is not None:
+            await caching.get_cache().aset(*entry)
+        return response
+
+    def process(self, request, response):
+        """Сжатый ответ и запись кэша ``(ключ, значение, срок)`` или ``None``"""
+        response, entry = self.compress_response(request, response)
+        # И для ответа, сжатого сейчас, и для сжатой копии из кэша
+        return tag_etag(response), entry
+
+    def compress_response(self, request, response):
+        if not is_compressible(response):
+            return response, None
+        if response.streaming:
+            if response.is_async:
+                return response, None
+        elif len(response.content) < settings.CATALOG_COMPRESS_MIN_SIZE:
+            return response, None
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate(request)
+        if encoding is None:
+            return response, None
+
+        if response.streaming:
+            response.streaming_content = compress_stream(
+                response.streaming_content, encoding
+            )
+            del response['Content-Length']
+            response['Content-Encoding'] = encoding
+            return response, None
+
+        content = compress(response.content, encoding)
+        if len(content) >= len(response.content):
+            return response, None
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+
+        key = getattr(response, 'compressed_cache_key', None)
+        if key is None:
+            return response, None
+        return response, (
+            f'{key}:{encoding}', (response['Content-Type'], content),
+            response.compressed_cache_timeout,
+        )
+
@@ -0,0 +1,174 @@
+"""
+Условные запросы (ETag, Last-Modified, If-Match) для ViewSet каталога.
+
+Валидаторы строятся одним агрегирующим запросом без сериализации:
+``COUNT(*)`` и ``MAX(updated_at)`` по выборке ответа (для деталей -
+по одному объекту). Все, что входит в ответ, но хранится в других
+таблицах (фото и вкладки товара, счетчики категорий), при изменении
+обновляет ``updated_at`` владельца, поэтому совпадение валидаторов
+означает неизменный ответ.
+
+- ``GET``/``HEAD``: ``If-None-Match``/``If-Modified-Since`` -> 304;
+- ``PUT``/``PATCH``: ``If-Match``/``If-Unmodified-Since`` -> 412, если
+  объект изменился с момента чтения клиентом.
+
+Для чтения валидаторы кэшируются вместе с ответами (``catalog.caching``),
+поэтому повторный запрос с ``If-None-Match`` не обращается к БД.
+
+Для деталей выдается строгий ETag (можно передавать в ``If-Match``),
+для списков - слабый, так как он зависит и от параметров запроса.
+"""
+import hashlib
+from functools import wraps
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+
+from . import caching
+from .fieldsets import QUERY_PARAMS
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def conditional(method):
+    """Декоратор метода ViewSet: проверить предусловия и выставить валидаторы"""
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            # Для чтения валидаторы берутся из кэша каталога
+            etag, last_modified = caching.memoize(
+                request, 'validators', lambda: self.get_validators(request)
+            )
+        else:
+            etag, last_modified = self.get_validators(request)
+        if etag is not None:
+            response = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if response is not None:
+                return response
+
+        response = method(self, request, *args, **kwargs)
+        if request.method not in SAFE_METHODS:
+            if not status.is_success(response.status_code):
+                return response
+            # После записи клиент получает валидаторы нового состояния
+            etag, last_modified = self.get_validators(request)
+        return set_validators(response, etag, last_modified)
+    return wrapper
+
+
+def aconditional(method):
+    """``conditional`` для асинхронного метода чтения ViewSet"""
+    @wraps(method)
+    async def wrapper(self, request, *args, **kwargs):
+        etag, last_modified = await caching.amemoize(
+            request, 'validators', lambda: self.aget_validators(request)
+        )
+        if etag is not None:
+            response = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if response is not None:
+                return response
+
+        response = await method(self, request, *args, **kwargs)
+        return set_validators(response, etag, last_modified)
+    return wrapper
+
+
+def set_validators(response, etag, last_modified):
+    if etag is not None and status.is_success(response.status_code):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ConditionalMixin:
+    """
+    Валидаторы ответа по полям ``modified_fields``.
+
+    Пустой ``modified_fields`` отключает условные запросы (у модели нет
+    отметки времени изменения).
+    """
+    modified_fields = ()
+
+    def get_validator_queryset(self):
+        if self.detail:
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            return self.get_queryset().filter(**{
+                self.lookup_field: self.kwargs[lookup_url_kwarg]
+            })
+        return self.filter_queryset(self.get_queryset())
+
+    def get_lookup_validator_queryset(self):
+        try:
+            return self.get_validator_queryset().order_by()
+        except (TypeError, ValueError, ValidationError):
+            # Некорректный id в URL: пусть обработчик вернет 404
+            return None
+
+    def get_validator_aggregates(self):
+        aggregates = {'count': Count('pk')}
+        for index, field in enumerate(self.modified_fields):
+            aggregates[f'modified_{index}'] = Max(field)
+        return aggregates
+
+    def get_validators(self, request):
+        """Вернуть ``(etag, last_modified)`` или ``(None, None)``"""
+        if not self.modified_fields:
+            return None, None
+        queryset = self.get_lookup_validator_queryset()
+        if queryset is None:
+            return None, None
+        values = queryset.aggregate(**self.get_validator_aggregates())
+        return self.build_validators(request, values)
+
+    async def aget_validators(self, request):
+        if not self.modified_fields:
+            return None, None
+        queryset = self.get_lookup_validator_queryset()
+        if queryset is None:
+            return None, None
+        values = await queryset.aaggregate(**self.get_validator_aggregates())
+        return self.build_validators(request, values)
+
+    def build_validators(self, request, values):
+        if self.detail and not values['count']:
+            # Объекта нет: пусть обработчик вернет 404
+            return None, None
+
+        stamps = [
+            values[f'modified_{index}']
+            for index in range(len(self.modified_fields))
+        ]
+        parts = [
+            self.basename, str(values['count']),
+            *(stamp.isoformat() if stamp else '' for stamp in stamps),
+        ]
+        if not self.detail:
+            parts.append(request.path)
+            parts.extend(sorted(
+                f'{key}={value}'
+                for key in request.query_params
+                for value in request.query_params.getlist(key)
+            ))
+        else:
+            # Выборочные поля - другое представление того же объекта
+            parts.extend(
+                f'{key}={value}'
+                for key in QUERY_PARAMS
+                for value in request.query_params.getlist(key)
+            )
+        etag = quote_etag(hashlib.md5(':'.join(parts).encode()).hexdigest())
+        if not self.detail:
+            etag = f'W/{etag}'
+
+        last_modified = max((stamp for stamp in stamps if stamp), default=None)
+        if last_modified is not None:
+            last_modified = int(last_modified.timestamp())
+        return etag, last_modified
@@ -0,0 +1,129 @@
+"""
+Потоковая выгрузка каталога в CSV и JSONL.
+
+Товары читаются серверным курсором (``iterator(chunk_size=...)``),
+связанные фото, вкладки и значения фильтров подгружаются отдельным
+запросом на каждый пакет, а готовый текст отдается клиенту кусками
+по мере формирования. Поэтому память процесса не зависит от размера
+каталога. Колонки CSV совместимы с импортом (``catalog.importers``).
+"""
+import csv
+import io
+import json
+
+from django.db.models import Prefetch
+
+from .models import Category, FilterValue, ProductPhoto
+
+FORMATS = ('csv', 'jsonl')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+CSV_COLUMNS = [
+    'id', 'external_id', 'name', 'category', 'category_path',
+    'description', 'price', 'old_price', 'quantity', 'is_active',
+    'filter_values', 'photos', 'tabs', 'created_at', 'updated_at',
+]
+
+
+class CatalogExporter:
+    """Построчная сериализация товаров для выгрузки"""
+
+    def __init__(self, queryset, base_url, chunk_size=1000):
+        self.queryset = queryset.select_related(None).prefetch_related(
+            None
+        ).prefetch_related(
+            Prefetch(
+                'filter_values',
+                queryset=FilterValue.objects.select_related('filter')
+            ),
+            Prefetch(
+                'photos',
+                queryset=ProductPhoto.objects.order_by('order', 'created_at')
+            ),
+            'tabs',
+        ).order_by('pk')
+        self.base_url = base_url.rstrip('/')
+        self.chunk_size = chunk_size
+        self.category_paths = Category.build_name_paths()
+
+    def photo_url(self, photo):
+        url = photo.image.url
+        if url.startswith(('http://', 'https://')):
+            return url
+        return f'{self.base_url}{url}'
+
+    def to_record(self, product):
+        return {
+            'id': product.pk,
+            'external_id': product.external_id,
+            'name': product.name,
+            'category': product.category_id,
+            'category_path': self.category_paths.get(product.category_id, ''),
+            'description': product.description,
+            'price': str(product.price),
+            'old_price': (
+                str(product.old_price) if product.old_price is not None else None
+            ),
+            'quantity': product.quantity,
+            'is_active': product.is_active,
+            'filter_values': [
+                {
+                    'id': value.pk,
+                    'filter': value.filter.name,
+                    'value': value.value,
+                }
+                for value in product.filter_values.all()
+            ],
+            'photos': [
+                {
+                    'url': self.photo_url(photo),
+                    'is_main': photo.is_main,
+                    'order': photo.order,
+                }
+                for photo in product.photos.all()
+            ],
+            'tabs': [
+                {'title': tab.title, 'content': tab.content, 'order': tab.order}
+                for tab in product.tabs.all()
+            ],
+            'created_at': product.created_at.isoformat(),
+            'updated_at': product.updated_at.isoformat(),
+        }
+
+    def to_csv_row(self, record):
+        row = dict(record)
+        row['filter_values'] = ','.join(
+            str(value['id']) for value in record['filter_values']
+        )
+        row['photos'] = ' '.join(photo['url'] for photo in record['photos'])
+        row['tabs'] = json.dumps(record['tabs'], ensure_ascii=False)
+        row['is_active'] = 'true' if record['is_active'] else 'false'
+        return row
+
+    def records(self):
+        for product in self.queryset.iterator(chunk_size=self.chunk_size):
+            yield self.to_record(product)
+
+    def stream(self, file_format):
+        """Генератор кусков текста выгрузки (по одному на пакет товаров)"""
+        buffer = io.StringIO()
+        writer = None
+        if file_format == 'csv':
+            writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+            writer.writeheader()
+
+        for count, record in enumerate(self.records(), start=1):
+            if writer is not None:
+                writer.writerow(self.to_csv_row(record))
+            else:
+                buffer.write(json.dumps(record, ensure_ascii=False))
+                buffer.write('\n')
+            if count % self.chunk_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
@@ -0,0 +1,312 @@
+"""
+Фасетный индекс товаров по значениям фильтров.
+
+Для каждой категории в памяти процесса строится индекс по ее товарам
+(как и ``?category=``, без подкатегорий): каждому товару выдается
+позиция (бит), а каждому значению фильтра - битовая маска товаров
+(целое число Python). Выборка по ``?fv=`` и подсчет фасетов сводятся
+к операциям ``&``/``|`` над масками. Небольшая выборка передается в
+запрос списком id; если подходящих товаров больше ``MAX_ID_LIST``, та же
+выборка повторяется в SQL условиями ``EXISTS`` (``filter_queryset``).
+
+Без категории индекс не строится: выборка выполняется условиями
+``EXISTS``, а фасеты считаются в SQL группировкой (``count_values``).
+
+Актуальность индекса определяется полем ``Category.facet_version``:
+любое изменение товаров категории увеличивает версию в БД. Процесс,
+в котором произошло изменение, применяет его к своему индексу
+инкрементально после коммита; остальные воркеры видят расхождение
+версий и перестраивают индекс при следующем запросе.
+"""
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q
+
+from .models import Category, FilterValue, Product
+
+# Наибольшее количество id выборки, передаваемых в запрос через IN
+MAX_ID_LIST = 1000
+
+
+class FacetIndex:
+    """Битовый индекс товаров категории"""
+
+    def __init__(self, category_id, version):
+        self.category_id = category_id
+        self.version = version
+        self.positions = {}
+        self.product_ids = []
+        self.all_bits = 0
+        self.active_bits = 0
+        self.value_bits = defaultdict(int)
+        self.value_filters = {}
+
+    @classmethod
+    def build(cls, category_id, version):
+        """Построить индекс категории двумя запросами"""
+        index = cls(category_id, version)
+        products = Product.objects.filter(
+            category_id=category_id
+        ).values_list('id', 'is_active').order_by()
+        for product_id, is_active in products.iterator(chunk_size=5000):
+            index.add_product(product_id, is_active)
+
+        through = Product.filter_values.through
+        links = through.objects.filter(
+            product__category_id=category_id
+        ).values_list('product_id', 'filtervalue_id', 'filtervalue__filter_id')
+        for product_id, value_id, filter_id in links.iterator(chunk_size=5000):
+            index.add_values(product_id, {value_id: filter_id})
+        return index
+
+    def add_product(self, product_id, is_active):
+        position = self.positions.get(product_id)
+        if position is None:
+            position = len(self.product_ids)
+            self.positions[product_id] = position
+            self.product_ids.append(product_id)
+        self.all_bits |= 1 << position
+        self.set_active(product_id, is_active)
+
+    def remove_product(self, product_id):
+        position = self.positions.pop(product_id, None)
+        if position is None:
+            return
+        mask = ~(1 << position)
+        self.all_bits &= mask
+        self.active_bits &= mask
+        for value_id in list(self.value_bits):
+            self.value_bits[value_id] &= mask
+
+    def set_active(self, product_id, is_active):
+        position = self.positions.get(product_id)
+        if position is None:
+            return
+        if is_active:
+            self.active_bits |= 1 << position
+        else:
+            self.active_bits &= ~(1 << position)
+
+    def add_values(self, product_id, values):
+        """Добавить товару значения фильтров ``{value_id: filter_id}``"""
+        position = self.positions.get(product_id)
+        if position is None:
+            return
+        for value_id, filter_id in values.items():
+            self.value_bits[value_id] |= 1 << position
+            self.value_filters[value_id] = filter_id
+
+    def remove_values(self, product_id, value_ids=None):
+        """Убрать у товара значения фильтров (все, если ``value_ids`` не задан)"""
+        position = self.positions.get(product_id)
+        if position is None:
+            return
+        mask = ~(1 << position)
+        if value_ids is None:
+            value_ids = list(self.value_bits)
+        for value_id in value_ids:
+            if value_id in self.value_bits:
+                self.value_bits[value_id] &= mask
+
+    def search(self, selected, is_active=None):
+        """Выборка и фасеты для выбранных значений
+
+        ``selected`` - словарь ``{value_id: filter_id}``. Внутри одного
+        фильтра значения объединяются по ИЛИ, между фильтрами - по И.
+        Возвращает маску подходящих товаров (id - ``bits_to_ids``) и
+        словарь ``{value_id: количество}``, где количество считается с
+        учетом выбора во всех остальных фильтрах.
+        """
+        base = self.all_bits
+        if is_active is True:
+            base = self.active_bits
+        elif is_active is False:
+            base = self.all_bits & ~self.active_bits
+
+        groups = {
+            filter_id: self.union(value_ids)
+            for filter_id, value_ids in group_by_filter(selected).items()
+        }
+
+        result = base
+        for bits in groups.values():
+            result &= bits
+
+        masks = {}
+        for filter_id in groups:
+            mask = base
+            for other_id, bits in groups.items():
+                if other_id != filter_id:
+                    mask &= bits
+            masks[filter_id] = mask
+
+        counts = {}
+        for value_id, bits in self.value_bits.items():
+            mask = masks.get(self.value_filters[value_id], result)
+            count = (bits & mask).bit_count()
+            if count or value_id in selected:
+                counts[value_id] = count
+        return result, counts
+
+    def union(self, value_ids):
+        bits = 0
+        for value_id in value_ids:
+            bits |= self.value_bits.get(value_id, 0)
+        return bits
+
+    def bits_to_ids(self, bits):
+        # bin() разворачивается в строку, поиск единиц по ней идет на C
+        digits = bin(bits)[:1:-1]
+        product_ids = []
+        position = digits.find('1')
+        while position != -1:
+            product_ids.append(self.product_ids[position])
+            position = digits.find('1', position + 1)
+        return product_ids
+
+
+class FacetIndexRegistry:
+    """Ограниченный LRU-кэш фасетных индексов текущего процесса"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, category_id):
+        """Актуальный индекс категории или ``None``, если ее нет"""
+        version = Category.objects.filter(
+            pk=category_id
+        ).values_list('facet_version', flat=True).first()
+        if version is None:
+            return None
+
+        with self.lock:
+            index = self.indexes.get(category_id)
+            if index is not None and index.version == version:
+                self.indexes.move_to_end(category_id)
+                return index
+
+        index = FacetIndex.build(category_id, version)
+        with self.lock:
+            self.indexes[category_id] = index
+            self.indexes.move_to_end(category_id)
+            while len(self.indexes) > self.max_size:
+                self.indexes.popitem(last=False)
+        return index
+
+    def apply(self, category_id, change):
+        """Применить изменение к загруженному индексу после коммита
+
+        Каждое изменение в БД увеличивает ``facet_version`` категории
+        ровно на единицу, поэтому здесь версия индекса тоже увеличивается
+        на единицу. Если параллельно писал другой процесс, версии
+        разойдутся и индекс будет перестроен.
+        """
+        def apply_change():
+            with self.lock:
+                index = self.indexes.get(category_id)
+                if index is not None:
+                    change(index)
+                    index.version += 1
+
+        transaction.on_commit(apply_change)
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+
+
+registry = FacetIndexRegistry(
+    getattr(settings, 'CATALOG_FACET_INDEX_SIZE', 64)
+)
+
+
+def resolve_filters(value_ids):
+    """Сопоставить выбранные значения их фильтрам: ``{value_id: filter_id}``"""
+    return dict(
+        FilterValue.objects.filter(pk__in=value_ids).values_list('id', 'filter_id')
+    )
+
+
+def group_by_filter(selected):
+    """``{value_id: filter_id}`` -> ``{filter_id: {value_id, ...}}``"""
+    groups = defaultdict(set)
+    for value_id, filter_id in selected.items():
+        groups[filter_id].add(value_id)
+    return groups
+
+
+def filter_queryset(queryset, selected):
+    """Оставить товары с выбранными значениями: по ``EXISTS`` на фильтр
+
+    В отличие от JOIN по каждому фильтру, не размножает строки и не
+    требует ``DISTINCT``.
+    """
+    through = Product.filter_values.through
+    for value_ids in group_by_filter(selected).values():
+        queryset = queryset.filter(Exists(through.objects.filter(
+            product_id=OuterRef('pk'), filtervalue_id__in=value_ids
+        )))
+    return queryset
+
+
+def count_values(queryset, selected):
+    """Фасеты выборки в SQL (без битового индекса)
+
+    Значения невыбранных фильтров считаются по всей выборке одной
+    группировкой, значения каждого выбранного фильтра - отдельной, с
+    учетом выбора только в остальных фильтрах (как ``FacetIndex.search``).
+    """
+    through = Product.filter_values.through
+    groups = group_by_filter(selected)
+
+    def count(products, condition):
+        return dict(
+            through.objects.filter(
+                condition, product_id__in=products.order_by().values('pk')
+            ).values_list('filtervalue_id').annotate(
+                count=Count('pk')
+            ).order_by()
+        )
+
+    counts = count(
+        filter_queryset(queryset, selected),
+        ~Q(filtervalue__filter_id__in=list(groups)),
+    )
+    for filter_id in groups:
+        others = {
+            value_id: other_id for value_id, other_id in selected.items()
+            if other_id != filter_id
+        }
+        counts.update(count(
+            filter_queryset(queryset, others),
+            Q(filtervalue__filter_id=filter_id),
+        ))
+    for value_id in selected:
+        counts.setdefault(value_id, 0)
+    return counts
+
+
+def build_facets(counts, selected):
+    """Сгруппировать счетчики значений по фильтрам для ответа API"""
+    values = FilterValue.objects.filter(
+        pk__in=counts
+    ).select_related('filter').order_by('filter__name', 'value')
+    facets = OrderedDict()
+    for value in values:
+        facet = facets.setdefault(value.filter_id, {
+            'id': value.filter_id,
+            'name': value.filter.name,
+            'values': [],
+        })
+        facet['values'].append({
+            'id': value.pk,
+            'value': value.value,
+            'count': counts[value.pk],
+            'selected': value.pk in selected,
+        })
+    return list(facets.values())
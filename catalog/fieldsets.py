@@ -0,0 +1,214 @@
+"""
+Выборочные поля ответа: ``?fields=`` и ``?expand=``.
+
+- ``?fields=id,name,tabs.title`` - в ответе только перечисленные поля;
+  через точку выбираются поля вложенных объектов (``tabs.title`` - только
+  заголовки вкладок, ``tabs`` - вкладки целиком);
+- ``?expand=photos,tabs`` - добавить к полям по умолчанию связи, которые
+  сериализатор отдает только по запросу (``Meta.expandable_fields``).
+
+Набор полей определяет и выборку: ``apply`` загружает только столбцы,
+нужные полям ответа (``only()``), и делает ``prefetch_related`` только для
+выводимых связей, поэтому большие текстовые столбцы (``description``,
+``content``) не читаются, если их не запросили.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import BaseSerializer, ListSerializer
+
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+QUERY_PARAMS = (FIELDS_PARAM, EXPAND_PARAM)
+
+
+def parse_paths(param, values):
+    """``['id,tabs.title', 'tabs.id']`` -> ``{'id': {}, 'tabs': {'title': {}, 'id': {}}}``"""
+    tree = {}
+    for raw in values:
+        for path in raw.split(','):
+            path = path.strip()
+            if not path:
+                continue
+            node = tree
+            for name in path.split('.'):
+                if not name:
+                    raise ValidationError({param: f'Некорректное поле: {path}'})
+                node = node.setdefault(name, {})
+    return tree
+
+
+class Fieldset:
+    """Выбранные поля одного уровня ответа
+
+    ``fields`` - дерево запрошенных полей или ``None`` (поля по умолчанию),
+    ``expand`` - дерево раскрываемых связей.
+    """
+
+    def __init__(self, fields=None, expand=None):
+        self.fields = fields
+        self.expand = expand or {}
+
+    @classmethod
+    def from_request(cls, request):
+        params = request.query_params
+        fields = None
+        if FIELDS_PARAM in params:
+            fields = parse_paths(FIELDS_PARAM, params.getlist(FIELDS_PARAM))
+        return cls(fields, parse_paths(EXPAND_PARAM, params.getlist(EXPAND_PARAM)))
+
+    def nested(self, name):
+        """Поля вложенного объекта ``name`` (пустое поддерево - все поля)"""
+        fields = self.fields.get(name) if self.fields is not None else None
+        return Fieldset(fields or None, self.expand.get(name))
+
+    def resolve(self, path):
+        fieldset = self
+        for name in path:
+            fieldset = fieldset.nested(name)
+        return fieldset
+
+    def select(self, fields, expandable=()):
+        """Оставить из полей сериализатора ``fields`` только выбранные"""
+        unknown = sorted(set(self.expand) - set(expandable))
+        if unknown:
+            raise ValidationError(
+                {EXPAND_PARAM: f"Нельзя раскрыть: {', '.join(unknown)}"}
+            )
+        if self.fields is None:
+            return {
+                name: field for name, field in fields.items()
+                if name not in expandable or name in self.expand
+            }
+
+        unknown = sorted(set(self.fields) - set(fields))
+        if unknown:
+            raise ValidationError(
+                {FIELDS_PARAM: f"Неизвестные поля: {', '.join(unknown)}"}
+            )
+        for name, subtree in self.fields.items():
+            if subtree and not isinstance(fields[name], BaseSerializer):
+                raise ValidationError(
+                    {FIELDS_PARAM: f'Поле {name} не содержит вложенных полей'}
+                )
+        return {
+            name: field for name, field in fields.items()
+            if name in self.fields or name in self.expand
+        }
+
+
+def get_field_path(serializer):
+    """Путь вложенного сериализатора от корня ответа: ``['tabs']``"""
+    path = []
+    while serializer.parent is not None:
+        if serializer.field_name:
+            path.append(serializer.field_name)
+        serializer = serializer.parent
+    return path[::-1]
+
+
+class SparseFieldsetMixin:
+    """Сериализатор с полями из ``context['fieldset']``
+
+    Поля из ``Meta.expandable_fields`` выводятся только по ``?expand=``
+    или при явном указании в ``?fields=``. ``Meta.field_sources`` задает
+    столбцы модели для полей, которые не отображаются на поле модели
+    напрямую (методы и свойства): ``{'in_stock': ('quantity',)}``.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        expandable = getattr(self.Meta, 'expandable_fields', ())
+        fieldset = self.context.get('fieldset')
+        if fieldset is None:
+            return {
+                name: field for name, field in fields.items()
+                if name not in expandable
+            }
+        return fieldset.resolve(get_field_path(self)).select(fields, expandable)
+
+
+def add_source(model, source, columns, relations, child=None):
+    """Учесть источник поля; ``False``, если он не является полем модели"""
+    parts = source.split('.')
+    try:
+        model_field = model._meta.get_field(parts[0])
+    except FieldDoesNotExist:
+        return False
+    if model_field.many_to_many or model_field.one_to_many:
+        relations[parts[0]] = child
+    else:
+        columns.add(parts[0])
+        if len(parts) > 1:
+            columns.add('__'.join(parts))
+    return True
+
+
+def get_requirements(serializer):
+    """Столбцы и связи модели, нужные полям сериализатора
+
+    Возвращает ``(columns, relations)``, где ``relations`` -
+    ``{связь: вложенный сериализатор или None}``. Если источник какого-то
+    поля неизвестен, ``columns`` - ``None`` (столбцы не ограничиваются).
+    """
+    model = serializer.Meta.model
+    sources = getattr(serializer.Meta, 'field_sources', {})
+    columns = {model._meta.pk.name}
+    relations = {}
+    for name, field in serializer.fields.items():
+        if name in sources:
+            known = all(
+                add_source(model, source, columns, relations)
+                for source in sources[name]
+            )
+        else:
+            child = field.child if isinstance(field, ListSerializer) else None
+            known = field.source != '*' and add_source(
+                model, field.source, columns, relations, child
+            )
+        if not known:
+            return None, relations
+    return columns, relations
+
+
+def build_prefetch(model, name, serializer=None):
+    """``Prefetch`` связи ``name`` только со столбцами полей ответа"""
+    relation = model._meta.get_field(name)
+    related_model = relation.related_model
+    queryset = related_model._default_manager.all()
+    if serializer is None:
+        # Выводятся только id (PrimaryKeyRelatedField)
+        return Prefetch(name, queryset=queryset.only(related_model._meta.pk.name))
+
+    columns, relations = get_requirements(serializer)
+    if columns is not None:
+        if relation.one_to_many:
+            # По внешнему ключу объекты раскладываются по владельцам
+            columns.add(relation.field.name)
+        queryset = queryset.only(*columns)
+    for nested_name, child in relations.items():
+        queryset = queryset.prefetch_related(
+            build_prefetch(related_model, nested_name, child)
+        )
+    return Prefetch(name, queryset=queryset)
+
+
+def apply(queryset, serializer, keep=()):
+    """Ограничить выборку столбцами и связями полей ``serializer``
+
+    ``keep`` - столбцы, которые нужны представлению помимо полей ответа
+    (например, поля курсора пагинации). ``select_related`` выставляется
+    заново: только для связей, поля которых попали в ответ.
+    """
+    columns, relations = get_requirements(serializer)
+    if columns is not None:
+        joined = {column.split('__')[0] for column in columns if '__' in column}
+        queryset = queryset.select_related(None)
+        if joined:
+            queryset = queryset.select_related(*joined)
+        queryset = queryset.only(*columns, *keep)
+    for name, child in relations.items():
+        queryset = queryset.prefetch_related(
+            build_prefetch(queryset.model, name, child)
+        )
+    return queryset
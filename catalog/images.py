@@ -0,0 +1,179 @@
+"""
+Производные изображения фото товаров (миниатюра, карточка, зум).
+
+Уменьшенные копии в WebP и JPEG строятся Pillow в пуле процессов вне
+обработки запроса: после коммита сохранения фото задача отправляется
+в пул, а результат записывается в ``ProductPhoto.derivatives``
+(до этого там лежит ``{'pending': имя оригинала}``).
+Файлы кладутся рядом с оригиналом: ``products/photo__card.webp``.
+
+При ``CATALOG_IMAGE_WORKERS = 0`` производные строятся синхронно
+(удобно для разработки и тестов).
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+
+from . import caching
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_SIZES = {
+    'thumbnail': (200, 200),
+    'card': (600, 600),
+    'zoom': (1600, 1600),
+}
+
+DERIVATIVE_FORMATS = {
+    'webp': 'WEBP',
+    'jpeg': 'JPEG',
+}
+
+QUALITY = 85
+
+
+def derivative_name(name, size, extension):
+    stem = os.path.splitext(name)[0]
+    return f'{stem}__{size}.{extension}'
+
+
+def render_derivatives(name):
+    """Построить и сохранить все производные оригинала ``name``
+
+    Выполняется в процессе пула, к БД не обращается. Возвращает
+    ``{'source': name, 'sizes': {'card': {'webp': путь, ...}, ...}}``.
+    """
+    from PIL import Image, ImageOps
+
+    with default_storage.open(name, 'rb') as fileobj:
+        image = Image.open(fileobj)
+        image.load()
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    sizes = {}
+    for size, bounds in DERIVATIVE_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail(bounds, Image.Resampling.LANCZOS)
+        sizes[size] = {}
+        for extension, image_format in DERIVATIVE_FORMATS.items():
+            output = resized
+            if image_format == 'JPEG' and output.mode != 'RGB':
+                output = output.convert('RGB')
+            buffer = BytesIO()
+            output.save(buffer, format=image_format, quality=QUALITY)
+            path = derivative_name(name, size, extension)
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            sizes[size][extension] = default_storage.save(
+                path, ContentFile(buffer.getvalue())
+            )
+    return {'source': name, 'sizes': sizes}
+
+
+def delete_derivatives(derivatives):
+    for formats in derivatives.get('sizes', {}).values():
+        for path in formats.values():
+            default_storage.delete(path)
+
+
+def store_derivatives(photo_id, name, derivatives):
+    """Записать результат, если за это время фото не заменили"""
+    from .models import Product, ProductPhoto
+
+    updated = ProductPhoto.objects.filter(pk=photo_id, image=name).update(
+        derivatives=derivatives
+    )
+    if updated:
+        Product.touch(
+            ProductPhoto.objects.filter(pk=photo_id).values_list(
+                'product_id', flat=True
+            )
+        )
+        caching.invalidate()
+    else:
+        delete_derivatives(derivatives)
+
+
+def forget_pending(photo_id, name):
+    """Снять отметку о построении, чтобы следующее сохранение фото повторило его"""
+    from .models import ProductPhoto
+
+    ProductPhoto.objects.filter(
+        pk=photo_id, image=name, derivatives__pending=name
+    ).update(derivatives={})
+
+
+def _setup_worker():
+    import django
+    django.setup()
+
+
+class DerivativePipeline:
+    """Ленивый пул процессов для построения производных"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=get_context('spawn'),
+                    initializer=_setup_worker,
+                )
+            return self.executor
+
+    def schedule(self, photo_id, name):
+        """Поставить построение производных в очередь после коммита"""
+        transaction.on_commit(lambda: self.submit(photo_id, name))
+
+    def submit(self, photo_id, name):
+        if not self.workers:
+            try:
+                store_derivatives(photo_id, name, render_derivatives(name))
+            except Exception:
+                forget_pending(photo_id, name)
+                raise
+            return
+        future = self.get_executor().submit(render_derivatives, name)
+        future.add_done_callback(
+            lambda done: self.on_done(photo_id, name, done)
+        )
+
+    @staticmethod
+    def on_done(photo_id, name, future):
+        # Колбэк выполняется в служебном потоке пула со своим соединением
+        try:
+            store_derivatives(photo_id, name, future.result())
+        except Exception:
+            logger.exception('Не удалось построить производные фото %s', photo_id)
+            forget_pending(photo_id, name)
+        finally:
+            connection.close()
+
+
+pipeline = DerivativePipeline(getattr(settings, 'CATALOG_IMAGE_WORKERS', 2))
+
+
+def build_srcset(derivatives, build_url):
+    """Карта URL производных: ``{'card': {'webp': url, 'jpeg': url}, ...}``"""
+    return {
+        size: {
+            extension: build_url(default_storage.url(path))
+            for extension, path in formats.items()
+        }
+        for size, formats in derivatives.get('sizes', {}).items()
+    }
@@ -0,0 +1,340 @@
+"""
+Потоковый импорт товаров из CSV и JSONL.
+
+Файл читается построчно и обрабатывается пакетами по ``batch_size``
+строк: каждая строка проверяется по правилам ``ProductSerializer``,
+после чего пакет записывается через ``bulk_create``/``bulk_update``
+в одной транзакции. Товары с уже существующим ``external_id``
+обновляются (upsert), ошибки строк накапливаются в отчете и не
+прерывают импорт. Память ограничена размером пакета и количеством
+сохраняемых ошибок, а не размером файла.
+
+Колонки: ``external_id``, ``name``, ``description``, ``price``,
+``old_price``, ``quantity``, ``is_active``, ``filter_values`` (id через
+запятую или список в JSONL) и одна из ``category`` (id),
+``category_name`` или ``category_path`` (названия через ``/``).
+"""
+import codecs
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import caching
+from .models import Category, FilterValue, Product
+from .search import update_search_vectors
+from .serializers import ProductImportSerializer
+
+FORMATS = ('csv', 'jsonl')
+
+
+def detect_format(filename):
+    """Формат файла по расширению (``None``, если не распознан)"""
+    extension = filename.rsplit('.', 1)[-1].lower() if filename else ''
+    if extension == 'ndjson':
+        return 'jsonl'
+    return extension if extension in FORMATS else None
+
+
+def read_rows(fileobj, file_format):
+    """Последовательно отдать ``(номер строки, запись)`` из бинарного файла"""
+    lines = codecs.iterdecode(fileobj, 'utf-8-sig')
+    if file_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if not isinstance(row, dict):
+            row = {'__error__': 'Строка не является JSON-объектом'}
+        yield line_number, row
+
+
+class ImportResult:
+    """Итоги импорта с ограниченным списком ошибок"""
+    max_errors = 1000
+
+    def __init__(self):
+        self.processed = 0
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line, errors):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'processed': self.processed,
+            'created': self.created,
+            'updated': self.updated,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+
+class CategoryResolver:
+    """Поиск категории строки по id, названию или пути из названий"""
+
+    def __init__(self):
+        self.ids = set()
+        self.by_name = {}
+        for pk, name in Category.objects.values_list('id', 'name'):
+            self.ids.add(pk)
+            self.by_name.setdefault(name, []).append(pk)
+        # Путь из названий не уникален: у одного родителя могут быть
+        # одноименные подкатегории
+        self.by_path = {}
+        for pk, path in Category.build_name_paths().items():
+            self.by_path.setdefault(path, []).append(pk)
+
+    @staticmethod
+    def choose(matches, ambiguous_error):
+        if len(matches) == 1:
+            return matches[0], None
+        if matches:
+            return None, ambiguous_error
+        return None, 'Категория не найдена'
+
+    def resolve(self, row):
+        """Вернуть ``(id категории, ошибка)``; ``(None, None)`` - не указана"""
+        if 'category' in row:
+            value = str(row['category'])
+            if value.isdigit() and int(value) in self.ids:
+                return int(value), None
+            return None, 'Категория не найдена'
+        if 'category_path' in row:
+            path = Category.PATH_SEPARATOR.join(
+                part.strip()
+                for part in str(row['category_path']).split(
+                    Category.PATH_SEPARATOR
+                )
+            )
+            return self.choose(
+                self.by_path.get(path, []),
+                'Несколько категорий с таким путем, укажите category',
+            )
+        if 'category_name' in row:
+            return self.choose(
+                self.by_name.get(str(row['category_name']).strip(), []),
+                'Несколько категорий с таким названием, укажите category_path',
+            )
+        return None, None
+
+
+class ProductImporter:
+    """Пакетный upsert товаров по ``external_id``"""
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.categories = CategoryResolver()
+        self.result = ImportResult()
+
+    def import_file(self, fileobj, file_format):
+        return self.import_rows(read_rows(fileobj, file_format))
+
+    def import_rows(self, rows):
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.batch_size))
+            if not chunk:
+                break
+            self.process_chunk(chunk)
+        return self.result
+
+    @staticmethod
+    def normalize(row):
+        data = {}
+        for key, value in row.items():
+            if key is None:
+                continue
+            key = key.strip()
+            if isinstance(value, str):
+                value = value.strip()
+                if value == '':
+                    if key != 'old_price':
+                        continue
+                    value = None
+            data[key] = value
+        return data
+
+    @staticmethod
+    def parse_filter_values(value):
+        if isinstance(value, str):
+            value = [
+                part for part in value.replace(';', ',').split(',')
+                if part.strip()
+            ]
+        if not isinstance(value, list):
+            raise ValueError
+        return {int(str(part).strip()) for part in value}
+
+    def process_chunk(self, chunk):
+        """Проверить и записать один пакет строк; True, если что-то записано"""
+        self.result.processed += len(chunk)
+        parsed = []
+        external_ids = set()
+        value_ids = set()
+        for line, row in chunk:
+            if '__error__' in row:
+                self.result.add_error(line, {'non_field_errors': [row['__error__']]})
+                continue
+            data = self.normalize(row)
+            filter_values = None
+            if 'filter_values' in data:
+                try:
+                    filter_values = self.parse_filter_values(
+                        data.pop('filter_values')
+                    )
+                except (TypeError, ValueError):
+                    self.result.add_error(
+                        line, {'filter_values': ['Ожидается список id']}
+                    )
+                    continue
+                value_ids |= filter_values
+            if data.get('external_id'):
+                data['external_id'] = str(data['external_id'])
+                external_ids.add(data['external_id'])
+            parsed.append((line, data, filter_values))
+
+        by_key = Product.objects.filter(
+            external_id__in=external_ids
+        ).in_bulk(field_name='external_id')
+        known_values = set(
+            FilterValue.objects.filter(pk__in=value_ids).values_list('id', flat=True)
+        )
+
+        creates = []
+        updates = {}
+        update_fields = set()
+        links = {}
+        # Состояние товаров до пакета: (category_id, is_active) по pk
+        originals = {}
+        # Строки, попавшие в запись (для ошибки всей транзакции)
+        written_lines = []
+        for line, data, filter_values in parsed:
+            instance = by_key.get(data.get('external_id'))
+            errors = {}
+            category_id, category_error = self.categories.resolve(data)
+            if category_error:
+                errors['category'] = [category_error]
+            elif category_id is None and instance is None:
+                errors['category'] = ['Обязательное поле.']
+            if filter_values and not filter_values <= known_values:
+                missing = sorted(filter_values - known_values)
+                errors['filter_values'] = [
+                    f'Значения фильтров не найдены: {missing}'
+                ]
+
+            serializer = ProductImportSerializer(
+                instance, data=data, partial=instance is not None
+            )
+            if not serializer.is_valid():
+                errors.update(serializer.errors)
+            if errors:
+                self.result.add_error(line, errors)
+                continue
+
+            values = serializer.validated_data
+            if category_id is not None:
+                values['category_id'] = category_id
+            if instance is None:
+                instance = Product(**values)
+                creates.append(instance)
+                if instance.external_id:
+                    by_key[instance.external_id] = instance
+            else:
+                if instance.pk:
+                    originals.setdefault(
+                        instance.pk, (instance.category_id, instance.is_active)
+                    )
+                for field, value in values.items():
+                    setattr(instance, field, value)
+                if instance.pk:
+                    updates[instance.pk] = instance
+                    update_fields.update(values)
+            if filter_values is not None:
+                links[id(instance)] = (instance, filter_values)
+            written_lines.append(line)
+
+        if not creates and not updates:
+            return False
+        try:
+            with transaction.atomic():
+                self.write(
+                    creates, list(updates.values()), update_fields, links,
+                    originals,
+                )
+        except IntegrityError as exc:
+            for line in written_lines:
+                self.result.add_error(line, {'non_field_errors': [str(exc)]})
+            return False
+        self.result.created += len(creates)
+        self.result.updated += len(updates)
+        return True
+
+    def write(self, creates, updates, update_fields, links, originals):
+        Product.objects.bulk_create(creates, batch_size=self.batch_size)
+        if updates:
+            now = timezone.now()
+            for instance in updates:
+                instance.updated_at = now
+            Product.objects.bulk_update(
+                updates,
+                sorted(update_fields | {'updated_at'}),
+                batch_size=self.batch_size,
+            )
+        update_search_vectors(Product.objects.filter(
+            pk__in=[instance.pk for instance in creates + updates]
+        ))
+        if links:
+            through = Product.filter_values.through
+            through.objects.filter(
+                product_id__in=[instance.pk for instance, _ in links.values()]
+            ).delete()
+            through.objects.bulk_create(
+                [
+                    through(product_id=instance.pk, filtervalue_id=value_id)
+                    for instance, value_ids in links.values()
+                    for value_id in value_ids
+                ],
+                batch_size=self.batch_size,
+                ignore_conflicts=True,
+            )
+
+        # bulk-операции обходят сигналы: счетчики категорий меняются на
+        # дельты, фасетные индексы затронутых категорий сбрасываются
+        counters = defaultdict(lambda: [0, 0])
+        touched_facets = {instance.category_id for instance, _ in links.values()}
+        for instance in creates:
+            counters[instance.category_id][0] += 1
+            counters[instance.category_id][1] += int(instance.is_active)
+        for instance in updates:
+            old = originals[instance.pk]
+            if old != (instance.category_id, instance.is_active):
+                touched_facets.update((old[0], instance.category_id))
+                counters[old[0]][0] -= 1
+                counters[old[0]][1] -= int(old[1])
+                counters[instance.category_id][0] += 1
+                counters[instance.category_id][1] += int(instance.is_active)
+        for category_id, (products, active) in counters.items():
+            Category.adjust_product_counters(
+                category_id, products=products, active=active
+            )
+        if touched_facets:
+            Category.bump_facet_version(touched_facets)
+        caching.invalidate()
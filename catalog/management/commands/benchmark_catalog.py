@@ -0,0 +1,194 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from catalog.benchmark import (
+    BenchmarkError, BenchmarkRunner, CompressionRunner, LoadRunner, compare
+)
+
+
+class Command(BaseCommand):
+    help = 'Замер времени ответа, SQL-запросов и памяти маршрутов каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20,
+            help='Количество замеренных вызовов каждого маршрута'
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=2,
+            help='Количество вызовов для прогрева перед замером'
+        )
+        parser.add_argument(
+            '--route',
+            action='append',
+            help='Замерить только маршрут с этим именем (можно несколько раз)'
+        )
+        parser.add_argument(
+            '--include-writes',
+            action='store_true',
+            help='Замерить и записывающие маршруты (с откатом транзакции)'
+        )
+        parser.add_argument(
+            '--with-cache',
+            action='store_true',
+            help='Не отключать кэш ответов'
+        )
+        parser.add_argument(
+            '--host',
+            help='Значение заголовка Host (по умолчанию из ALLOWED_HOSTS)'
+        )
+        parser.add_argument(
+            '--url',
+            help='Адрес запущенного сервера: нагрузочный прогон маршрутов '
+                 'чтения по HTTP вместо замера в процессе'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=50,
+            help='Количество одновременных клиентов при нагрузочном прогоне'
+        )
+        parser.add_argument(
+            '--duration',
+            type=int,
+            default=10,
+            help='Длительность нагрузки на каждый маршрут, секунд'
+        )
+        parser.add_argument(
+            '--compression',
+            action='store_true',
+            help='Замерить время сжатия ответов gzip/brotli и размер '
+                 'результата вместо времени ответа'
+        )
+        parser.add_argument(
+            '--output',
+            help='Сохранить результат в JSON-файл'
+        )
+        parser.add_argument(
+            '--compare',
+            help='JSON-файл предыдущего прогона для сравнения'
+        )
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations должно быть больше нуля')
+
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as fileobj:
+                    baseline = json.load(fileobj)
+            except (OSError, ValueError) as exc:
+                raise CommandError(str(exc))
+
+        common = {
+            'warmup': options['warmup'],
+            'host': options['host'],
+            'log': lambda message: self.stderr.write(message),
+        }
+        if options['compression']:
+            if options['url'] or options['include_writes']:
+                raise CommandError(
+                    '--compression не сочетается с --url и --include-writes'
+                )
+            runner = CompressionRunner(
+                iterations=options['iterations'], **common
+            )
+        elif options['url']:
+            if options['include_writes']:
+                raise CommandError(
+                    'Нагрузочный прогон выполняется только для маршрутов чтения'
+                )
+            if options['concurrency'] < 1 or options['duration'] < 1:
+                raise CommandError(
+                    '--concurrency и --duration должны быть больше нуля'
+                )
+            runner = LoadRunner(
+                options['url'],
+                concurrency=options['concurrency'],
+                duration=options['duration'],
+                **common
+            )
+        else:
+            runner = BenchmarkRunner(
+                iterations=options['iterations'],
+                include_writes=options['include_writes'],
+                use_cache=options['with_cache'],
+                **common
+            )
+        try:
+            result = runner.run(only=options['route'])
+        except BenchmarkError as exc:
+            raise CommandError(str(exc))
+
+        if options['compression']:
+            self.write_compression(result)
+        elif options['url']:
+            self.write_load(result)
+        else:
+            self.write_latency(result)
+
+        if baseline is not None:
+            self.stdout.write('')
+            self.stdout.write(
+                f"Сравнение с {baseline.get('meta', {}).get('revision')}:"
+            )
+            for name, metric, before, after, change in compare(baseline, result):
+                change = f'{change:+.1f}%' if change is not None else '-'
+                self.stdout.write(
+                    f'{name:<36} {metric:<15} {before:>10} -> {after:<10} {change}'
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as fileobj:
+                json.dump(result, fileobj, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(
+                f"Результат сохранен в {options['output']}"
+            ))
+
+    def write_latency(self, result):
+        self.stdout.write(
+            f"{'маршрут':<36} {'код':>4} {'p50':>9} {'p95':>9} {'p99':>9} "
+            f"{'SQL':>6} {'память КБ':>10}"
+        )
+        for name, route in result['routes'].items():
+            self.stdout.write(
+                f"{name:<36} {route['status']:>4} {route['p50_ms']:>9.2f} "
+                f"{route['p95_ms']:>9.2f} {route['p99_ms']:>9.2f} "
+                f"{route['queries']:>6} {route['peak_memory_kb']:>10}"
+            )
+
+    def write_compression(self, result):
+        self.stdout.write(
+            f"{'маршрут':<36} {'байт':>8} {'сжатие':<8} {'байт':>8} "
+            f"{'доля':>6} {'p50':>9} {'p95':>9}"
+        )
+        for name, route in result['routes'].items():
+            for encoding, item in route['encodings'].items():
+                self.stdout.write(
+                    f"{name:<36} {route['bytes']:>8} {encoding:<8} "
+                    f"{item['bytes']:>8} {item['ratio']:>6.3f} "
+                    f"{item['p50_ms']:>9.3f} {item['p95_ms']:>9.3f}"
+                )
+
+    def write_load(self, result):
+        self.stdout.write(
+            f"{'маршрут':<36} {'код':>4} {'запр/с':>9} {'ошибок':>7} "
+            f"{'p50':>9} {'p95':>9} {'p99':>9}"
+        )
+        for name, route in result['routes'].items():
+            if not route['requests']:
+                self.stdout.write(f'{name:<36} нет ответов')
+                continue
+            # Код - самый частый ответ; None, если ни на один запрос
+            # сервер не ответил (обрыв соединения, таймаут)
+            status = route['status'] or '-'
+            self.stdout.write(
+                f"{name:<36} {status:>4} {route['rps']:>9.1f} "
+                f"{route['errors']:>7} {route['p50_ms']:>9.2f} "
+                f"{route['p95_ms']:>9.2f} {route['p99_ms']:>9.2f}"
+            )
@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from catalog.importers import FORMATS, ProductImporter, detect_format
+
+
+class Command(BaseCommand):
+    help = 'Импорт товаров из CSV/JSONL с upsert по external_id'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу CSV или JSONL')
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            help='Формат файла (по умолчанию определяется по расширению)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Количество строк в одном пакете записи'
+        )
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or detect_format(options['path'])
+        if file_format is None:
+            raise CommandError('Не удалось определить формат, укажите --format')
+
+        importer = ProductImporter(batch_size=options['batch_size'])
+        try:
+            with open(options['path'], 'rb') as fileobj:
+                result = importer.import_file(fileobj, file_format)
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        for error in result.errors:
+            self.stderr.write(
+                f"Строка {error['line']}: "
+                f"{json.dumps(error['errors'], ensure_ascii=False)}"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано: {result.processed}, создано: {result.created}, '
+            f'обновлено: {result.updated}, ошибок: {result.error_count}'
+        ))
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from catalog.uploads import purge
+
+
+class Command(BaseCommand):
+    help = 'Удалить незавершенные загрузки фото и их файлы'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=int,
+            default=24,
+            help='Удалять загрузки, не получавшие частей дольше этого количества часов'
+        )
+
+    def handle(self, *args, **options):
+        count = purge(timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено загрузок: {count}'
+        ))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from catalog.models import Category
+
+
+class Command(BaseCommand):
+    help = 'Пересчитать денормализованные счетчики товаров и подкатегорий'
+
+    def handle(self, *args, **options):
+        updated = Category.rebuild_counters()
+        self.stdout.write(self.style.SUCCESS(
+            f'Счетчики пересчитаны для {updated} категорий'
+        ))
@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing import get_context
+
+from django.core.management.base import BaseCommand
+from catalog.images import render_derivatives, store_derivatives, _setup_worker
+from catalog.models import ProductPhoto
+
+# Задач в работе на один процесс: очередь пула не пустеет, а память
+# не зависит от количества фото
+TASKS_PER_WORKER = 4
+
+
+class Command(BaseCommand):
+    help = 'Пересоздать уменьшенные копии фото товаров в несколько процессов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Количество процессов Pillow'
+        )
+        parser.add_argument(
+            '--missing-only',
+            action='store_true',
+            help='Только фото, для которых копии еще не построены'
+        )
+
+    def handle(self, *args, **options):
+        photos = ProductPhoto.objects.exclude(image='').order_by('pk')
+        if options['missing_only']:
+            # Без готовых копий, включая зависшие в построении
+            photos = photos.exclude(derivatives__has_key='sizes')
+        rows = photos.values_list('pk', 'image').iterator(chunk_size=1000)
+
+        done = failed = 0
+        window = options['workers'] * TASKS_PER_WORKER
+        with ProcessPoolExecutor(
+            max_workers=options['workers'],
+            mp_context=get_context('spawn'),
+            initializer=_setup_worker,
+        ) as executor:
+            futures = {}
+            while True:
+                for pk, name in islice(rows, window - len(futures)):
+                    futures[executor.submit(render_derivatives, name)] = (pk, name)
+                if not futures:
+                    break
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    pk, name = futures.pop(future)
+                    try:
+                        store_derivatives(pk, name, future.result())
+                        done += 1
+                    except Exception as exc:
+                        failed += 1
+                        self.stderr.write(f'Фото {pk}: {exc}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано фото: {done}, ошибок: {failed}'
+        ))
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from catalog.seeding import SCALES, CatalogSeeder
+
+
+class Command(BaseCommand):
+    help = 'Генерация синтетического каталога для нагрузочных замеров'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale',
+            choices=SCALES,
+            default='small',
+            help='Набор размеров каталога (по умолчанию small)'
+        )
+        for name, help_text in (
+            ('depth', 'Глубина дерева категорий'),
+            ('branching', 'Количество подкатегорий у каждой категории'),
+            ('filters', 'Количество фильтров у листовой категории'),
+            ('values', 'Количество значений у фильтра'),
+            ('products', 'Количество товаров'),
+            ('photos', 'Количество фото у товара'),
+            ('tabs', 'Количество вкладок у товара'),
+        ):
+            parser.add_argument(f'--{name}', type=int, help=help_text)
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Зерно генератора случайных чисел'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Количество товаров в одном пакете записи'
+        )
+        parser.add_argument(
+            '--clear',
+            action='store_true',
+            help='Удалить существующий каталог перед генерацией'
+        )
+
+    def handle(self, *args, **options):
+        params = dict(SCALES[options['scale']])
+        for name in params:
+            if options[name] is not None:
+                if options[name] < 0:
+                    raise CommandError(f'--{name} не может быть отрицательным')
+                params[name] = options[name]
+        if params['depth'] < 1 or params['branching'] < 1:
+            raise CommandError('Нужна хотя бы одна категория')
+
+        if options['clear']:
+            CatalogSeeder.clear()
+            self.stdout.write('Каталог очищен')
+
+        seeder = CatalogSeeder(
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+            log=self.stdout.write,
+            **params
+        )
+        seeder.run()
+        self.stdout.write(self.style.SUCCESS(
+            'Каталог сгенерирован: '
+            + ', '.join(f'{name}={value}' for name, value in params.items())
+        ))
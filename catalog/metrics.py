@@ -0,0 +1,436 @@
+"""
+Метрики производительности запросов в формате Prometheus.
+
+Каждый воркер копит гистограммы в памяти (фиксированные корзины, одна
+операция сложения на наблюдение). Если задан ``CATALOG_METRICS_DIR``,
+воркер не чаще раза в ``CATALOG_METRICS_FLUSH_INTERVAL`` секунд
+сбрасывает свой снимок в ``<dir>/<pid>.json``, а ``/metrics`` любого
+воркера складывает снимки всех процессов - так под gunicorn с
+несколькими воркерами отдаются общие значения. Без каталога метрики
+отражают только обработавший запрос процесс.
+
+Снимки называются ``<хост>-<pid>.json``. Счетчики и гистограммы
+процесса, завершившегося на этом хосте (перезапуск воркера gunicorn),
+при сборе переносятся в ``archive.json`` и продолжают суммироваться, как
+в multiprocess-режиме ``prometheus_client``: иначе после перезапуска
+счетчики уменьшились бы, и ``rate()`` увидел бы сброс. Текущие значения
+пула (gauges) завершившегося процесса отбрасываются. Жив ли процесс,
+проверяется только для снимков своего хоста: pid другого контейнера или
+хоста из этого пространства pid не виден, такие снимки не удаляются. У
+снимка, не обновлявшегося дольше ``STALE_FLUSHES`` интервалов (воркер
+простаивает, контейнер остановлен), учитываются только счетчики.
+
+Кроме корзин гистограмм (для ``histogram_quantile``) отдаются оценки
+p50/p95/p99 по маршруту, посчитанные интерполяцией внутри корзины.
+
+При ``DB_POOL=True`` в снимок попадает статистика пула соединений psycopg
+(занятые и свободные соединения, ожидание соединения, потерянные
+соединения); значения процессов суммируются.
+"""
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connections
+
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Через сколько интервалов сброса показатели пула в снимке считаются устаревшими
+STALE_FLUSHES = 3
+
+# Счетчики завершившихся процессов
+ARCHIVE_NAME = 'archive.json'
+
+HISTOGRAMS = {
+    'duration': ('catalog_request_duration_seconds', 'Полное время ответа'),
+    'db': ('catalog_request_db_seconds', 'Время SQL-запросов'),
+    'render': ('catalog_request_render_seconds', 'Время сериализации ответа'),
+}
+COUNTERS = {
+    'queries': ('catalog_request_db_queries_total', 'Количество SQL-запросов'),
+}
+
+# Статистика psycopg_pool.ConnectionPool.get_stats()
+POOL_GAUGES = {
+    'pool_max': ('catalog_db_pool_max_size', 'Максимальный размер пула'),
+    'pool_size': ('catalog_db_pool_size', 'Открытые соединения пула'),
+    'pool_available': ('catalog_db_pool_available', 'Свободные соединения пула'),
+    'in_use': ('catalog_db_pool_in_use', 'Занятые соединения пула'),
+    'requests_waiting': (
+        'catalog_db_pool_requests_waiting', 'Запросы, ждущие свободное соединение'
+    ),
+}
+POOL_COUNTERS = {
+    'requests_num': ('catalog_db_pool_requests_total', 'Выдано соединений из пула'),
+    'requests_queued': (
+        'catalog_db_pool_requests_queued_total', 'Выдачи с ожиданием соединения'
+    ),
+    'requests_errors': (
+        'catalog_db_pool_requests_errors_total',
+        'Запросы соединения с ошибкой (истек DB_POOL_TIMEOUT)'
+    ),
+    'requests_wait_ms': (
+        'catalog_db_pool_wait_seconds_total', 'Суммарное ожидание соединения'
+    ),
+    'connections_num': (
+        'catalog_db_pool_connections_total', 'Открыто соединений с БД'
+    ),
+    'connections_errors': (
+        'catalog_db_pool_connections_errors_total', 'Ошибки подключения к БД'
+    ),
+    'connections_lost': (
+        'catalog_db_pool_connections_lost_total',
+        'Соединения, не прошедшие проверку перед выдачей'
+    ),
+}
+
+
+def is_alive(pid):
+    """Существует ли процесс ``pid``"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+
+def pool_stats():
+    """Статистика пулов соединений процесса: ``{alias: {имя: значение}}``"""
+    stats = {}
+    for alias in connections:
+        connection = connections[alias]
+        if not connection.settings_dict['OPTIONS'].get('pool'):
+            continue
+        values = connection.pool.get_stats()
+        item = {
+            name: values.get(name, 0)
+            for name in (*POOL_GAUGES, *POOL_COUNTERS) if name != 'in_use'
+        }
+        item['in_use'] = item['pool_size'] - item['pool_available']
+        stats[alias] = item
+    return stats
+
+
+class Histogram:
+    """Накопительная гистограмма с корзинами ``BUCKETS``"""
+
+    def __init__(self, counts=None, total=0.0):
+        self.counts = list(counts) if counts else [0] * (len(BUCKETS) + 1)
+        self.total = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                if index == len(BUCKETS):
+                    return lower
+                upper = BUCKETS[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return BUCKETS[-1]
+
+    def as_list(self):
+        return [self.counts, self.total]
+
+
+class RouteMetrics:
+    """Метрики одного маршрута (``view_name`` + метод)"""
+
+    def __init__(self):
+        self.histograms = {name: Histogram() for name in HISTOGRAMS}
+        self.counters = {name: 0 for name in COUNTERS}
+        self.statuses = {}
+
+    def merge(self, other):
+        for name, histogram in other.histograms.items():
+            self.histograms[name].merge(histogram)
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for code, value in other.statuses.items():
+            self.statuses[code] = self.statuses.get(code, 0) + value
+
+    def as_dict(self):
+        return {
+            'histograms': {
+                name: histogram.as_list()
+                for name, histogram in self.histograms.items()
+            },
+            'counters': self.counters,
+            'statuses': self.statuses,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        metrics = cls()
+        for name, (counts, total) in data['histograms'].items():
+            if name in metrics.histograms:
+                metrics.histograms[name] = Histogram(counts, total)
+        for name, value in data['counters'].items():
+            if name in metrics.counters:
+                metrics.counters[name] = value
+        metrics.statuses = dict(data['statuses'])
+        return metrics
+
+
+class MetricsRegistry:
+    """Метрики процесса с периодическим сбросом снимка на диск"""
+
+    def __init__(self, directory='', flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.flushed_at = 0.0
+
+    def observe(self, route, method, status, timings, queries):
+        key = (route, method)
+        with self.lock:
+            metrics = self.routes.get(key)
+            if metrics is None:
+                metrics = self.routes[key] = RouteMetrics()
+            for name, value in timings.items():
+                metrics.histograms[name].observe(value)
+            metrics.counters['queries'] += queries
+            code = str(status)
+            metrics.statuses[code] = metrics.statuses.get(code, 0) + 1
+        if self.directory and time.monotonic() - self.flushed_at > self.flush_interval:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            routes = {
+                '\t'.join(key): metrics.as_dict()
+                for key, metrics in self.routes.items()
+            }
+        return {'routes': routes, 'pools': pool_stats()}
+
+    def snapshot_path(self, pid, host=None):
+        return os.path.join(
+            self.directory, f'{host or socket.gethostname()}-{pid}.json'
+        )
+
+    def flush(self):
+        """Записать снимок процесса атомарно (через временный файл)"""
+        self.flushed_at = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.snapshot_path(os.getpid())
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as fileobj:
+            json.dump({**self.snapshot(), 'flushed_at': time.time()}, fileobj)
+        os.replace(temporary, path)
+
+    def archive(self, path):
+        """Перенести счетчики снимка завершившегося процесса в архив
+
+        Выполняется под блокировкой: снимок, который уже перенес другой
+        воркер, не учитывается дважды.
+        """
+        archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+        with open(f'{archive_path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                snapshot = read_json(path)
+            except FileNotFoundError:
+                return
+            except (OSError, ValueError):
+                snapshot = {}
+            try:
+                archived = read_json(archive_path)
+            except (OSError, ValueError):
+                archived = {}
+            routes, pools = merge_snapshots([archived, snapshot])
+            temporary = f'{archive_path}.tmp'
+            with open(temporary, 'w') as fileobj:
+                json.dump(counters_snapshot(routes, pools), fileobj)
+            os.replace(temporary, archive_path)
+            os.remove(path)
+
+    def read_snapshots(self):
+        """Архив и снимки других процессов
+
+        Снимки завершившихся процессов этого хоста переносятся в архив.
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        host = socket.gethostname()
+        stale_before = time.time() - STALE_FLUSHES * self.flush_interval
+        snapshots = []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            snapshot_host, _, pid = stem.rpartition('-')
+            if ext != '.json' or not snapshot_host or not pid.isdigit():
+                continue
+            path = os.path.join(self.directory, name)
+            if snapshot_host == host:
+                if int(pid) == os.getpid():
+                    continue
+                if not is_alive(int(pid)):
+                    self.archive(path)
+                    continue
+            try:
+                snapshot = read_json(path)
+            except (OSError, ValueError):
+                continue
+            if snapshot.get('flushed_at', 0) < stale_before:
+                snapshot = without_gauges(snapshot)
+            snapshots.append(snapshot)
+        try:
+            # Читается после переноса: снимок попадает либо сюда, либо в архив
+            snapshots.append(read_json(os.path.join(self.directory, ARCHIVE_NAME)))
+        except (OSError, ValueError):
+            pass
+        return snapshots
+
+    def collect(self):
+        """Метрики всех процессов: маршруты и пулы соединений
+
+        ``({(route, method): RouteMetrics}, {alias: {имя: значение}})``
+        """
+        return merge_snapshots([self.snapshot(), *self.read_snapshots()])
+
+
+def read_json(path):
+    with open(path) as fileobj:
+        return json.load(fileobj)
+
+
+def without_gauges(snapshot):
+    """Снимок только со счетчиками пула"""
+    return {**snapshot, 'pools': {
+        alias: {
+            name: value for name, value in values.items()
+            if name in POOL_COUNTERS
+        }
+        for alias, values in snapshot.get('pools', {}).items()
+    }}
+
+
+def merge_snapshots(snapshots):
+    """Сложить снимки: ``({(route, method): RouteMetrics}, {alias: {...}})``"""
+    merged = {}
+    pools = {}
+    for snapshot in snapshots:
+        for key, data in snapshot.get('routes', {}).items():
+            key = tuple(key.split('\t'))
+            metrics = RouteMetrics.from_dict(data)
+            if key in merged:
+                merged[key].merge(metrics)
+            else:
+                merged[key] = metrics
+        for alias, values in snapshot.get('pools', {}).items():
+            totals = pools.setdefault(alias, {})
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0) + value
+    return merged, pools
+
+
+def counters_snapshot(routes, pools):
+    """Снимок архива из сложенных метрик, без gauges пула"""
+    return without_gauges({
+        'routes': {
+            '\t'.join(key): metrics.as_dict() for key, metrics in routes.items()
+        },
+        'pools': pools,
+    })
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(routes, pools=None):
+    """Текстовый формат экспозиции Prometheus 0.0.4"""
+    lines = []
+    items = sorted(routes.items())
+
+    lines.append('# HELP catalog_requests_total Количество запросов')
+    lines.append('# TYPE catalog_requests_total counter')
+    for (route, method), metrics in items:
+        for code, value in sorted(metrics.statuses.items()):
+            lines.append(
+                f'catalog_requests_total{{route="{escape(route)}",'
+                f'method="{method}",status="{code}"}} {value}'
+            )
+
+    for name, (metric, description) in COUNTERS.items():
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} counter')
+        for (route, method), metrics in items:
+            lines.append(
+                f'{metric}{{route="{escape(route)}",method="{method}"}} '
+                f'{metrics.counters[name]}'
+            )
+
+    for name, (metric, description) in HISTOGRAMS.items():
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} histogram')
+        for (route, method), metrics in items:
+            labels = f'route="{escape(route)}",method="{method}"'
+            histogram = metrics.histograms[name]
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{{labels}}} {histogram.total:.6f}')
+            lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+
+    metric = 'catalog_request_duration_seconds_quantile'
+    lines.append(f'# HELP {metric} Оценка квантилей времени ответа по корзинам')
+    lines.append(f'# TYPE {metric} gauge')
+    for (route, method), metrics in items:
+        histogram = metrics.histograms['duration']
+        for q in QUANTILES:
+            value = histogram.quantile(q)
+            if value is not None:
+                lines.append(
+                    f'{metric}{{route="{escape(route)}",method="{method}",'
+                    f'quantile="{q}"}} {value:.6f}'
+                )
+
+    pools = sorted((pools or {}).items())
+    kinds = (('gauge', POOL_GAUGES), ('counter', POOL_COUNTERS)) if pools else ()
+    for kind, metrics in kinds:
+        for name, (metric, description) in metrics.items():
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for alias, values in pools:
+                value = values.get(name, 0)
+                if name == 'requests_wait_ms':
+                    value = f'{value / 1000:.3f}'
+                lines.append(f'{metric}{{db="{escape(alias)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry(
+    settings.CATALOG_METRICS_DIR, settings.CATALOG_METRICS_FLUSH_INTERVAL
+)
@@ -0,0 +1,161 @@
+import heapq
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from .metrics import registry
+
+logger = logging.getLogger('catalog.performance')
+
+SLOWEST_QUERIES = 3
+
+# Регистратор текущего запроса для выборок в потоках пула (catalog.async_db)
+current_recorder = ContextVar('catalog_query_recorder', default=None)
+
+
+class QueryRecorder:
+    """``execute_wrapper``: количество и время SQL, самые медленные запросы"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = []
+        # Асинхронный запрос может выполнять SQL в нескольких потоках
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.record(duration, sql)
+
+    def record(self, duration, sql):
+        self.count += 1
+        self.duration += duration
+        item = (duration, self.count, sql)
+        if len(self.slowest) < SLOWEST_QUERIES:
+            heapq.heappush(self.slowest, item)
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+
+class PerformanceMiddleware:
+    """
+    Замер времени запроса: всего, SQL (время и количество) и рендеринга
+    ответа (сериализация ``Response.data`` в JSON).
+
+    Результат отдается в заголовке ``Server-Timing``, попадает в
+    гистограммы ``/metrics`` по маршруту (``view_name`` и метод), а запросы
+    дольше ``CATALOG_SLOW_REQUEST_MS`` пишутся в лог вместе с самыми
+    медленными SQL. Накладные расходы - пара ``perf_counter`` на SQL-запрос.
+    Поддерживает и синхронный, и асинхронный (ASGI) стек. Должен стоять
+    первым в ``MIDDLEWARE``.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not settings.CATALOG_METRICS_ENABLED:
+            return self.get_response(request)
+
+        recorder = self.start(request)
+        with ExitStack() as stack:
+            self.install(stack, recorder)
+            response = self.get_response(request)
+        return self.finish(request, response, recorder)
+
+    async def __acall__(self, request):
+        if not settings.CATALOG_METRICS_ENABLED:
+            return await self.get_response(request)
+
+        recorder = self.start(request)
+        # Async ORM выполняет SQL в потоке запроса (thread_sensitive):
+        # регистратор ставится на соединения этого потока
+        stack = ExitStack()
+        await sync_to_async(self.install)(stack, recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self.finish(request, response, recorder)
+
+    @staticmethod
+    def install(stack, recorder):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+
+    @staticmethod
+    def start(request):
+        recorder = QueryRecorder()
+        current_recorder.set(recorder)
+        request._render_started = None
+        request._render_duration = 0.0
+        request._started = time.perf_counter()
+        return recorder
+
+    def finish(self, request, response, recorder):
+        total = time.perf_counter() - request._started
+        current_recorder.set(None)
+
+        timings = {
+            'duration': total,
+            'db': recorder.duration,
+            'render': request._render_duration,
+        }
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries"',
+            f'render;dur={request._render_duration * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.view_name if match else 'unmatched'
+        registry.observe(
+            route, request.method, response.status_code, timings, recorder.count
+        )
+
+        if total * 1000 >= settings.CATALOG_SLOW_REQUEST_MS:
+            slowest = sorted(recorder.slowest, reverse=True)
+            logger.warning(
+                'Медленный запрос %s %s: %.0f мс, SQL %d за %.0f мс%s',
+                request.method, request.get_full_path(), total * 1000,
+                recorder.count, recorder.duration * 1000,
+                ''.join(
+                    f'\n  {duration * 1000:.1f} мс: {sql[:500]}'
+                    for duration, _, sql in slowest
+                ),
+            )
+        return response
+
+    def process_template_response(self, request, response):
+        if not settings.CATALOG_METRICS_ENABLED:
+            return response
+        # DRF Response рендерится сразу после этого хука
+        request._render_started = time.perf_counter()
+        response.add_post_render_callback(
+            lambda rendered: self.finish_render(request)
+        )
+        return response
+
+    @staticmethod
+    def finish_render(request):
+        if request._render_started is not None:
+            request._render_duration = time.perf_counter() - request._render_started
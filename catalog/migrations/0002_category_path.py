@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:22
+
+from django.db import migrations, models
+
+
+def fill_category_paths(apps, schema_editor):
+    Category = apps.get_model('catalog', 'Category')
+    children_map = {}
+    for category in Category.objects.only('id', 'parent_id'):
+        children_map.setdefault(category.parent_id, []).append(category)
+
+    stack = [(category, '', 0) for category in children_map.get(None, [])]
+    updated = []
+    while stack:
+        category, parent_path, depth = stack.pop()
+        category.path = f'{parent_path}{category.pk}/'
+        category.depth = depth
+        updated.append(category)
+        stack.extend(
+            (child, category.path, depth + 1)
+            for child in children_map.get(category.pk, [])
+        )
+    Category.objects.bulk_update(updated, ['path', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Уровень вложенности'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255, verbose_name='Путь в дереве'),
+        ),
+        migrations.RunPython(fill_category_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:24
+
+from django.db import migrations, models
+
+
+def fill_category_counters(apps, schema_editor):
+    Category = apps.get_model('catalog', 'Category')
+    Product = apps.get_model('catalog', 'Product')
+    categories = list(Category.objects.only('id', 'parent_id', 'path'))
+    by_id = {category.pk: category for category in categories}
+    for category in categories:
+        category.children_count = 0
+        category.products_count = 0
+        category.active_products_count = 0
+        category.products_total = 0
+        category.active_products_total = 0
+
+    for category in categories:
+        if category.parent_id in by_id:
+            by_id[category.parent_id].children_count += 1
+    rows = Product.objects.values_list('category_id', 'is_active').iterator()
+    for category_id, is_active in rows:
+        category = by_id[category_id]
+        category.products_count += 1
+        category.active_products_count += int(is_active)
+        for ancestor_id in category.path.split('/')[:-1]:
+            ancestor = by_id[int(ancestor_id)]
+            ancestor.products_total += 1
+            ancestor.active_products_total += int(is_active)
+
+    Category.objects.bulk_update(
+        categories,
+        [
+            'children_count', 'products_count', 'active_products_count',
+            'products_total', 'active_products_total',
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0002_category_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='active_products_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Количество активных товаров'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='active_products_total',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Количество активных товаров с подкатегориями'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='children_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Количество подкатегорий'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='products_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Количество товаров'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='products_total',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Количество товаров с подкатегориями'),
+        ),
+        migrations.RunPython(fill_category_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0003_category_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='facet_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Версия фасетного индекса'),
+        ),
+    ]
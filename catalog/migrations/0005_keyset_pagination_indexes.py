@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0004_category_facet_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-created_at', '-id'], name='product_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productphoto',
+            index=models.Index(fields=['product', 'order', 'created_at', 'id'], name='photo_product_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='producttab',
+            index=models.Index(fields=['product', 'order', 'created_at', 'id'], name='tab_product_order_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0005_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True, verbose_name='Внешний код'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0006_product_external_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productphoto',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии'),
+        ),
+    ]
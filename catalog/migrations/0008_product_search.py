@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:39
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# Копия catalog.search.build_search_vector на момент миграции: миграция
+# не должна зависеть от кода приложения, который меняется позже
+UPDATE_SEARCH_VECTORS = """
+    UPDATE catalog_product SET search_vector =
+        setweight(to_tsvector(%(config)s::regconfig, COALESCE(name, '')), 'A') ||
+        setweight(to_tsvector(%(config)s::regconfig, COALESCE(description, '')), 'B') ||
+        setweight(to_tsvector(%(config)s::regconfig, COALESCE((
+            SELECT string_agg(tab.title || ' ' || tab.content, ' ')
+            FROM catalog_producttab tab
+            WHERE tab.product_id = catalog_product.id
+        ), '')), 'C')
+"""
+
+CREATE_INDEXES = [
+    'CREATE INDEX product_search_vector_idx ON catalog_product '
+    'USING gin (search_vector)',
+    'CREATE INDEX product_name_trgm_idx ON catalog_product '
+    'USING gin (name gin_trgm_ops)',
+]
+
+DROP_INDEXES = [
+    'DROP INDEX IF EXISTS product_search_vector_idx',
+    'DROP INDEX IF EXISTS product_name_trgm_idx',
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    # GIN и pg_trgm есть только в PostgreSQL; в остальных СУБД
+    # catalog.search использует icontains
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        UPDATE_SEARCH_VECTORS, {'config': settings.CATALOG_SEARCH_CONFIG}
+    )
+    for sql in CREATE_INDEXES:
+        schema_editor.execute(sql)
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for sql in DROP_INDEXES:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0007_productphoto_derivatives'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
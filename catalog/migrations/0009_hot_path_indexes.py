@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def keep_single_main_photo(apps, schema_editor):
+    # Перед уникальным индексом: у товара остается первое по порядку
+    # главное фото
+    ProductPhoto = apps.get_model('catalog', 'ProductPhoto')
+    photos = ProductPhoto.objects.using(schema_editor.connection.alias)
+    duplicated = photos.filter(is_main=True).values('product').annotate(
+        count=Count('id')
+    ).filter(count__gt=1).values_list('product', flat=True)
+    for product_id in duplicated:
+        main_ids = list(photos.filter(
+            product_id=product_id, is_main=True
+        ).order_by('order', 'created_at', 'id').values_list('id', flat=True))
+        photos.filter(id__in=main_ids[1:]).update(is_main=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0008_product_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', '-created_at', '-id'], name='product_category_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'is_active', '-created_at', '-id'], name='product_category_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-created_at', '-id'], name='product_active_created_idx'),
+        ),
+        # Индекс внешнего ключа - префикс product_category_created_idx
+        migrations.AlterField(
+            model_name='product',
+            name='category',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='products', to='catalog.category', verbose_name='Категория'),
+        ),
+        migrations.RunPython(keep_single_main_photo, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='productphoto',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_main', True)), fields=('product',), name='photo_one_main_per_product', violation_error_message='У товара может быть только одно главное фото'),
+        ),
+    ]
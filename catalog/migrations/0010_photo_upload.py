@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:32
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0009_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер, байт')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256')),
+                ('is_main', models.BooleanField(default=False, verbose_name='Главное фото')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photo_uploads', to='catalog.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Загрузка фото',
+                'verbose_name_plural': 'Загрузки фото',
+            },
+        ),
+    ]
@@ -1,10 +1,40 @@
-from django.db import models
+import uuid
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models import Count, F, Max, Value
+from django.db.models.functions import Concat, Greatest, Length, Round, Substr
 from django.core.validators import MinValueValidator
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from . import caching
 
 
 class Category(models.Model):
-    """Категория товаров с поддержкой подкатегорий"""
+    """Категория товаров с поддержкой подкатегорий
+
+    Иерархия дублируется в материализованном пути ``path`` вида ``1/5/12/``
+    (id всех предков и самой категории), что позволяет выбирать поддерево
+    одним запросом ``path__startswith``.
+
+    Счетчики товаров и подкатегорий хранятся денормализованно и
+    поддерживаются инкрементально при изменении товаров и категорий.
+    Операции в обход сигналов (``bulk_create``, ``update``) должны
+    применять дельты через ``Category.adjust_product_counters()`` или
+    завершаться вызовом ``Category.rebuild_counters()``.
+    """
+    PATH_SEPARATOR = '/'
+    # Длина path ограничивает глубину дерева (около 40 уровней при
+    # пятизначных id); проверяется в clean() и при сохранении
+    MAX_PATH_LENGTH = 255
+    MAINTAINED_FIELDS = (
+        'path', 'depth', 'children_count', 'products_count',
+        'active_products_count', 'products_total', 'active_products_total',
+        'facet_version',
+    )
+
     name = models.CharField(max_length=200, verbose_name='Название')
     parent = models.ForeignKey(
         'self',
@@ -15,6 +45,48 @@ class Category(models.Model):
         verbose_name='Родительская категория'
     )
     is_active = models.BooleanField(default=True, verbose_name='Активна')
+    path = models.CharField(
+        max_length=MAX_PATH_LENGTH,
+        db_index=True,
+        editable=False,
+        default='',
+        verbose_name='Путь в дереве'
+    )
+    depth = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Уровень вложенности'
+    )
+    children_count = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество подкатегорий'
+    )
+    products_count = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество товаров'
+    )
+    active_products_count = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество активных товаров'
+    )
+    products_total = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество товаров с подкатегориями'
+    )
+    active_products_total = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество активных товаров с подкатегориями'
+    )
+    facet_version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Версия фасетного индекса'
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлена')
 
@@ -29,6 +101,355 @@ class Category(models.Model):
     def clean(self):
         if self.parent == self:
             raise ValidationError('Категория не может быть родителем самой себя')
+        if self.parent is not None and self.is_ancestor_of(self.parent):
+            raise ValidationError(
+                'Категория не может быть перемещена в свою подкатегорию'
+            )
+        self.validate_path_length(self.parent)
+
+    def validate_path_length(self, parent):
+        """Поместятся ли пути категории и ее поддерева под ``parent``"""
+        parent_path = parent.path if parent is not None else ''
+        if self.pk:
+            own_path = f'{self.pk}{self.PATH_SEPARATOR}'
+            suffix = len(own_path) + self.subtree_depth_length()
+        else:
+            # id новой категории еще неизвестен: берем следующий за последним
+            last_id = Category.objects.aggregate(Max('pk'))['pk__max'] or 0
+            suffix = len(f'{last_id + 1}{self.PATH_SEPARATOR}')
+        self.check_path_length(len(parent_path) + suffix)
+
+    def subtree_depth_length(self):
+        """На сколько символов самый длинный путь поддерева длиннее пути категории"""
+        if not self.path:
+            return 0
+        longest = Category.objects.filter(path__startswith=self.path).aggregate(
+            longest=Max(Length('path'))
+        )['longest']
+        return (longest or len(self.path)) - len(self.path)
+
+    @classmethod
+    def check_path_length(cls, length):
+        if length > cls.MAX_PATH_LENGTH:
+            raise ValidationError(
+                f'Слишком глубокая вложенность: путь в дереве не должен '
+                f'превышать {cls.MAX_PATH_LENGTH} символов'
+            )
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic():
+            if update_fields is None and not self._state.adding:
+                # Путь и счетчики меняются запросами UPDATE: экземпляр,
+                # загруженный раньше, не должен затирать их своими значениями
+                self.refresh_from_db(fields=self.MAINTAINED_FIELDS)
+                kwargs['update_fields'] = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and
+                    field.name not in self.MAINTAINED_FIELDS
+                ]
+            super().save(*args, **kwargs)
+            if update_fields is None or 'parent' in update_fields:
+                self._sync_path()
+
+    def _sync_path(self):
+        """Пересчитать путь категории и всех ее потомков после сохранения"""
+        parent_path = ''
+        depth = 0
+        if self.parent_id:
+            parent_path, parent_depth = Category.objects.filter(
+                pk=self.parent_id
+            ).values_list('path', 'depth').get()
+            depth = parent_depth + 1
+        new_path = f'{parent_path}{self.pk}{self.PATH_SEPARATOR}'
+        if new_path == self.path and depth == self.depth:
+            return
+
+        old_path = self.path
+        # Выход за длину поля откатывает сохранение вместе с транзакцией
+        self.check_path_length(len(new_path) + self.subtree_depth_length())
+        if old_path:
+            # Перемещение: переписываем префикс пути у всего поддерева
+            Category.objects.filter(path__startswith=old_path).update(
+                path=Concat(Value(new_path), Substr('path', len(old_path) + 1)),
+                depth=F('depth') + (depth - self.depth),
+                updated_at=timezone.now(),
+            )
+            self._move_counters(old_path, new_path)
+        else:
+            Category.objects.filter(pk=self.pk).update(path=new_path, depth=depth)
+            if self.parent_id:
+                Category.objects.filter(pk=self.parent_id).update(
+                    children_count=F('children_count') + 1,
+                    updated_at=timezone.now(),
+                )
+        self.path = new_path
+        self.depth = depth
+
+    def _move_counters(self, old_path, new_path):
+        """Перенести итоговые счетчики поддерева от старых предков к новым"""
+        old_ancestors = self.path_to_ids(old_path)[:-1]
+        new_ancestors = self.path_to_ids(new_path)[:-1]
+        if old_ancestors[-1:] != new_ancestors[-1:]:
+            if old_ancestors:
+                Category.objects.filter(pk=old_ancestors[-1]).update(
+                    children_count=F('children_count') - 1,
+                    updated_at=timezone.now(),
+                )
+            if new_ancestors:
+                Category.objects.filter(pk=new_ancestors[-1]).update(
+                    children_count=F('children_count') + 1,
+                    updated_at=timezone.now(),
+                )
+
+        products_total, active_products_total = Category.objects.filter(
+            pk=self.pk
+        ).values_list('products_total', 'active_products_total').get()
+        left = set(old_ancestors) - set(new_ancestors)
+        joined = set(new_ancestors) - set(old_ancestors)
+        if left:
+            Category.objects.filter(pk__in=left).update(
+                products_total=F('products_total') - products_total,
+                active_products_total=(
+                    F('active_products_total') - active_products_total
+                ),
+                updated_at=timezone.now(),
+            )
+        if joined:
+            Category.objects.filter(pk__in=joined).update(
+                products_total=F('products_total') + products_total,
+                active_products_total=(
+                    F('active_products_total') + active_products_total
+                ),
+                updated_at=timezone.now(),
+            )
+
+    def is_ancestor_of(self, category):
+        """Является ли текущая категория предком ``category``"""
+        if not self.path:
+            return False
+        return category.pk != self.pk and category.path.startswith(self.path)
+
+    def get_descendants(self, include_self=False):
+        """Все потомки категории (одним запросом по материализованному пути)"""
+        queryset = Category.objects.filter(path__startswith=self.path)
+        if not include_self:
+            queryset = queryset.exclude(pk=self.pk)
+        return queryset
+
+    def get_ancestor_ids(self):
+        """Id предков категории от корня к родителю"""
+        return self.path_to_ids(self.path)[:-1]
+
+    @classmethod
+    def path_to_ids(cls, path):
+        """Id категорий материализованного пути от корня к самой категории"""
+        return [int(part) for part in path.split(cls.PATH_SEPARATOR) if part]
+
+    @classmethod
+    def build_name_paths(cls):
+        """Пути всех категорий из названий: ``{id: 'Электроника/Смартфоны'}``"""
+        rows = list(cls.objects.values_list('id', 'name', 'path'))
+        names = {pk: name for pk, name, _ in rows}
+        return {
+            pk: cls.PATH_SEPARATOR.join(
+                names.get(ancestor_id, '') for ancestor_id in cls.path_to_ids(path)
+            )
+            for pk, _, path in rows
+        }
+
+    @classmethod
+    def adjust_product_counters(cls, category_id, products=0, active=0):
+        """Изменить счетчики товаров категории и всех ее предков на дельту
+
+        Заодно увеличивает версию фасетного индекса категории. Счетчики
+        входят в ответ API, поэтому ``updated_at`` тоже обновляется
+        (по нему строятся ETag и Last-Modified).
+        """
+        if not products and not active:
+            return
+        path = cls.objects.filter(
+            pk=category_id
+        ).values_list('path', flat=True).first()
+        if path is None:
+            return
+        now = timezone.now()
+        cls.objects.filter(pk=category_id).update(
+            products_count=F('products_count') + products,
+            active_products_count=F('active_products_count') + active,
+            facet_version=F('facet_version') + 1,
+        )
+        cls.objects.filter(pk__in=cls.path_to_ids(path)).update(
+            products_total=F('products_total') + products,
+            active_products_total=F('active_products_total') + active,
+            updated_at=now,
+        )
+
+    def set_subtree_active(self, is_active, include_products=True, dry_run=False):
+        """Включить/выключить категорию со всеми подкатегориями и их товарами
+
+        Несколько UPDATE по материализованному пути независимо от размера
+        поддерева. Счетчики активных товаров пересчитываются тоже
+        множественно: в поддереве все товары получают одно состояние.
+        Возвращает количество измененных (при ``dry_run`` - подлежащих
+        изменению) категорий и товаров.
+        """
+        categories = self.get_descendants(include_self=True).exclude(
+            is_active=is_active
+        )
+        products = Product.objects.filter(
+            category__path__startswith=self.path
+        ).exclude(is_active=is_active)
+        if not include_products:
+            products = products.none()
+        if dry_run:
+            return {'categories': categories.count(), 'products': products.count()}
+
+        now = timezone.now()
+        with transaction.atomic():
+            result = {
+                'categories': categories.update(is_active=is_active, updated_at=now),
+                'products': products.update(is_active=is_active, updated_at=now),
+            }
+            if result['products']:
+                # Активных товаров в поддереве теперь либо все, либо ни одного
+                self.get_descendants(include_self=True).update(
+                    active_products_count=(
+                        F('products_count') if is_active else Value(0)
+                    ),
+                    active_products_total=(
+                        F('products_total') if is_active else Value(0)
+                    ),
+                    facet_version=F('facet_version') + 1,
+                    updated_at=now,
+                )
+                delta = result['products'] if is_active else -result['products']
+                Category.objects.filter(pk__in=self.get_ancestor_ids()).update(
+                    active_products_total=F('active_products_total') + delta,
+                    updated_at=now,
+                )
+            if result['categories'] or result['products']:
+                caching.invalidate()
+        return result
+
+    def reprice_products(self, percent=None, amount=None,
+                         move_to_old_price=False, only_active=False,
+                         dry_run=False):
+        """Изменить цены товаров категории и подкатегорий одним UPDATE
+
+        ``percent`` - изменение в процентах (``-10`` - скидка 10%),
+        ``amount`` - на сумму; цена округляется до копеек и не становится
+        отрицательной. ``move_to_old_price`` переносит прежнюю цену в
+        ``old_price``. Если самая высокая новая цена не помещается в поле
+        ``price``, ничего не меняется и выбрасывается ``ValidationError``
+        (в том числе при ``dry_run``).
+        """
+        products = Product.objects.filter(category__path__startswith=self.path)
+        if only_active:
+            products = products.filter(is_active=True)
+
+        if percent is not None:
+            factor = 1 + percent / 100
+            price = Round(F('price') * Value(factor), 2)
+        else:
+            price = F('price') + Value(amount)
+
+        # Снижение цен не может переполнить поле, и проверка не нужна
+        if dry_run or (percent or 0) > 0 or (amount or 0) > 0:
+            stats = products.aggregate(count=Count('pk'), max_price=Max('price'))
+            if stats['max_price'] is not None:
+                if percent is not None:
+                    new_max = (stats['max_price'] * factor).quantize(
+                        Decimal('0.01'), rounding=ROUND_HALF_UP
+                    )
+                else:
+                    new_max = stats['max_price'] + amount
+                if new_max > Product.MAX_PRICE:
+                    raise ValidationError(
+                        f'Новая цена {new_max} превышает максимальную '
+                        f'{Product.MAX_PRICE}'
+                    )
+            if dry_run:
+                return {'products': stats['count']}
+        changes = {
+            'price': Greatest(
+                price, Value(0), output_field=models.DecimalField()
+            ),
+            'updated_at': timezone.now(),
+        }
+        if move_to_old_price:
+            changes['old_price'] = F('price')
+        with transaction.atomic():
+            result = {'products': products.update(**changes)}
+            if result['products']:
+                caching.invalidate()
+        return result
+
+    @classmethod
+    def bump_facet_version(cls, category_ids):
+        """Инвалидировать фасетные индексы категорий"""
+        cls.objects.filter(pk__in=set(category_ids)).update(
+            facet_version=F('facet_version') + 1
+        )
+
+    @classmethod
+    def rebuild_counters(cls):
+        """Полностью пересчитать денормализованные счетчики всех категорий"""
+        with transaction.atomic():
+            counter_fields = [
+                'children_count', 'products_count', 'active_products_count',
+                'products_total', 'active_products_total',
+            ]
+            categories = list(cls.objects.select_for_update().only(
+                'id', 'path', 'updated_at', *counter_fields
+            ))
+            old_counters = {
+                category.pk: [getattr(category, field) for field in counter_fields]
+                for category in categories
+            }
+            products = {
+                row['category_id']: row
+                for row in Product.objects.values('category_id').annotate(
+                    total=models.Count('pk'),
+                    active=models.Count('pk', filter=models.Q(is_active=True)),
+                ).order_by()
+            }
+            children = dict(
+                cls.objects.filter(parent__isnull=False).values_list(
+                    'parent_id'
+                ).annotate(total=models.Count('pk')).order_by()
+            )
+            by_id = {category.pk: category for category in categories}
+            for category in categories:
+                row = products.get(category.pk, {})
+                category.children_count = children.get(category.pk, 0)
+                category.products_count = row.get('total', 0)
+                category.active_products_count = row.get('active', 0)
+                category.products_total = 0
+                category.active_products_total = 0
+            for category in categories:
+                for ancestor_id in cls.path_to_ids(category.path):
+                    ancestor = by_id.get(ancestor_id)
+                    if ancestor is not None:
+                        ancestor.products_total += category.products_count
+                        ancestor.active_products_total += (
+                            category.active_products_count
+                        )
+            now = timezone.now()
+            changed = []
+            for category in categories:
+                counters = [getattr(category, field) for field in counter_fields]
+                if counters != old_counters[category.pk]:
+                    category.updated_at = now
+                    changed.append(category)
+            cls.objects.bulk_update(
+                changed, counter_fields + ['updated_at'], batch_size=500
+            )
+            # Пересчет вызывается после массовых операций в обход сигналов,
+            # поэтому фасетные индексы тоже нужно перестроить
+            cls.objects.update(facet_version=F('facet_version') + 1)
+            caching.invalidate()
+        return len(categories)
 
 
 class Filter(models.Model):
@@ -75,11 +496,23 @@ class FilterValue(models.Model):
 
 class Product(models.Model):
     """Товар"""
+    # Наибольшая цена, которую вмещают price и old_price (10 цифр, 2 после точки)
+    MAX_PRICE = Decimal('99999999.99')
+
     name = models.CharField(max_length=200, verbose_name='Название')
+    external_id = models.CharField(
+        max_length=100,
+        unique=True,
+        null=True,
+        blank=True,
+        verbose_name='Внешний код'
+    )
     category = models.ForeignKey(
         Category,
         on_delete=models.CASCADE,
         related_name='products',
+        # Поиск по категории обслуживает product_category_created_idx
+        db_index=False,
         verbose_name='Категория'
     )
     description = models.TextField(blank=True, verbose_name='Описание')
@@ -107,15 +540,57 @@ class Product(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлен')
+    # Заполняется catalog.search; GIN-индексы по нему и по триграммам
+    # названия создаются миграцией 0008 только в PostgreSQL
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         verbose_name = 'Товар'
         verbose_name_plural = 'Товары'
         ordering = ['-created_at']
+        indexes = [
+            # Курсорная пагинация списка товаров
+            models.Index(
+                fields=['-created_at', '-id'],
+                name='product_created_id_idx'
+            ),
+            # Список товаров категории; заменяет индекс внешнего ключа
+            models.Index(
+                fields=['category', '-created_at', '-id'],
+                name='product_category_created_idx'
+            ),
+            # Список товаров категории с фильтром по активности
+            models.Index(
+                fields=['category', 'is_active', '-created_at', '-id'],
+                name='product_category_active_idx'
+            ),
+            # Активные товары всего каталога
+            models.Index(
+                fields=['-created_at', '-id'],
+                condition=models.Q(is_active=True),
+                name='product_active_created_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # Счетчики категорий обновляются сигналами в той же транзакции
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    @classmethod
+    def touch(cls, product_ids):
+        """Обновить ``updated_at`` после изменения фото, вкладок или фильтров
+
+        Они входят в карточку товара, поэтому ETag и Last-Modified
+        товара должны меняться вместе с ними.
+        """
+        cls.objects.filter(pk__in=set(product_ids)).update(
+            updated_at=timezone.now()
+        )
+
     @property
     def in_stock(self):
         """Количество товара в наличии"""
@@ -144,6 +619,12 @@ class ProductPhoto(models.Model):
         verbose_name='Товар'
     )
     image = models.ImageField(upload_to='products/', verbose_name='Изображение')
+    derivatives = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        verbose_name='Уменьшенные копии'
+    )
     is_main = models.BooleanField(default=False, verbose_name='Главное фото')
     order = models.PositiveIntegerField(default=0, verbose_name='Порядок')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создано')
@@ -152,6 +633,21 @@ class ProductPhoto(models.Model):
         verbose_name = 'Фото товара'
         verbose_name_plural = 'Фото товаров'
         ordering = ['order', 'created_at']
+        indexes = [
+            models.Index(
+                fields=['product', 'order', 'created_at', 'id'],
+                name='photo_product_order_idx'
+            ),
+        ]
+        constraints = [
+            # Этот же частичный индекс выбирает главные фото списка товаров
+            models.UniqueConstraint(
+                fields=['product'],
+                condition=models.Q(is_main=True),
+                name='photo_one_main_per_product',
+                violation_error_message='У товара может быть только одно главное фото',
+            ),
+        ]
 
     def __str__(self):
         return f"Фото {self.product.name}"
@@ -180,6 +676,40 @@ class ProductTab(models.Model):
         verbose_name = 'Вкладка товара'
         verbose_name_plural = 'Вкладки товаров'
         ordering = ['order', 'created_at']
+        indexes = [
+            models.Index(
+                fields=['product', 'order', 'created_at', 'id'],
+                name='tab_product_order_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.product.name})"
+
+
+class PhotoUpload(models.Model):
+    """Загрузка фото товара по частям (см. ``catalog.uploads``)
+
+    Принятые байты лежат в файле ``CATALOG_UPLOAD_DIR/<id>.part``; после
+    проверки собранного файла создается ``ProductPhoto``, а загрузка
+    удаляется.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='photo_uploads',
+        verbose_name='Товар'
+    )
+    filename = models.CharField(max_length=255, verbose_name='Имя файла')
+    size = models.PositiveBigIntegerField(verbose_name='Размер, байт')
+    sha256 = models.CharField(max_length=64, verbose_name='SHA-256')
+    is_main = models.BooleanField(default=False, verbose_name='Главное фото')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создано')
+
+    class Meta:
+        verbose_name = 'Загрузка фото'
+        verbose_name_plural = 'Загрузки фото'
+
+    def __str__(self):
+        return f"{self.filename} ({self.product_id})"
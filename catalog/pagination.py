@@ -0,0 +1,290 @@
+import base64
+import binascii
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import async_db
+
+
+class KeysetPagination(BasePagination):
+    """
+    Курсорная пагинация по составному ключу сортировки.
+
+    В отличие от ``PageNumberPagination`` не выполняет ``COUNT(*)`` и
+    ``OFFSET``: следующая страница выбирается условием
+    ``(created_at, id) < (последние значения)`` по индексу, поэтому время
+    ответа не зависит от глубины страницы. Последнее поле ``ordering``
+    должно быть уникальным (обычно ``id``).
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = ('-created_at', '-id')
+    invalid_cursor_message = 'Некорректный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset, position, reverse = self.prepare(queryset, request)
+        return self.finish(list(queryset), position, reverse)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        queryset, position, reverse = self.prepare(queryset, request)
+        return self.finish(await async_db.fetch(queryset), position, reverse)
+
+    def prepare(self, queryset, request):
+        """Выборка страницы (на одну запись больше) по курсору запроса"""
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request, queryset.model)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [self.invert(field) for field in ordering]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.build_filter(ordering, position))
+        return queryset[:self.page_size + 1], position, reverse
+
+    def finish(self, results, position, reverse):
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+        page_size = request.query_params.get(self.page_size_query_param)
+        if page_size and page_size.isdigit() and int(page_size) > 0:
+            return min(int(page_size), self.max_page_size)
+        return self.page_size
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    def build_filter(self, ordering, position):
+        """Условие «строго после позиции» для лексикографической сортировки
+
+        Первое поле дополнительно ограничивается нестрогим неравенством,
+        чтобы планировщик мог начать сканирование индекса с позиции.
+        """
+        names = [field.lstrip('-') for field in ordering]
+        lookups = ['lt' if field.startswith('-') else 'gt' for field in ordering]
+
+        after = Q()
+        for index, name in enumerate(names):
+            condition = Q(**{f'{name}__{lookups[index]}': position[index]})
+            for previous in range(index):
+                condition &= Q(**{names[previous]: position[previous]})
+            after |= condition
+        bound_lookup = 'lte' if lookups[0] == 'lt' else 'gte'
+        bound = Q(**{f'{names[0]}__{bound_lookup}': position[0]})
+        return bound & after
+
+    def get_position(self, instance):
+        names = [field.lstrip('-') for field in self.ordering]
+        if isinstance(instance, dict):
+            # Строка .values() (см. catalog.fastlist)
+            return [instance[name] for name in names]
+        return [getattr(instance, name) for name in names]
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            values = data['p']
+            reverse = bool(data.get('r'))
+            if len(values) != len(self.ordering):
+                raise ValueError
+            position = [
+                model._meta.get_field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except (TypeError, ValueError, KeyError, binascii.Error,
+                DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, position, reverse):
+        data = {'p': [self.to_json(value) for value in position]}
+        if reverse:
+            data['r'] = 1
+        encoded = base64.urlsafe_b64encode(
+            json.dumps(data, separators=(',', ':')).encode()
+        ).decode()
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, encoded
+        )
+
+    @staticmethod
+    def to_json(value):
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return value
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[-1]), False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.get_position(self.page[0]), True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {
+                    'type': 'string', 'nullable': True, 'format': 'uri'
+                },
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Курсор страницы (из ссылок next/previous)',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Количество записей на странице',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+class OrderedKeysetPagination(KeysetPagination):
+    """Курсорная пагинация для фото и вкладок (порядок, дата создания)"""
+    ordering = ('order', 'created_at', 'id')
+
+
+class KeysetPaginationMixin:
+    """
+    Включает курсорную пагинацию по запросу клиента.
+
+    По умолчанию используется глобальная ``PageNumberPagination``;
+    с параметром ``?pagination=cursor`` (или при наличии ``?cursor=``)
+    выдача переключается на ``keyset_pagination_class``.
+
+    Параметры из ``keyset_unsupported_params`` задают свою сортировку
+    (например, ``search`` - по релевантности), которую курсор заменил бы
+    сортировкой ``ordering``; вместе с курсором они дают 400.
+    """
+    keyset_pagination_class = KeysetPagination
+    keyset_unsupported_params = ()
+
+    def use_keyset_pagination(self):
+        request = getattr(self, 'request', None)
+        if request is None:
+            return False
+        params = request.query_params
+        requested = (
+            params.get('pagination') == 'cursor' or
+            KeysetPagination.cursor_query_param in params
+        )
+        unsupported = [
+            name for name in self.keyset_unsupported_params if params.get(name)
+        ]
+        if requested and unsupported:
+            raise ValidationError({'pagination': [
+                f'Курсорная пагинация недоступна с параметрами: '
+                f'{", ".join(unsupported)}; используйте page'
+            ]})
+        return requested
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.use_keyset_pagination():
+                self._paginator = self.keyset_pagination_class()
+            elif self.pagination_class is None:
+                self._paginator = None
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+
+async def apaginate(paginator, queryset, request, view=None):
+    """Асинхронный ``paginator.paginate_queryset``
+
+    Для ``PageNumberPagination`` страница и ``COUNT(*)`` выбираются
+    одновременно: номер страницы известен до подсчета, а проверка
+    номера по количеству записей выполняется после.
+    """
+    if isinstance(paginator, KeysetPagination):
+        return await paginator.apaginate_queryset(queryset, request, view)
+    if not isinstance(paginator, PageNumberPagination):
+        return await sync_to_async(paginator.paginate_queryset)(
+            queryset, request, view
+        )
+
+    paginator.request = request
+    page_size = paginator.get_page_size(request)
+    if not page_size:
+        return None
+
+    django_paginator = paginator.django_paginator_class(queryset, page_size)
+    raw_number = request.query_params.get(paginator.page_query_param) or 1
+    results = None
+    if str(raw_number).isdigit() and int(raw_number) > 0:
+        bottom = (int(raw_number) - 1) * page_size
+        django_paginator.count, results = await async_db.gather(
+            async_db.fetch_count(queryset),
+            async_db.fetch(queryset[bottom:bottom + page_size]),
+        )
+    else:
+        django_paginator.count = await async_db.fetch_count(queryset)
+    page_number = paginator.get_page_number(request, django_paginator)
+
+    try:
+        paginator.page = django_paginator.page(page_number)
+    except InvalidPage as exc:
+        msg = paginator.invalid_page_message.format(
+            page_number=page_number, message=str(exc)
+        )
+        raise NotFound(msg)
+    if results is None:
+        results = await async_db.fetch(paginator.page.object_list)
+    paginator.page.object_list = results
+
+    if django_paginator.num_pages > 1 and paginator.template is not None:
+        paginator.display_page_controls = True
+    return list(results)
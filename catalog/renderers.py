@@ -0,0 +1,50 @@
+"""
+JSON-рендерер на orjson.
+
+Вывод совпадает с ``rest_framework.renderers.JSONRenderer`` (компактные
+разделители, UTF-8 без экранирования, ``\\u2028``/``\\u2029``
+экранируются, типы без JSON-представления кодируются ``encoder_class``),
+но кодирование в несколько раз быстрее. Отличается только запись чисел с
+плавающей точкой в экспоненциальной форме и ``NaN``, которых в ответах
+каталога нет.
+
+Если orjson не установлен, ответ запрошен с отступами (``indent`` в
+``Accept``, browsable API) или orjson не может закодировать данные
+(целые больше 64 бит, нестроковые ключи), работает ``JSONRenderer``.
+"""
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    # datetime/date/time - через encoder_class: DRF пишет UTC как "Z"
+    ORJSON_OPTIONS = (
+        orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+
+class CatalogJSONRenderer(JSONRenderer):
+    """``JSONRenderer`` с кодированием через orjson"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None or data is None or
+            not self.compact or self.ensure_ascii or
+            self.get_indent(accepted_media_type, renderer_context or {})
+            is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(
+                data, default=self.encoder_class().default,
+                option=ORJSON_OPTIONS,
+            )
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Как JSONRenderer: эти символы допустимы в JSON, но не в JavaScript
+        return ret.replace(
+            b'\xe2\x80\xa8', b'\\u2028'
+        ).replace(b'\xe2\x80\xa9', b'\\u2029')
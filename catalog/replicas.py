@@ -0,0 +1,113 @@
+"""
+Чтение каталога с реплик PostgreSQL.
+
+Если кроме ``default`` настроены реплики (``CATALOG_DB_REPLICAS``, см.
+``DB_REPLICA_HOSTS``), безопасные запросы ViewSet каталога
+(``ReplicaReadMixin``) читают со случайной реплики. БД выбирается после
+аутентификации: токен и пользователь всегда читаются с основной БД.
+
+Read-your-writes: успешный запрос на запись закрепляет пользователя за
+основной БД на ``CATALOG_REPLICA_PIN_SECONDS`` секунд (отметка в кэше
+каталога, общем для воркеров), и в это окно его чтение идет в основную
+БД мимо кэша ответов. Окно должно быть больше обычного отставания
+реплик.
+
+Запись и любое чтение внутри ``transaction.atomic`` (изменение порядка
+фото и вкладок, ``select_for_update``) выполняются в основной БД. Без
+реплик роутер ничего не меняет.
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+
+from . import caching
+
+# БД чтения текущего запроса: реплика, DEFAULT_DB_ALIAS (пользователь
+# закреплен за основной БД) или None (запрос не маршрутизируется)
+read_alias = ContextVar('catalog_read_alias', default=None)
+
+
+def pin_key(user):
+    return f'catalog:replica-pin:{user.pk}'
+
+
+def route(request):
+    """Выбрать БД чтения для запроса ViewSet"""
+    replicas = settings.CATALOG_DB_REPLICAS
+    if not replicas or request.method not in SAFE_METHODS:
+        read_alias.set(None)
+    elif (
+        request.user.is_authenticated and
+        caching.get_cache().get(pin_key(request.user))
+    ):
+        read_alias.set(DEFAULT_DB_ALIAS)
+    else:
+        read_alias.set(random.choice(replicas))
+
+
+def pin(request):
+    """Закрепить пользователя за основной БД после записи"""
+    if not settings.CATALOG_DB_REPLICAS or not request.user.is_authenticated:
+        return
+    caching.get_cache().set(
+        pin_key(request.user), True, settings.CATALOG_REPLICA_PIN_SECONDS
+    )
+
+
+def is_pinned():
+    """Текущий запрос читает основную БД, потому что пользователь недавно писал"""
+    return read_alias.get() == DEFAULT_DB_ALIAS
+
+
+def reads_replica():
+    return read_alias.get() not in (None, DEFAULT_DB_ALIAS)
+
+
+class ReplicaRouter:
+    """Роутер БД: чтение запроса - с выбранной реплики, запись - в основную"""
+
+    def db_for_read(self, model, **hints):
+        alias = read_alias.get()
+        if alias is None:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # Транзакция видит только данные основной БД
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # И для объектов, прочитанных с реплики
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.CATALOG_DB_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема приходит на реплики репликацией
+        if db in settings.CATALOG_DB_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaReadMixin:
+    """Маршрутизация чтения ViewSet по репликам (см. модуль)"""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        route(request)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        read_alias.set(None)
+        if (
+            request.method not in SAFE_METHODS and
+            status.is_success(response.status_code)
+        ):
+            pin(request)
+        return super().finalize_response(request, response, *args, **kwargs)
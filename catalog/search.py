@@ -0,0 +1,97 @@
+"""
+Полнотекстовый и нечеткий поиск товаров.
+
+В PostgreSQL у товара хранится ``search_vector`` (``tsvector`` с GIN-
+индексом) с весами: название - A, описание - B, вкладки - C. Вектор
+пересчитывается одним ``UPDATE`` при сохранении товара или его вкладок.
+Запрос ``websearch_to_tsquery`` дополняется триграммным сходством
+названия (``pg_trgm``, GIN-индекс по ``name``), поэтому опечатки тоже
+находят товар. Результаты упорядочены по сумме ``ts_rank`` и сходства.
+
+На других СУБД (SQLite в тестах) используется ``icontains`` по тем же
+полям (у вкладок - заголовок и текст, как и в векторе) с упрощенным
+рангом: совпадение в названии важнее описания.
+"""
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+)
+from django.db import connections
+from django.db.models import (
+    Case, Exists, F, FloatField, OuterRef, Q, Subquery, TextField, Value,
+    When
+)
+from django.db.models.functions import Concat
+
+
+def is_postgresql(using='default'):
+    return connections[using].vendor == 'postgresql'
+
+
+def build_search_vector(tab_model):
+    """Выражение ``tsvector`` товара (модель вкладок передается для миграций)"""
+    config = settings.CATALOG_SEARCH_CONFIG
+    tabs_text = tab_model.objects.filter(
+        product=OuterRef('pk')
+    ).order_by().values('product').annotate(
+        text=StringAgg(
+            Concat('title', Value(' '), 'content', output_field=TextField()),
+            delimiter=' '
+        )
+    ).values('text')
+    return (
+        SearchVector('name', weight='A', config=config) +
+        SearchVector('description', weight='B', config=config) +
+        SearchVector(Subquery(tabs_text), weight='C', config=config)
+    )
+
+
+def update_search_vectors(queryset):
+    """Пересчитать ``search_vector`` товаров выборки (только PostgreSQL)"""
+    if not is_postgresql(queryset.db):
+        return 0
+    from .models import ProductTab
+    return queryset.update(search_vector=build_search_vector(ProductTab))
+
+
+def search_products(queryset, term):
+    """Отфильтровать товары по запросу и упорядочить по релевантности"""
+    term = term.strip()
+    if not term:
+        return queryset
+
+    if is_postgresql(queryset.db):
+        query = SearchQuery(
+            term, config=settings.CATALOG_SEARCH_CONFIG, search_type='websearch'
+        )
+        return queryset.annotate(
+            search_rank=(
+                SearchRank(F('search_vector'), query) +
+                TrigramSimilarity('name', term)
+            )
+        ).filter(
+            Q(search_vector=query) | Q(name__trigram_similar=term)
+        ).order_by('-search_rank', '-created_at', '-id')
+
+    from .models import ProductTab
+    rank = Value(0.0, output_field=FloatField())
+    for word in term.split():
+        in_tabs = ProductTab.objects.filter(
+            Q(title__icontains=word) | Q(content__icontains=word),
+            product=OuterRef('pk'),
+        )
+        queryset = queryset.filter(
+            Q(name__icontains=word) |
+            Q(description__icontains=word) |
+            Exists(in_tabs)
+        )
+        rank = rank + Case(
+            When(name__icontains=word, then=Value(1.0)),
+            When(description__icontains=word, then=Value(0.4)),
+            default=Value(0.1),
+            output_field=FloatField(),
+        )
+    return queryset.annotate(search_rank=rank).order_by(
+        '-search_rank', '-created_at', '-id'
+    )
@@ -0,0 +1,205 @@
+"""
+Генерация синтетического каталога для нагрузочных замеров.
+
+Дерево категорий заданной глубины и ветвистости, у листовых категорий -
+фильтры со значениями, товары распределяются по листьям и получают по
+одному значению каждого фильтра своей категории, фото и вкладки.
+Все записывается пакетами через ``bulk_create`` в обход сигналов, после
+чего счетчики категорий и поисковые векторы пересчитываются одним
+проходом. Генератор детерминирован: одинаковые параметры и ``seed``
+дают одинаковый каталог.
+"""
+import random
+from decimal import Decimal
+
+from django.db import connection, transaction
+
+from .models import (
+    Category, Filter, FilterValue, Product, ProductPhoto, ProductTab
+)
+from .search import update_search_vectors
+
+SCALES = {
+    'small': {
+        'depth': 3, 'branching': 4, 'filters': 3, 'values': 5,
+        'products': 2000, 'photos': 2, 'tabs': 2,
+    },
+    'medium': {
+        'depth': 4, 'branching': 5, 'filters': 4, 'values': 8,
+        'products': 50000, 'photos': 3, 'tabs': 3,
+    },
+    'large': {
+        'depth': 4, 'branching': 6, 'filters': 5, 'values': 10,
+        'products': 300000, 'photos': 4, 'tabs': 3,
+    },
+}
+
+CATEGORY_NAMES = [
+    'Электроника', 'Смартфоны', 'Ноутбуки', 'Аксессуары', 'Бытовая техника',
+    'Одежда', 'Обувь', 'Спорт', 'Туризм', 'Дом', 'Сад', 'Инструменты',
+    'Детские товары', 'Игрушки', 'Книги', 'Красота', 'Здоровье', 'Зоотовары',
+]
+FILTER_NAMES = [
+    'Цвет', 'Размер', 'Бренд', 'Материал', 'Страна', 'Вес', 'Гарантия',
+    'Мощность', 'Объем', 'Сезон',
+]
+ADJECTIVES = [
+    'Компактный', 'Легкий', 'Прочный', 'Удобный', 'Новый', 'Классический',
+    'Профессиональный', 'Беспроводной', 'Складной', 'Универсальный',
+]
+NOUNS = [
+    'набор', 'чехол', 'рюкзак', 'фонарь', 'чайник', 'светильник', 'кабель',
+    'коврик', 'стул', 'органайзер', 'термос', 'наушники',
+]
+WORDS = [
+    'качество', 'материал', 'комплект', 'гарантия', 'доставка', 'размер',
+    'цвет', 'упаковка', 'инструкция', 'производитель', 'модель', 'сезон',
+]
+TAB_TITLES = ['Описание', 'Характеристики', 'Доставка', 'Отзывы']
+
+MODELS = (
+    Product.filter_values.through, ProductPhoto, ProductTab, Product,
+    FilterValue, Filter, Category,
+)
+
+
+class CatalogSeeder:
+    """Пакетная генерация каталога"""
+
+    def __init__(self, depth, branching, filters, values, products, photos,
+                 tabs, batch_size=1000, seed=0, log=None):
+        self.depth = depth
+        self.branching = branching
+        self.filters = filters
+        self.values = values
+        self.products = products
+        self.photos = photos
+        self.tabs = tabs
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+        self.log = log or (lambda message: None)
+
+    @staticmethod
+    def clear():
+        """Удалить весь каталог без загрузки объектов и сигналов"""
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in MODELS:
+                cursor.execute(
+                    f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}'
+                )
+
+    def run(self):
+        leaves = self.create_categories()
+        leaf_values = self.create_filters(leaves)
+        self.create_products(leaves, leaf_values)
+        self.log('Пересчет счетчиков категорий')
+        Category.rebuild_counters()
+        self.log('Пересчет поисковых векторов')
+        update_search_vectors(Product.objects.all())
+
+    def text(self, words):
+        return ' '.join(self.random.choice(WORDS) for _ in range(words))
+
+    def create_categories(self):
+        parents = [None]
+        for depth in range(self.depth):
+            level = []
+            for parent in parents:
+                for index in range(self.branching):
+                    name = self.random.choice(CATEGORY_NAMES)
+                    level.append(Category(
+                        name=f'{name} {depth + 1}.{len(level) + 1}',
+                        parent=parent,
+                        depth=depth,
+                    ))
+            Category.objects.bulk_create(level, batch_size=self.batch_size)
+            for category in level:
+                parent_path = category.parent.path if category.parent else ''
+                category.path = f'{parent_path}{category.pk}{Category.PATH_SEPARATOR}'
+            Category.objects.bulk_update(
+                level, ['path'], batch_size=self.batch_size
+            )
+            self.log(f'Категорий уровня {depth + 1}: {len(level)}')
+            parents = level
+        return parents
+
+    def create_filters(self, leaves):
+        """Фильтры листьев; вернуть ``{id категории: [[id значений], ...]}``"""
+        filters = []
+        for leaf in leaves:
+            names = self.random.sample(
+                FILTER_NAMES, min(self.filters, len(FILTER_NAMES))
+            )
+            filters.extend(Filter(name=name, category=leaf) for name in names)
+        Filter.objects.bulk_create(filters, batch_size=self.batch_size)
+
+        values = [
+            FilterValue(filter=item, value=f'{item.name} {index + 1}')
+            for item in filters
+            for index in range(self.values)
+        ]
+        FilterValue.objects.bulk_create(values, batch_size=self.batch_size)
+        self.log(f'Фильтров: {len(filters)}, значений: {len(values)}')
+
+        by_filter = {}
+        for value in values:
+            by_filter.setdefault(value.filter_id, []).append(value.pk)
+        leaf_values = {}
+        for item in filters:
+            leaf_values.setdefault(item.category_id, []).append(
+                by_filter[item.pk]
+            )
+        return leaf_values
+
+    def create_products(self, leaves, leaf_values):
+        through = Product.filter_values.through
+        created = 0
+        while created < self.products:
+            size = min(self.batch_size, self.products - created)
+            products = []
+            for index in range(created, created + size):
+                price = Decimal(self.random.randint(100, 200000)) / 100
+                products.append(Product(
+                    name=(
+                        f'{self.random.choice(ADJECTIVES)} '
+                        f'{self.random.choice(NOUNS)} {index + 1}'
+                    ),
+                    category=self.random.choice(leaves),
+                    description=self.text(30),
+                    price=price,
+                    old_price=price * 2 if self.random.random() < 0.2 else None,
+                    quantity=self.random.randint(0, 500),
+                    is_active=self.random.random() < 0.9,
+                ))
+            with transaction.atomic():
+                Product.objects.bulk_create(products)
+                ProductPhoto.objects.bulk_create([
+                    ProductPhoto(
+                        product=product,
+                        image=f'products/seed/{product.pk}-{order}.jpg',
+                        is_main=order == 0,
+                        order=order,
+                    )
+                    for product in products
+                    for order in range(self.photos)
+                ])
+                ProductTab.objects.bulk_create([
+                    ProductTab(
+                        product=product,
+                        title=TAB_TITLES[order % len(TAB_TITLES)],
+                        content=self.text(60),
+                        order=order,
+                    )
+                    for product in products
+                    for order in range(self.tabs)
+                ])
+                through.objects.bulk_create([
+                    through(product_id=product.pk, filtervalue_id=value_id)
+                    for product in products
+                    for value_id in (
+                        self.random.choice(choices)
+                        for choices in leaf_values.get(product.category_id, [])
+                    )
+                ])
+            created += size
+            self.log(f'Товаров: {created}/{self.products}')
@@ -1,54 +1,113 @@
+import re
+from collections import defaultdict
+from decimal import Decimal
+
 from rest_framework import serializers
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.contrib.auth.models import User
+from django.utils.text import get_valid_filename
+from .fieldsets import SparseFieldsetMixin
+from .images import build_srcset
 from .models import (
     Category, Product, ProductPhoto, ProductTab,
-    Filter, FilterValue
+    Filter, FilterValue, PhotoUpload
 )
+from .uploads import IMAGE_EXTENSIONS, get_offset
+
+
+def group_by_parent(categories):
+    """Сгруппировать категории по parent_id для сборки дерева в памяти"""
+    children_map = defaultdict(list)
+    for category in categories:
+        children_map[category.parent_id].append(category)
+    return children_map
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор категории"""
     children = serializers.SerializerMethodField()
-    products_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Category
         fields = [
             'id', 'name', 'parent', 'is_active',
-            'children', 'products_count', 'created_at', 'updated_at'
+            'children', 'children_count', 'products_count',
+            'active_products_count', 'products_total',
+            'active_products_total', 'created_at', 'updated_at'
         ]
         read_only_fields = ['created_at', 'updated_at']
+        field_sources = {'children': ('path',)}
+
+    def validate_parent(self, value):
+        """Проверка, что категория не перемещается в свое поддерево"""
+        if value is not None and self.instance is not None:
+            if value.pk == self.instance.pk:
+                raise serializers.ValidationError(
+                    'Категория не может быть родителем самой себя'
+                )
+            if self.instance.is_ancestor_of(value):
+                raise serializers.ValidationError(
+                    'Категория не может быть перемещена в свою подкатегорию'
+                )
+        if value is not None:
+            # Путь в дереве ограничен по длине (Category.MAX_PATH_LENGTH)
+            try:
+                (self.instance or Category()).validate_path_length(value)
+            except DjangoValidationError as error:
+                raise serializers.ValidationError(error.messages)
+        return value
 
     def get_children(self, obj):
         """Получить дочерние категории"""
-        children = obj.children.filter(is_active=True)
-        return CategorySerializer(children, many=True).data
+        children_map = self.context.get('children_map')
+        if children_map is None:
+            # Все активное поддерево выбирается одним запросом по пути
+            children_map = group_by_parent(
+                obj.get_descendants().filter(is_active=True)
+            )
+        context = {**self.context, 'children_map': children_map}
+        children = children_map.get(obj.pk, [])
+        return CategorySerializer(children, many=True, context=context).data
 
-    def get_products_count(self, obj):
-        """Количество товаров в категории"""
-        return obj.products.count()
 
+class CategoryTreeSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """Узел полного дерева категорий
 
-class CategoryListSerializer(serializers.ModelSerializer):
-    """Упрощенный сериализатор для списка категорий"""
-    children_count = serializers.SerializerMethodField()
-    products_count = serializers.SerializerMethodField()
+    Дочерние узлы берутся из ``children_map`` в контексте, поэтому дерево
+    любой глубины собирается без дополнительных запросов.
+    """
+    children = serializers.SerializerMethodField()
 
     class Meta:
         model = Category
         fields = [
-            'id', 'name', 'parent', 'is_active',
-            'children_count', 'products_count', 'created_at', 'updated_at'
+            'id', 'name', 'parent', 'is_active', 'depth',
+            'products_count', 'products_total', 'children'
         ]
+        field_sources = {'children': ()}
+
+    def get_children(self, obj):
+        children = self.context['children_map'].get(obj.pk, [])
+        return CategoryTreeSerializer(
+            children, many=True, context=self.context
+        ).data
 
-    def get_children_count(self, obj):
-        return obj.children.count()
 
-    def get_products_count(self, obj):
-        return obj.products.count()
+class CategoryListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """Упрощенный сериализатор для списка категорий"""
+    class Meta:
+        model = Category
+        fields = [
+            'id', 'name', 'parent', 'is_active',
+            'children_count', 'products_count', 'active_products_count',
+            'products_total', 'active_products_total',
+            'created_at', 'updated_at'
+        ]
 
 
-class FilterValueSerializer(serializers.ModelSerializer):
+class FilterValueSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор значения фильтра"""
     class Meta:
         model = FilterValue
@@ -56,7 +115,7 @@ class FilterValueSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at']
 
 
-class FilterSerializer(serializers.ModelSerializer):
+class FilterSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор фильтра"""
     values = FilterValueSerializer(many=True, read_only=True)
 
@@ -66,14 +125,33 @@ class FilterSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at']
 
 
-class ProductPhotoSerializer(serializers.ModelSerializer):
+def build_url(serializer):
+    """Функция построения абсолютного URL из контекста сериализатора"""
+    request = serializer.context.get('request')
+    if request:
+        return request.build_absolute_uri
+    return lambda url: url
+
+
+class ProductPhotoSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор фото товара"""
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = ProductPhoto
         fields = [
-            'id', 'product', 'image', 'is_main', 'order', 'created_at'
+            'id', 'product', 'image', 'srcset', 'is_main', 'order',
+            'created_at'
         ]
         read_only_fields = ['created_at']
+        field_sources = {'srcset': ('derivatives',)}
+        # Новое главное фото заменяет прежнее (ProductPhotoViewSet), а не
+        # отклоняется проверкой photo_one_main_per_product
+        validators = []
+
+    def get_srcset(self, obj):
+        """Уменьшенные копии (пусто, пока они строятся)"""
+        return build_srcset(obj.derivatives, build_url(self))
 
     def validate_image(self, value):
         """Проверка размера изображения"""
@@ -84,7 +162,60 @@ class ProductPhotoSerializer(serializers.ModelSerializer):
         return value
 
 
-class ProductTabSerializer(serializers.ModelSerializer):
+class PhotoUploadSerializer(serializers.ModelSerializer):
+    """Загрузка фото по частям; ``offset`` - сколько байт уже принято"""
+    offset = serializers.SerializerMethodField()
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = PhotoUpload
+        fields = [
+            'id', 'product', 'filename', 'size', 'sha256', 'is_main',
+            'offset', 'chunk_size', 'created_at'
+        ]
+        read_only_fields = ['created_at']
+
+    def get_offset(self, obj):
+        return get_offset(obj)
+
+    def get_chunk_size(self, obj):
+        """Наибольший размер одной части"""
+        return settings.CATALOG_UPLOAD_CHUNK_SIZE
+
+    def validate_filename(self, value):
+        """Только имя файла изображения, без каталогов"""
+        if '/' in value or '\\' in value:
+            raise serializers.ValidationError(
+                'Имя файла не должно содержать путь'
+            )
+        try:
+            value = get_valid_filename(value)
+        except SuspiciousFileOperation:
+            raise serializers.ValidationError('Недопустимое имя файла')
+        if not value.lower().endswith(IMAGE_EXTENSIONS):
+            raise serializers.ValidationError(
+                'Поддерживаются файлы .jpg, .jpeg, .png, .webp и .gif'
+            )
+        return value
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError(
+                f'Размер изображения не должен превышать '
+                f'{settings.MAX_UPLOAD_SIZE // (1024 * 1024)}MB'
+            )
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', value):
+            raise serializers.ValidationError(
+                'Ожидается SHA-256 файла в шестнадцатеричном виде'
+            )
+        return value
+
+
+class ProductTabSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор вкладки товара"""
     class Meta:
         model = ProductTab
@@ -95,7 +226,7 @@ class ProductTabSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at', 'updated_at']
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор товара"""
     photos = ProductPhotoSerializer(many=True, read_only=True)
     tabs = ProductTabSerializer(many=True, read_only=True)
@@ -114,12 +245,16 @@ class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = [
-            'id', 'name', 'category', 'category_name', 'description',
-            'price', 'old_price', 'quantity', 'in_stock', 'out_of_stock',
-            'is_active', 'filter_values', 'photos', 'tabs',
+            'id', 'external_id', 'name', 'category', 'category_name',
+            'description', 'price', 'old_price', 'quantity', 'in_stock',
+            'out_of_stock', 'is_active', 'filter_values', 'photos', 'tabs',
             'created_at', 'updated_at'
         ]
         read_only_fields = ['created_at', 'updated_at']
+        field_sources = {
+            'in_stock': ('quantity',),
+            'out_of_stock': (),
+        }
 
     def validate_name(self, value):
         """Проверка названия товара"""
@@ -142,22 +277,69 @@ class ProductSerializer(serializers.ModelSerializer):
         return value
 
 
-class ProductListSerializer(serializers.ModelSerializer):
-    """Упрощенный сериализатор для списка товаров"""
+class ProductImportSerializer(ProductSerializer):
+    """Проверка строки импорта по правилам ProductSerializer
+
+    Категория и значения фильтров сопоставляются импортером пакетно,
+    а уникальность ``external_id`` обеспечивает upsert, поэтому
+    валидация строки не делает запросов к БД.
+    """
+    external_id = serializers.CharField(
+        max_length=100,
+        required=False,
+        allow_null=True
+    )
+    photos = None
+    tabs = None
+    filter_values = None
+    in_stock = None
+    out_of_stock = None
+    category_name = None
+
+    class Meta(ProductSerializer.Meta):
+        fields = [
+            'external_id', 'name', 'description', 'price', 'old_price',
+            'quantity', 'is_active'
+        ]
+
+
+class ProductListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """Упрощенный сериализатор для списка товаров
+
+    Описание, фото, вкладки и значения фильтров выводятся только по
+    ``?expand=`` или ``?fields=``.
+    """
     main_photo = serializers.SerializerMethodField()
+    main_photo_srcset = serializers.SerializerMethodField()
     category_name = serializers.CharField(source='category.name', read_only=True)
+    filter_values = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+    photos = ProductPhotoSerializer(many=True, read_only=True)
+    tabs = ProductTabSerializer(many=True, read_only=True)
 
     class Meta:
         model = Product
         fields = [
-            'id', 'name', 'category', 'category_name',
+            'id', 'name', 'category', 'category_name', 'description',
             'price', 'old_price', 'quantity', 'is_active',
-            'main_photo', 'created_at'
+            'main_photo', 'main_photo_srcset', 'filter_values', 'photos',
+            'tabs', 'created_at'
         ]
+        expandable_fields = ['description', 'filter_values', 'photos', 'tabs']
+        # Главное фото выбирается отдельным Prefetch (см. ProductViewSet)
+        field_sources = {'main_photo': (), 'main_photo_srcset': ()}
+
+    def find_main_photo(self, obj):
+        main_photos = getattr(obj, 'main_photos', None)
+        if main_photos is not None:
+            # Главное фото уже выбрано через Prefetch(to_attr='main_photos')
+            return main_photos[0] if main_photos else None
+        if not hasattr(obj, '_main_photo'):
+            obj._main_photo = obj.photos.filter(is_main=True).first()
+        return obj._main_photo
 
     def get_main_photo(self, obj):
         """Получить главное фото"""
-        main_photo = obj.photos.filter(is_main=True).first()
+        main_photo = self.find_main_photo(obj)
         if main_photo:
             request = self.context.get('request')
             if request:
@@ -165,6 +347,53 @@ class ProductListSerializer(serializers.ModelSerializer):
             return main_photo.image.url
         return None
 
+    def get_main_photo_srcset(self, obj):
+        """Уменьшенные копии главного фото"""
+        main_photo = self.find_main_photo(obj)
+        if main_photo:
+            return build_srcset(main_photo.derivatives, build_url(self))
+        return None
+
+
+class ReorderItemSerializer(serializers.Serializer):
+    """Элемент запроса на изменение порядка"""
+    id = serializers.IntegerField(min_value=1)
+    order = serializers.IntegerField(min_value=0)
+
+
+class ReorderSerializer(serializers.Serializer):
+    """Запрос на изменение порядка фото или вкладок одного товара"""
+    product = serializers.IntegerField(required=False, min_value=1)
+    orders = ReorderItemSerializer(many=True)
+
+
+class SubtreeActiveSerializer(serializers.Serializer):
+    """Включение/выключение категории с поддеревом"""
+    is_active = serializers.BooleanField()
+    include_products = serializers.BooleanField(default=True)
+    dry_run = serializers.BooleanField(default=False)
+
+
+class SubtreeRepriceSerializer(serializers.Serializer):
+    """Изменение цен товаров категории с поддеревом"""
+    percent = serializers.DecimalField(
+        max_digits=5, decimal_places=2, required=False,
+        min_value=Decimal('-99.99')
+    )
+    amount = serializers.DecimalField(
+        max_digits=10, decimal_places=2, required=False
+    )
+    move_to_old_price = serializers.BooleanField(default=False)
+    only_active = serializers.BooleanField(default=False)
+    dry_run = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if ('percent' in attrs) == ('amount' in attrs):
+            raise serializers.ValidationError(
+                'Укажите изменение цены: percent или amount'
+            )
+        return attrs
+
 
 class UserSerializer(serializers.ModelSerializer):
     """Сериализатор пользователя"""
@@ -0,0 +1,238 @@
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.db.models.signals import (
+    pre_save, post_save, pre_delete, post_delete, m2m_changed
+)
+from django.dispatch import receiver
+from django.contrib.auth import get_user_model
+from rest_framework.authtoken.models import Token
+
+from . import caching
+from .authentication import forget_tokens, forget_user
+from .facets import registry as facet_registry
+from .images import delete_derivatives, pipeline as image_pipeline
+from .search import update_search_vectors
+from .models import (
+    Category, Filter, FilterValue, Product, ProductPhoto, ProductTab
+)
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_state(sender, instance, **kwargs):
+    """Запомнить категорию и активность товара до сохранения"""
+    instance._counter_state = None
+    if instance.pk:
+        instance._counter_state = Product.objects.filter(
+            pk=instance.pk
+        ).values_list('category_id', 'is_active').first()
+
+
+@receiver(post_save, sender=Product)
+def update_counters_on_product_save(sender, instance, created, **kwargs):
+    """Обновить счетчики категорий после создания/изменения товара"""
+    old_state = getattr(instance, '_counter_state', None)
+    if created or old_state is None:
+        Category.adjust_product_counters(
+            instance.category_id, products=1, active=int(instance.is_active)
+        )
+        facet_registry.apply(
+            instance.category_id,
+            lambda index: index.add_product(instance.pk, instance.is_active)
+        )
+        return
+
+    old_category_id, old_is_active = old_state
+    if old_category_id != instance.category_id:
+        Category.adjust_product_counters(
+            old_category_id, products=-1, active=-int(old_is_active)
+        )
+        Category.adjust_product_counters(
+            instance.category_id, products=1, active=int(instance.is_active)
+        )
+    elif old_is_active != instance.is_active:
+        Category.adjust_product_counters(
+            instance.category_id,
+            active=int(instance.is_active) - int(old_is_active)
+        )
+        facet_registry.apply(
+            instance.category_id,
+            lambda index: index.set_active(instance.pk, instance.is_active)
+        )
+
+
+@receiver(post_delete, sender=Product)
+def update_counters_on_product_delete(sender, instance, **kwargs):
+    """Обновить счетчики категорий после удаления товара"""
+    Category.adjust_product_counters(
+        instance.category_id, products=-1, active=-int(instance.is_active)
+    )
+    facet_registry.apply(
+        instance.category_id, lambda index: index.remove_product(instance.pk)
+    )
+
+
+@receiver(m2m_changed, sender=Product.filter_values.through)
+def update_facets_on_filter_values_change(sender, instance, action, reverse,
+                                          pk_set, **kwargs):
+    """Обновить фасетные индексы при изменении значений фильтров товара"""
+    if reverse:
+        # FilterValue.products.add(...): затронуто сразу несколько товаров,
+        # индексы их категорий просто перестраиваются при следующем запросе
+        if action == 'pre_clear':
+            instance._cleared_products = list(
+                instance.products.values_list('id', 'category_id')
+            )
+        elif action == 'post_clear':
+            Category.bump_facet_version(
+                category_id for _, category_id in instance._cleared_products
+            )
+            Product.touch(pk for pk, _ in instance._cleared_products)
+        elif action in ('post_add', 'post_remove'):
+            Category.bump_facet_version(
+                Product.objects.filter(pk__in=pk_set).values_list(
+                    'category_id', flat=True
+                )
+            )
+            Product.touch(pk_set)
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action != 'post_clear' and not pk_set:
+        return
+    Category.bump_facet_version([instance.category_id])
+    Product.touch([instance.pk])
+    if action == 'post_add':
+        values = dict(
+            FilterValue.objects.filter(pk__in=pk_set).values_list(
+                'id', 'filter_id'
+            )
+        )
+        facet_registry.apply(
+            instance.category_id,
+            lambda index: index.add_values(instance.pk, values)
+        )
+    elif action == 'post_remove':
+        value_ids = set(pk_set)
+        facet_registry.apply(
+            instance.category_id,
+            lambda index: index.remove_values(instance.pk, value_ids)
+        )
+    else:
+        facet_registry.apply(
+            instance.category_id,
+            lambda index: index.remove_values(instance.pk)
+        )
+
+
+@receiver(post_delete, sender=Category)
+def update_counters_on_category_delete(sender, instance, **kwargs):
+    """Уменьшить счетчик подкатегорий у родителя удаленной категории"""
+    if instance.parent_id:
+        Category.objects.filter(pk=instance.parent_id).update(
+            children_count=F('children_count') - 1,
+            updated_at=timezone.now(),
+        )
+
+
+@receiver(post_save, sender=ProductPhoto)
+@receiver(post_delete, sender=ProductPhoto)
+@receiver(post_save, sender=ProductTab)
+@receiver(post_delete, sender=ProductTab)
+def touch_product_on_item_change(sender, instance, **kwargs):
+    """Фото и вкладки входят в карточку товара"""
+    Product.touch([instance.product_id])
+
+
+@receiver(post_save, sender=Product)
+def update_product_search_vector(sender, instance, update_fields, **kwargs):
+    """Пересчитать поисковый вектор после изменения текста товара"""
+    if update_fields is not None and not {'name', 'description'} & set(update_fields):
+        return
+    update_search_vectors(Product.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=ProductTab)
+@receiver(post_delete, sender=ProductTab)
+def update_search_vector_on_tab_change(sender, instance, **kwargs):
+    """Текст вкладок входит в поисковый вектор товара"""
+    update_search_vectors(Product.objects.filter(pk=instance.product_id))
+
+
+@receiver(pre_delete, sender=FilterValue)
+def touch_products_on_filter_value_delete(sender, instance, **kwargs):
+    """Удаление значения каскадно убирает его из товаров без m2m_changed"""
+    Product.touch(instance.products.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=ProductPhoto)
+def schedule_photo_derivatives(sender, instance, **kwargs):
+    """Построить уменьшенные копии нового или замененного изображения
+
+    До записи результата в ``derivatives`` лежит ``{'pending': имя}``:
+    повторное сохранение фото, пока копии строятся, не ставит вторую задачу.
+    """
+    if not instance.image:
+        return
+    name = instance.image.name
+    if name in (instance.derivatives.get('source'), instance.derivatives.get('pending')):
+        return
+    if instance.derivatives:
+        # Копии прежнего изображения больше не нужны
+        old_derivatives = instance.derivatives
+        transaction.on_commit(lambda: delete_derivatives(old_derivatives))
+    instance.derivatives = {'pending': name}
+    ProductPhoto.objects.filter(pk=instance.pk).update(
+        derivatives=instance.derivatives
+    )
+    image_pipeline.schedule(instance.pk, name)
+
+
+@receiver(post_delete, sender=ProductPhoto)
+def delete_photo_derivatives(sender, instance, **kwargs):
+    """Удалить уменьшенные копии удаленного фото"""
+    if instance.derivatives:
+        derivatives = instance.derivatives
+        transaction.on_commit(lambda: delete_derivatives(derivatives))
+
+
+CACHED_MODELS = (Category, Product, ProductPhoto, ProductTab, Filter, FilterValue)
+
+
+def invalidate_catalog_cache(sender, **kwargs):
+    """Любое изменение каталога сбрасывает кэш ответов GET"""
+    caching.invalidate()
+
+
+for model in CACHED_MODELS:
+    post_save.connect(
+        invalidate_catalog_cache, sender=model,
+        dispatch_uid=f'catalog_cache_save_{model.__name__}'
+    )
+    post_delete.connect(
+        invalidate_catalog_cache, sender=model,
+        dispatch_uid=f'catalog_cache_delete_{model.__name__}'
+    )
+m2m_changed.connect(
+    invalidate_catalog_cache, sender=Product.filter_values.through,
+    dispatch_uid='catalog_cache_filter_values'
+)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def forget_cached_token(sender, instance, **kwargs):
+    """Убрать измененный или удаленный токен из кэша аутентификации"""
+    forget_tokens([instance.key])
+
+
+@receiver(post_save, sender=get_user_model())
+def forget_cached_user(sender, instance, created, update_fields, **kwargs):
+    """Права и активность пользователя кэшируются вместе с токеном
+
+    Удаление пользователя каскадно удаляет токены (см. выше).
+    """
+    if created or update_fields == frozenset({'last_login'}):
+        return
+    forget_user(instance.pk)
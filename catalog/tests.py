@@ -1,3 +1,1944 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, connections, transaction
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from . import authentication, facets
+from .async_views import async_patterns
+from .authentication import (
+    CachedTokenAuthentication, SharedTokenCache, TokenLRUCache
+)
+from .benchmark import BenchmarkRunner
+from .checks import check_catalog_cache
+from .images import pipeline as image_pipeline, render_derivatives, store_derivatives
+from .importers import CategoryResolver
+from .management.commands.regenerate_photo_derivatives import TASKS_PER_WORKER
+from .metrics import MetricsRegistry, render_prometheus
+from .models import (
+    Category, Filter, FilterValue, PhotoUpload, Product, ProductPhoto, ProductTab
+)
+from .renderers import CatalogJSONRenderer
+from .replicas import read_alias
+from .seeding import SCALES, CatalogSeeder
+from .uploads import purge
+from .urls import router
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductListQueryCountTest(TestCase):
+    """Количество запросов списка товаров не зависит от размера страницы"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.category = Category.objects.create(name='Электроника')
+
+    def create_products(self, count):
+        for index in range(count):
+            product = Product.objects.create(
+                name=f'Товар {index}', category=self.category, price=100
+            )
+            ProductPhoto.objects.create(
+                product=product, image=f'products/{index}.jpg', is_main=True
+            )
+            ProductPhoto.objects.create(
+                product=product, image=f'products/{index}-2.jpg', order=1
+            )
+
+    def count_list_queries(self, query=''):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'/api/products/{query}')
+        self.assertEqual(response.status_code, 200)
+        return len(context), response.json()
+
+    def test_query_count_is_constant(self):
+        self.create_products(1)
+        expected, data = self.count_list_queries()
+        self.assertTrue(data['results'][0]['main_photo'].endswith('/0.jpg'))
+
+        self.create_products(19)
+        queries, data = self.count_list_queries()
+        self.assertEqual(len(data['results']), 20)
+        self.assertEqual(queries, expected)
+
+        self.create_products(40)
+        queries, data = self.count_list_queries('?page=3')
+        self.assertEqual(len(data['results']), 20)
+        self.assertEqual(queries, expected)
+
+    def test_main_photo_missing(self):
+        Product.objects.create(name='Без фото', category=self.category, price=1)
+        _, data = self.count_list_queries()
+        self.assertIsNone(data['results'][0]['main_photo'])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=300)
+class ResponseCacheTest(TestCase):
+    """Кэш ответов сбрасывается после коммита изменения"""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.category = Category.objects.create(name='Электроника')
+
+    def get_products(self):
+        response = self.client.get('/api/products/', {'category': self.category.pk})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_hit_and_invalidation(self):
+        self.assertEqual(self.get_products()['X-Cache'], 'MISS')
+        with CaptureQueriesContext(connection) as context:
+            response = self.get_products()
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.json()['count'], 0)
+        # Попадание не обращается к БД, кроме аутентификации
+        self.assertFalse(any('catalog_' in q['sql'] for q in context))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name='Товар', category=self.category, price=1)
+        response = self.get_products()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['count'], 1)
+
+    def test_invalidation_across_workers(self):
+        # Два воркера - два экземпляра бэкенда над общим хранилищем
+        with tempfile.TemporaryDirectory() as directory:
+            shared = {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': directory,
+            }
+            with override_settings(CACHES={
+                **settings.CACHES, 'worker1': shared, 'worker2': dict(shared),
+            }):
+                with override_settings(CATALOG_CACHE_ALIAS='worker1'):
+                    self.assertEqual(check_catalog_cache(None), [])
+                    self.get_products()
+                    self.assertEqual(self.get_products()['X-Cache'], 'HIT')
+                with override_settings(CATALOG_CACHE_ALIAS='worker2'), \
+                        self.captureOnCommitCallbacks(execute=True):
+                    Product.objects.create(
+                        name='Товар', category=self.category, price=1
+                    )
+                with override_settings(CATALOG_CACHE_ALIAS='worker1'):
+                    response = self.get_products()
+                    self.assertEqual(response['X-Cache'], 'MISS')
+                    self.assertEqual(response.json()['count'], 1)
+
+        # Кэш в памяти процесса так не работает
+        self.assertEqual(
+            [warning.id for warning in check_catalog_cache(None)],
+            ['catalog.W001']
+        )
+
+    def test_stats(self):
+        self.get_products()
+        self.get_products()
+        response = self.client.get('/api/cache/stats/')
+        self.assertEqual(
+            response.json(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5}
+        )
+
+
+class TokenLRUCacheTest(TestCase):
+    """Кэш токенов процесса: вытеснение, TTL и сброс при изменениях"""
+
+    def setUp(self):
+        self.cache = TokenLRUCache(max_size=10, ttl=60)
+        self.enterContext(mock.patch.object(authentication, 'token_cache', self.cache))
+        self.user = User.objects.create_user('admin', is_staff=True)
+        self.token = Token.objects.create(user=self.user)
+
+    def authenticate(self):
+        return CachedTokenAuthentication().authenticate_credentials(self.token.key)
+
+    def test_evicts_least_recently_used(self):
+        cache = TokenLRUCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(len(cache.entries), 2)
+
+    def test_entries_expire(self):
+        clock = mock.Mock(monotonic=mock.Mock(return_value=1000.0))
+        with mock.patch.object(authentication, 'time', clock):
+            self.cache.set('a', 1)
+            clock.monotonic.return_value = 1059.0
+            self.assertEqual(self.cache.get('a'), 1)
+            clock.monotonic.return_value = 1061.0
+            self.assertIsNone(self.cache.get('a'))
+        self.assertNotIn('a', self.cache.entries)
+
+    def test_hit_runs_no_queries(self):
+        with self.assertNumQueries(1):
+            self.authenticate()
+        with self.assertNumQueries(0):
+            user, token = self.authenticate()
+        self.assertEqual((user.pk, user.username), (self.user.pk, 'admin'))
+        self.assertTrue(user.is_staff)
+        self.assertEqual(token.key, self.token.key)
+
+    def test_token_delete_invalidates(self):
+        self.authenticate()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        self.assertIsNone(self.cache.get(self.token.key))
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_user_save_invalidates(self):
+        self.authenticate()
+        self.user.is_staff = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertIsNone(self.cache.get(self.token.key))
+        self.assertFalse(self.authenticate()[0].is_staff)
+
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_last_login_keeps_entry(self):
+        self.authenticate()
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=['last_login'])
+        self.assertIsNotNone(self.cache.get(self.token.key))
+
+
+class SharedTokenCacheTest(TestCase):
+    """Отзыв токена виден всем воркерам с общим кэшем"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        shared = {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': directory.name,
+        }
+        caches_override = override_settings(CACHES={
+            **settings.CACHES, 'worker1': shared, 'worker2': dict(shared),
+        })
+        caches_override.enable()
+        self.addCleanup(caches_override.disable)
+        self.workers = [
+            SharedTokenCache(alias, 60) for alias in ('worker1', 'worker2')
+        ]
+        self.user = User.objects.create_user('admin', is_staff=True)
+        self.token = Token.objects.create(user=self.user)
+
+    def get_status(self, worker):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        with mock.patch.object(authentication, 'token_cache', worker):
+            return client.get('/api/categories/').status_code
+
+    def change_in(self, worker, change):
+        with mock.patch.object(authentication, 'token_cache', worker), \
+                self.captureOnCommitCallbacks(execute=True):
+            change()
+
+    def test_token_deleted_in_other_worker(self):
+        first, second = self.workers
+        self.assertEqual(self.get_status(first), 200)
+        self.assertIsNotNone(first.get(self.token.key))
+        self.change_in(second, self.token.delete)
+        self.assertEqual(self.get_status(first), 401)
+
+    def test_user_deactivated_in_other_worker(self):
+        first, second = self.workers
+        self.assertEqual(self.get_status(first), 200)
+        self.user.is_active = False
+        self.change_in(second, self.user.save)
+        self.assertEqual(self.get_status(first), 401)
+
+    def test_clear_keeps_other_entries(self):
+        first, second = self.workers
+        self.assertEqual(self.get_status(first), 200)
+        first.cache.set('catalog:other', 1)
+        second.clear()
+        self.assertIsNone(first.get(self.token.key))
+        self.assertEqual(first.cache.get('catalog:other'), 1)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=300)
+class CompressionTest(TestCase):
+    """Сжатие по ``Accept-Encoding`` и сжатые копии в кэше ответов"""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        category = Category.objects.create(name='Электроника')
+        for index in range(20):
+            Product.objects.create(
+                name=f'Товар {index}', category=category, price=100
+            )
+
+    def test_gzip_cached(self):
+        plain = self.client.get('/api/products/')
+        self.assertEqual(plain['X-Cache'], 'MISS')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+        # Первое попадание сжимает сохраненный ответ, второе отдает
+        # сжатую копию из кэша
+        for _ in range(2):
+            response = self.client.get(
+                '/api/products/', HTTP_ACCEPT_ENCODING='br;q=0, gzip'
+            )
+            self.assertEqual(response['X-Cache'], 'HIT')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.content), plain.content)
+            self.assertEqual(response['ETag'], plain['ETag'][:-1] + '-gzip"')
+
+        # ETag сжатого ответа подходит для предусловий
+        response = self.client.get(
+            '/api/products/', HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(CATALOG_COMPRESS_MIN_SIZE=0)
+    def test_if_match_with_encoded_etag(self):
+        product = Product.objects.first()
+        url = f'/api/products/{product.pk}/'
+        etag = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        response = self.client.patch(
+            url, {'name': 'Новое'}, format='json', HTTP_IF_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.patch(
+            url, {'name': 'Еще'}, format='json', HTTP_IF_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 412)
+
+    @override_settings(CATALOG_COMPRESS_MIN_SIZE=0)
+    def test_html_not_compressed(self):
+        response = self.client.get('/admin/login/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response)
+
+    @override_settings(CATALOG_COMPRESS_MIN_SIZE=10 ** 6)
+    def test_small_response_not_compressed(self):
+        response = self.client.get('/api/products/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ConditionalRequestTest(TestCase):
+    """ETag товара меняется вместе с фото и защищает от потери изменений"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        category = Category.objects.create(name='Электроника')
+        self.product = Product.objects.create(
+            name='Товар', category=category, price=1
+        )
+        self.url = f'/api/products/{self.product.pk}/'
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        ProductPhoto.objects.create(product=self.product, image='products/1.jpg')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_match(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.patch(
+            self.url, {'name': 'Новый'}, format='json', HTTP_IF_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.patch(
+            self.url, {'name': 'Другой'}, format='json', HTTP_IF_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 412)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class FacetFilterTest(TestCase):
+    """Фильтрация по значениям фильтров и фасеты"""
+
+    def setUp(self):
+        facets.registry.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.category = Category.objects.create(name='Футболки')
+        color = Filter.objects.create(name='Цвет', category=self.category)
+        size = Filter.objects.create(name='Размер', category=self.category)
+        self.red = FilterValue.objects.create(filter=color, value='Красный')
+        self.blue = FilterValue.objects.create(filter=color, value='Синий')
+        self.small = FilterValue.objects.create(filter=size, value='S')
+        self.medium = FilterValue.objects.create(filter=size, value='M')
+        self.products = {}
+        for name, values, is_active in [
+            ('red-s', [self.red, self.small], True),
+            ('blue-s', [self.blue, self.small], True),
+            ('red-m', [self.red, self.medium], True),
+            ('plain', [], True),
+            ('hidden-red-s', [self.red, self.small], False),
+        ]:
+            product = Product.objects.create(
+                name=name, category=self.category, price=1, is_active=is_active
+            )
+            product.filter_values.set(values)
+            self.products[name] = product
+
+    def get(self, values, category=True, **params):
+        if category:
+            params['category'] = self.category.pk
+        params['fv'] = ','.join(str(value.pk) for value in values)
+        response = self.client.get('/api/products/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def names(self, data):
+        return sorted(product['name'] for product in data['results'])
+
+    def counts(self, data):
+        return {
+            value['value']: value['count']
+            for facet in data['facets'] for value in facet['values']
+        }
+
+    def test_or_within_and_across_filters(self):
+        for category in (True, False):
+            self.assertEqual(
+                self.names(self.get([self.red, self.blue], category)),
+                ['blue-s', 'hidden-red-s', 'red-m', 'red-s']
+            )
+            self.assertEqual(
+                self.names(self.get([self.red, self.small], category)),
+                ['hidden-red-s', 'red-s']
+            )
+            self.assertEqual(
+                self.names(self.get(
+                    [self.red, self.small], category, is_active='true'
+                )),
+                ['red-s']
+            )
+            # Большая выборка повторяется в SQL, а не передается списком id
+            with mock.patch.object(facets, 'MAX_ID_LIST', 1):
+                self.assertEqual(
+                    self.names(self.get([self.red, self.small], category)),
+                    ['hidden-red-s', 'red-s']
+                )
+
+    def test_facet_counts(self):
+        data = self.get([self.red], facets='true', is_active='true')
+        # Цвета считаются без выбора в своем фильтре, размеры - среди красных
+        expected = {'Красный': 2, 'Синий': 1, 'S': 1, 'M': 1}
+        self.assertEqual(self.counts(data), expected)
+        data = self.get(
+            [self.red], category=False, facets='true', is_active='true'
+        )
+        self.assertEqual(self.counts(data), expected)
+
+    def test_index_follows_filter_value_changes(self):
+        self.assertEqual(self.names(self.get([self.blue])), ['blue-s'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products['plain'].filter_values.add(self.blue)
+            self.products['blue-s'].filter_values.remove(self.blue)
+        self.assertEqual(self.names(self.get([self.blue])), ['plain'])
+        self.assertEqual(
+            self.counts(self.get([], facets='true'))['Синий'], 1
+        )
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductSearchTest(TestCase):
+    """Поиск по названию, описанию и вкладкам с ранжированием"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.category = Category.objects.create(name='Электроника')
+        other = Category.objects.create(name='Аксессуары')
+        Product.objects.create(
+            name='Чехол', description='Подходит для Galaxy S24',
+            category=self.category, price=1
+        )
+        Product.objects.create(
+            name='Смартфон Galaxy S24', category=self.category, price=1
+        )
+        cable = Product.objects.create(name='Кабель', category=other, price=1)
+        ProductTab.objects.create(
+            product=cable, title='Совместимость', content='Samsung Galaxy'
+        )
+
+    def search(self, **params):
+        response = self.client.get('/api/products/', params)
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.json()['results']]
+
+    def test_rank_order(self):
+        self.assertEqual(
+            self.search(search='galaxy'),
+            ['Смартфон Galaxy S24', 'Чехол', 'Кабель']
+        )
+
+    def test_combined_with_category(self):
+        self.assertEqual(
+            self.search(search='galaxy', category=self.category.pk),
+            ['Смартфон Galaxy S24', 'Чехол']
+        )
+
+    def test_tab_title(self):
+        cable = Product.objects.get(name='Кабель')
+        ProductTab.objects.create(product=cable, title='USB-C', content='1 м')
+        self.assertEqual(self.search(search='usb-c'), ['Кабель'])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductImportTest(TestCase):
+    """Потоковый импорт товаров с upsert по external_id"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.phones = Category.objects.create(name='Смартфоны')
+        self.existing = Product.objects.create(
+            name='Старое название', external_id='SKU-1',
+            category=self.phones, price=10, quantity=1,
+        )
+
+    def upload(self, content, name='feed.csv'):
+        return self.client.post('/api/products/import/', {
+            'file': SimpleUploadedFile(name, content.encode()),
+        }, format='multipart')
+
+    def test_upsert_by_external_id(self):
+        response = self.upload(
+            'external_id,name,price,quantity,category\n'
+            f'SKU-1,Телефон,99.90,5,\n'
+            f'SKU-2,Чехол,5,,{self.phones.pk}\n'
+            f'SKU-3,Без цены,,,{self.phones.pk}\n'
+        )
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(
+            [result[key] for key in ('processed', 'created', 'updated', 'error_count')],
+            [3, 1, 1, 1]
+        )
+        self.assertEqual(result['errors'][0]['line'], 4)
+        self.assertIn('price', result['errors'][0]['errors'])
+
+        self.existing.refresh_from_db()
+        self.assertEqual(
+            (self.existing.name, str(self.existing.price), self.existing.quantity),
+            ('Телефон', '99.90', 5)
+        )
+        self.assertEqual(Product.objects.count(), 2)
+        self.phones.refresh_from_db()
+        self.assertEqual(self.phones.products_count, 2)
+
+        # Строка с известным кодом обновляет товар, а не создает копию
+        response = self.upload(
+            '{"external_id": "SKU-2", "name": "Чехол", "price": "6.00"}\n',
+            name='feed.jsonl',
+        )
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(
+            str(Product.objects.get(external_id='SKU-2').price), '6.00'
+        )
+
+    def counters(self):
+        return list(Category.objects.order_by('pk').values_list(
+            'products_count', 'active_products_count',
+            'products_total', 'active_products_total',
+        ))
+
+    def test_counters_by_delta(self):
+        tablets = Category.objects.create(name='Планшеты', parent=self.phones)
+        other = Category.objects.create(name='Книги')
+        versions = dict(Category.objects.values_list('pk', 'facet_version'))
+        response = self.upload(
+            'external_id,name,price,is_active,category\n'
+            f'SKU-1,Телефон,10,false,{tablets.pk}\n'
+            f'SKU-2,Планшет,20,true,{tablets.pk}\n'
+        )
+        self.assertEqual(response.json()['error_count'], 0)
+
+        # Категория, которой импорт не касался, не сброшена
+        self.assertEqual(
+            Category.objects.get(pk=other.pk).facet_version, versions[other.pk]
+        )
+        counters = self.counters()
+        self.assertEqual(counters, [(0, 0, 2, 1), (2, 1, 2, 1), (0, 0, 0, 0)])
+        Category.rebuild_counters()
+        self.assertEqual(counters, self.counters())
+
+    def test_integrity_error_reported_once_per_line(self):
+        with mock.patch(
+            'catalog.importers.ProductImporter.write',
+            side_effect=IntegrityError('duplicate key'),
+        ):
+            response = self.upload(
+                'external_id,name,price,category\n'
+                f'SKU-2,Чехол,5,{self.phones.pk}\n'
+                f'SKU-3,Без цены,,{self.phones.pk}\n'
+            )
+        result = response.json()
+        self.assertEqual(result['error_count'], 2)
+        self.assertEqual(
+            [(error['line'], list(error['errors'])) for error in result['errors']],
+            [(3, ['price']), (2, ['non_field_errors'])]
+        )
+
+
+class CategoryResolverTest(TestCase):
+    """Сопоставление категории строки импорта"""
+
+    def test_duplicate_names_and_separator_in_name(self):
+        first = Category.objects.create(name='Sale')
+        second = Category.objects.create(name='Sale')
+        clothes = Category.objects.create(name='Одежда')
+        coats = Category.objects.create(name='Куртки/пальто', parent=clothes)
+
+        resolver = CategoryResolver()
+        self.assertEqual(resolver.resolve({'category': first.pk}), (first.pk, None))
+        self.assertEqual(resolver.resolve({'category': second.pk}), (second.pk, None))
+        self.assertIn('Несколько', resolver.resolve({'category_name': 'Sale'})[1])
+        self.assertIn('Несколько', resolver.resolve({'category_path': 'Sale'})[1])
+        self.assertEqual(
+            resolver.resolve({'category_name': 'Куртки/пальто'}), (coats.pk, None)
+        )
+        self.assertEqual(
+            resolver.resolve({'category_path': 'Одежда / Куртки/пальто'}),
+            (coats.pk, None)
+        )
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductExportTest(TestCase):
+    """Выгрузка каталога совместима с импортом"""
+
+    def test_csv_round_trip(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+        clothes = Category.objects.create(name='Одежда')
+        coats = Category.objects.create(name='Куртки/пальто', parent=clothes)
+        color = Filter.objects.create(name='Цвет', category=coats)
+        red = FilterValue.objects.create(filter=color, value='Красный')
+        coat = Product.objects.create(
+            name='Пальто, "классика"', external_id='SKU-1', category=coats,
+            description='Шерсть\nдлинное', price='120.50', old_price='150',
+            quantity=3, is_active=False,
+        )
+        coat.filter_values.add(red)
+        Product.objects.create(
+            name='Шарф', external_id='SKU-2', category=clothes, price=10
+        )
+        fields = (
+            'external_id', 'name', 'category_id', 'description', 'price',
+            'old_price', 'quantity', 'is_active',
+        )
+        before = list(Product.objects.order_by('external_id').values_list(*fields))
+
+        response = client.get('/api/products/export/?file_format=csv')
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+
+        Product.objects.all().delete()
+        response = client.post('/api/products/import/', {
+            'file': SimpleUploadedFile('catalog.csv', content),
+        }, format='multipart')
+        self.assertEqual(response.json()['created'], 2, response.json())
+        self.assertEqual(
+            list(Product.objects.order_by('external_id').values_list(*fields)),
+            before
+        )
+        self.assertEqual(
+            list(Product.objects.get(external_id='SKU-1').filter_values.all()),
+            [red]
+        )
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductBatchTest(TestCase):
+    """Пакетные операции с товарами: одна транзакция, результат по операциям"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.phones = Category.objects.create(name='Смартфоны')
+        self.cases = Category.objects.create(name='Чехлы')
+        self.product = Product.objects.create(
+            name='Телефон', external_id='SKU-1', category=self.phones, price=10
+        )
+        self.old = Product.objects.create(
+            name='Старый', category=self.phones, price=1
+        )
+
+    def batch(self, operations, **params):
+        return self.client.post(
+            '/api/products/batch/', {'operations': operations, **params},
+            format='json'
+        )
+
+    def test_mixed_operations(self):
+        response = self.batch([
+            {'op': 'create', 'data': {
+                'name': 'Чехол', 'category': self.cases.pk, 'price': '5.00'
+            }},
+            {'op': 'update', 'external_id': 'SKU-1', 'data': {
+                'price': '9.90', 'category': self.cases.pk
+            }},
+            {'op': 'delete', 'id': self.old.pk},
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            [item['status'] for item in data['results']],
+            ['created', 'updated', 'deleted']
+        )
+        self.product.refresh_from_db()
+        self.assertEqual(str(self.product.price), '9.90')
+        self.assertFalse(Product.objects.filter(pk=self.old.pk).exists())
+
+        # Счетчики по дельтам совпадают с полным пересчетом
+        counters = list(Category.objects.order_by('pk').values_list(
+            'products_count', 'active_products_count'
+        ))
+        self.assertEqual(counters, [(0, 0), (2, 2)])
+        Category.rebuild_counters()
+        self.assertEqual(counters, list(Category.objects.order_by('pk').values_list(
+            'products_count', 'active_products_count'
+        )))
+
+    def test_atomic_rejects_whole_batch(self):
+        response = self.batch([
+            {'op': 'update', 'id': self.product.pk, 'data': {'price': '1.00'}},
+            {'op': 'update', 'id': self.old.pk, 'data': {'price': '-1'}},
+        ])
+        self.assertEqual(response.status_code, 400)
+        results = response.json()['results']
+        self.assertEqual(results[0]['status'], 'skipped')
+        self.assertIn('price', results[1]['errors'])
+        self.product.refresh_from_db()
+        self.assertEqual(str(self.product.price), '10.00')
+
+    def test_non_atomic_applies_valid(self):
+        response = self.batch([
+            {'op': 'update', 'id': self.product.pk, 'data': {'quantity': 7}},
+            {'op': 'update', 'external_id': 'missing', 'data': {}},
+        ], atomic=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(response.json()['error_count'], 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 7)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class CategoryTreeTest(TestCase):
+    """Материализованный путь и дерево категорий"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.root = Category.objects.create(name='Электроника')
+        self.phones = Category.objects.create(name='Смартфоны', parent=self.root)
+        self.android = Category.objects.create(name='Android', parent=self.phones)
+        self.other = Category.objects.create(name='Распродажа')
+
+    def paths(self):
+        return dict(Category.objects.values_list('pk', 'path'))
+
+    def test_path_length_is_limited(self):
+        count = Category.objects.count()
+        with mock.patch.object(Category, 'MAX_PATH_LENGTH', len(self.android.path)):
+            response = self.client.post('/api/categories/', {
+                'name': 'Глубже', 'parent': self.android.pk,
+            }, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('вложенность', response.data['parent'][0])
+
+            response = self.client.patch(
+                f'/api/categories/{self.other.pk}/', {'parent': self.android.pk},
+                format='json',
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.paths()[self.other.pk], f'{self.other.pk}/')
+
+            with self.assertRaises(ValidationError):
+                Category.objects.create(name='Глубже', parent=self.android)
+            self.assertEqual(Category.objects.count(), count)
+
+            response = self.client.post('/api/categories/', {
+                'name': 'Аксессуары', 'parent': self.root.pk,
+            }, format='json')
+            self.assertEqual(response.status_code, 201)
+
+    def test_move_rewrites_subtree_paths(self):
+        response = self.client.patch(
+            f'/api/categories/{self.phones.pk}/', {'parent': self.other.pk},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+        paths = self.paths()
+        self.assertEqual(paths[self.phones.pk], f'{self.other.pk}/{self.phones.pk}/')
+        self.assertEqual(
+            paths[self.android.pk],
+            f'{self.other.pk}/{self.phones.pk}/{self.android.pk}/'
+        )
+        self.assertEqual(Category.objects.get(pk=self.android.pk).depth, 2)
+        self.assertEqual(
+            list(self.other.get_descendants().order_by('pk')),
+            [self.phones, self.android]
+        )
+
+        # В собственное поддерево переместить нельзя
+        response = self.client.patch(
+            f'/api/categories/{self.phones.pk}/', {'parent': self.android.pk},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.paths(), paths)
+
+    def test_tree(self):
+        Category.objects.filter(pk=self.other.pk).update(is_active=False)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/categories/tree/?is_active=true')
+        self.assertEqual(response.status_code, 200)
+        # Кроме запроса валидаторов ETag/Last-Modified (COUNT/MAX)
+        tree_queries = [
+            query for query in queries.captured_queries
+            if 'FROM "catalog_category"' in query['sql']
+            and 'MAX(' not in query['sql']
+        ]
+        self.assertEqual(len(tree_queries), 1)
+
+        [root] = response.json()
+        self.assertEqual(root['id'], self.root.pk)
+        [phones] = root['children']
+        self.assertEqual(phones['depth'], 1)
+        self.assertEqual(
+            [node['id'] for node in phones['children']], [self.android.pk]
+        )
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class CategoryCounterTest(TestCase):
+    """Счетчики категорий по дельтам совпадают с полным пересчетом"""
+
+    COUNTER_FIELDS = (
+        'children_count', 'products_count', 'active_products_count',
+        'products_total', 'active_products_total',
+    )
+
+    def setUp(self):
+        self.root = Category.objects.create(name='Электроника')
+        self.phones = Category.objects.create(name='Смартфоны', parent=self.root)
+        self.android = Category.objects.create(name='Android', parent=self.phones)
+        self.other = Category.objects.create(name='Распродажа')
+        self.phone = Product.objects.create(
+            name='Телефон', category=self.android, price=10
+        )
+        self.hidden = Product.objects.create(
+            name='Снят с продажи', category=self.android, price=10,
+            is_active=False,
+        )
+        self.case = Product.objects.create(
+            name='Чехол', category=self.phones, price=1
+        )
+
+    def counters(self):
+        return list(Category.objects.order_by('pk').values_list(
+            'pk', *self.COUNTER_FIELDS
+        ))
+
+    def assertCountersRebuilt(self):
+        counters = self.counters()
+        Category.rebuild_counters()
+        self.assertEqual(counters, self.counters())
+
+    def test_product_changes(self):
+        self.root.refresh_from_db()
+        self.assertEqual(
+            [getattr(self.root, field) for field in self.COUNTER_FIELDS],
+            [1, 0, 0, 3, 2]
+        )
+        self.assertCountersRebuilt()
+
+        self.phone.category = self.other
+        self.phone.save()
+        self.assertCountersRebuilt()
+
+        self.case.is_active = False
+        self.case.save()
+        self.assertCountersRebuilt()
+
+        self.hidden.delete()
+        self.assertCountersRebuilt()
+
+    def test_category_changes(self):
+        self.phones.parent = self.other
+        self.phones.save()
+        self.assertCountersRebuilt()
+
+        self.other.set_subtree_active(False)
+        self.assertCountersRebuilt()
+
+        self.phones.delete()
+        self.assertEqual(Product.objects.count(), 0)
+        self.assertCountersRebuilt()
+
+    def test_batch_update(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+        response = client.post('/api/products/batch/', {'operations': [
+            {'op': 'update', 'id': self.phone.pk, 'data': {
+                'category': self.other.pk, 'is_active': False
+            }},
+            {'op': 'update', 'id': self.hidden.pk, 'data': {'is_active': True}},
+            {'op': 'create', 'data': {
+                'name': 'Планшет', 'category': self.root.pk, 'price': '5.00'
+            }},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertCountersRebuilt()
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class CategorySubtreeTest(TestCase):
+    """Массовые изменения поддерева категории"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.root = Category.objects.create(name='Электроника')
+        self.phones = Category.objects.create(name='Смартфоны', parent=self.root)
+        self.other = Category.objects.create(name='Книги')
+        self.phone = Product.objects.create(
+            name='Телефон', category=self.phones, price='99.99'
+        )
+        self.book = Product.objects.create(
+            name='Книга', category=self.other, price=10
+        )
+
+    def post(self, category, name, data):
+        return self.client.post(
+            f'/api/categories/{category.pk}/{name}/', data, format='json'
+        )
+
+    def counters(self):
+        return list(Category.objects.order_by('pk').values_list(
+            'is_active', 'active_products_count', 'active_products_total'
+        ))
+
+    def test_set_active(self):
+        response = self.post(
+            self.root, 'set_active', {'is_active': False, 'dry_run': True}
+        )
+        self.assertEqual(
+            response.json(), {'categories': 2, 'products': 1, 'dry_run': True}
+        )
+        self.assertTrue(Product.objects.get(pk=self.phone.pk).is_active)
+
+        response = self.post(self.phones, 'set_active', {'is_active': False})
+        self.assertEqual(response.json()['products'], 1)
+        self.assertFalse(Product.objects.get(pk=self.phone.pk).is_active)
+        self.assertTrue(Product.objects.get(pk=self.book.pk).is_active)
+        counters = self.counters()
+        self.assertEqual(counters[:2], [(True, 0, 0), (False, 0, 0)])
+        Category.rebuild_counters()
+        self.assertEqual(counters, self.counters())
+
+    def test_reprice(self):
+        response = self.post(
+            self.root, 'reprice', {'percent': -10, 'move_to_old_price': True}
+        )
+        self.assertEqual(response.json()['products'], 1)
+        self.phone.refresh_from_db()
+        self.assertEqual(str(self.phone.price), '89.99')
+        self.assertEqual(str(self.phone.old_price), '99.99')
+        self.book.refresh_from_db()
+        self.assertEqual(str(self.book.price), '10.00')
+
+        self.post(self.root, 'reprice', {'amount': '-200'})
+        self.phone.refresh_from_db()
+        self.assertEqual(str(self.phone.price), '0.00')
+
+        response = self.post(self.root, 'reprice', {'percent': 5, 'amount': 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_reprice_overflow(self):
+        Product.objects.filter(pk=self.phone.pk).update(price='50000000.00')
+        for data in (
+            {'percent': 100},
+            {'amount': '50000000.00'},
+            {'percent': 100, 'dry_run': True},
+        ):
+            response = self.post(self.root, 'reprice', data)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+        self.phone.refresh_from_db()
+        self.assertEqual(str(self.phone.price), '50000000.00')
+
+        response = self.post(self.root, 'reprice', {'amount': '49999999.99'})
+        self.assertEqual(response.status_code, 200)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.price, Product.MAX_PRICE)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class FastListTest(TestCase):
+    """Списки из ``.values()`` совпадают с ответом сериализаторов байт в байт"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        parent = Category.objects.create(name='Электроника')
+        category = Category.objects.create(name='Ноутбуки', parent=parent)
+        for index in range(3):
+            product = Product.objects.create(
+                name=f'Товар «{index}»\u2028', category=category,
+                price='1999.90', old_price='2100' if index else None,
+                quantity=index,
+            )
+            ProductPhoto.objects.create(
+                product=product, image=f'products/фото {index}.jpg',
+                is_main=True, derivatives={'sizes': {'card': {
+                    'webp': f'products/derived/{index}-card.webp',
+                }}},
+            )
+
+    def assertSameResponse(self, url):
+        responses = []
+        for fast in (True, False):
+            with override_settings(CATALOG_FAST_LIST=fast):
+                responses.append(self.client.get(url))
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[0].content, responses[1].content)
+
+    def test_same_output(self):
+        for url in (
+            '/api/products/',
+            '/api/products/?pagination=cursor&page_size=2',
+            '/api/products/?fields=id,main_photo_srcset,price',
+            '/api/products/?expand=photos',
+            '/api/categories/',
+        ):
+            with self.subTest(url=url):
+                self.assertSameResponse(url)
+
+    def test_renderer(self):
+        for data in (
+            {
+                'text': 'Цена\n"\\\x01\u2028\u2029 😀',
+                'values': [1, None, True, Decimal('1.50')],
+                'at': timezone.now(),
+            },
+            # Не кодируется orjson - рендерит JSONRenderer
+            {'big': 2 ** 70},
+        ):
+            self.assertEqual(
+                CatalogJSONRenderer().render(data), JSONRenderer().render(data)
+            )
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class QueryPlanTest(TestCase):
+    """
+    Горячие запросы каталога на объеме бенчмарка читают большие таблицы
+    по индексам: без полного сканирования, а страницы списков - без
+    сортировки (в порядке индекса).
+    """
+    LARGE_TABLES = (
+        'catalog_product', 'catalog_productphoto', 'catalog_producttab',
+        'catalog_product_filter_values',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        CatalogSeeder(**SCALES['small']).run()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.user = User.objects.create_user('admin', is_staff=True)
+        cls.category = Category.objects.filter(
+            children_count=0
+        ).order_by('-products_count').first()
+        cls.product = cls.category.products.first()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute(f'EXPLAIN {sql}')
+            return [row[0] for row in cursor.fetchall()]
+
+    def plan_problems(self, plan, ordered):
+        for line in plan:
+            if connection.vendor == 'sqlite':
+                scan = re.match(r'SCAN (\w+)$', line)
+                sort = 'TEMP B-TREE FOR ORDER BY' in line
+            else:
+                scan = re.search(r'Seq Scan on (\w+)', line)
+                sort = re.match(r'\s*(->\s*)?(Incremental )?Sort\b', line)
+            if scan and scan.group(1) in self.LARGE_TABLES:
+                yield f'полное сканирование {scan.group(1)}'
+            if ordered and sort:
+                yield 'сортировка вместо порядка индекса'
+
+    def assertIndexed(self, url, ordered=True):
+        """Планы SELECT по ``url``; ``ordered`` - страница с LIMIT
+        читается в порядке индекса"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for query in context.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT'):
+                continue
+            plan = self.explain(sql)
+            problems = list(self.plan_problems(plan, ordered and 'LIMIT' in sql))
+            self.assertFalse(problems, f'{sql}\n' + '\n'.join(plan))
+        return response
+
+    def test_product_lists(self):
+        category = self.category.pk
+        for url in (
+            f'/api/products/?category={category}',
+            f'/api/products/?category={category}&is_active=true',
+            f'/api/products/?category={category}&pagination=cursor',
+            '/api/products/?is_active=true&pagination=cursor',
+            '/api/products/',
+        ):
+            with self.subTest(url=url):
+                response = self.assertIndexed(url)
+        self.assertIndexed(response.json()['next'])
+
+    def test_product_detail(self):
+        product = self.product.pk
+        for url in (
+            f'/api/products/{product}/',
+            f'/api/product-photos/?product={product}',
+            f'/api/product-tabs/?product={product}',
+        ):
+            with self.subTest(url=url):
+                self.assertIndexed(url)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class KeysetPaginationTest(TestCase):
+    """Курсорная пагинация без пропусков и повторов при равных ключах"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.product = Product.objects.create(
+            name='Товар', category=Category.objects.create(name='Книги'),
+            price=1,
+        )
+        for index in range(6):
+            Product.objects.create(
+                name=f'Товар {index}', category=self.product.category, price=1
+            )
+        # Одинаковое время создания: порядок задает только id
+        Product.objects.update(created_at=timezone.now())
+
+    def walk(self, url, link):
+        """Пройти ссылки ``link`` от ``url``; id по страницам"""
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertNotIn('count', data)
+            pages.append([item['id'] for item in data['results']])
+            last = data
+            url = data[link]
+        return pages, last
+
+    def test_benchmark_follows_cursor_link(self):
+        Product.objects.bulk_create([
+            Product(name=f'Товар {index}', category=self.product.category, price=1)
+            for index in range(20)
+        ])
+        runner = BenchmarkRunner(host='testserver')
+        routes = {
+            route.name: route.path
+            for route in runner.read_routes(runner.get_samples(), self.client)
+        }
+        path = routes['product-list-cursor']
+        self.assertTrue(path.startswith('/api/products/?'), path)
+        self.assertIn('pagination=cursor', path)
+        self.assertIn('cursor=', path)
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.json()['previous'])
+
+    def test_next_and_previous(self):
+        expected = list(
+            Product.objects.order_by('-created_at', '-id').values_list('pk', flat=True)
+        )
+        pages, last = self.walk(
+            '/api/products/?pagination=cursor&page_size=3', 'next'
+        )
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+        back, _ = self.walk(last['previous'], 'previous')
+        self.assertEqual(back, pages[-2::-1])
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', 'eyJwIjpbMV19'):
+            response = self.client.get('/api/products/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 404)
+
+    def test_search_rejects_cursor(self):
+        response = self.client.get(
+            '/api/products/', {'search': 'товар', 'pagination': 'cursor'}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pagination', response.json())
+
+    def test_photos_and_tabs(self):
+        for order in (1, 0, 1, 0):
+            ProductPhoto.objects.create(
+                product=self.product, image=f'products/{order}.jpg', order=order
+            )
+            ProductTab.objects.create(
+                product=self.product, title=f'Вкладка {order}', order=order
+            )
+        ProductPhoto.objects.update(created_at=timezone.now())
+        ProductTab.objects.update(created_at=timezone.now())
+        for url, model in (
+            ('/api/product-photos/', ProductPhoto),
+            ('/api/product-tabs/', ProductTab),
+        ):
+            pages, _ = self.walk(
+                f'{url}?product={self.product.pk}&pagination=cursor&page_size=3',
+                'next',
+            )
+            self.assertEqual(sum(pages, []), list(
+                model.objects.order_by('order', 'created_at', 'id')
+                .values_list('pk', flat=True)
+            ))
+
+
+class MainPhotoTest(TestCase):
+    """У товара одно главное фото: новое главное заменяет прежнее"""
+
+    def test_replace_main_photo(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+        product = Product.objects.create(
+            name='Товар', category=Category.objects.create(name='Книги'),
+            price=100,
+        )
+        first = ProductPhoto.objects.create(
+            product=product, image='products/1.jpg', is_main=True
+        )
+        second = ProductPhoto.objects.create(
+            product=product, image='products/2.jpg', order=1
+        )
+
+        response = client.patch(
+            f'/api/product-photos/{second.pk}/', {'is_main': True},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(product.photos.filter(is_main=True)), [second]
+        )
+
+        client.post(f'/api/product-photos/{first.pk}/set_main/')
+        self.assertEqual(list(product.photos.filter(is_main=True)), [first])
+
+
+class ReorderTest(TestCase):
+    """Порядок фото и вкладок меняется одним запросом в пределах товара"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        category = Category.objects.create(name='Книги')
+        self.product = Product.objects.create(
+            name='Книга', category=category, price=1
+        )
+        self.other = Product.objects.create(
+            name='Другая', category=category, price=1
+        )
+        self.tabs = [
+            ProductTab.objects.create(
+                product=self.product, title=f'Вкладка {order}', order=order
+            )
+            for order in range(3)
+        ]
+        self.foreign = ProductTab.objects.create(
+            product=self.other, title='Чужая'
+        )
+
+    def reorder(self, orders, **data):
+        return self.client.post('/api/product-tabs/reorder/', {
+            'orders': [{'id': tab.pk, 'order': order} for tab, order in orders],
+            **data,
+        }, format='json')
+
+    def orders(self):
+        return list(
+            ProductTab.objects.order_by('pk').values_list('order', flat=True)
+        )
+
+    def test_reorder(self):
+        first, second, third = self.tabs
+        with CaptureQueriesContext(connection) as queries:
+            response = self.reorder(
+                [(first, 2), (second, 0), (third, 1)], product=self.product.pk
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.orders(), [2, 0, 1, 0])
+        updates = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('UPDATE "catalog_producttab"')
+        ]
+        self.assertEqual(len(updates), 1)
+
+    def test_rejects_items_of_other_products(self):
+        first, second, _ = self.tabs
+        response = self.reorder([(first, 1), (self.foreign, 0)])
+        self.assertEqual(response.status_code, 400)
+        # Все элементы одного товара, но не того, что указан в запросе
+        response = self.reorder(
+            [(first, 1), (second, 0)], product=self.other.pk
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.reorder(
+            [(first, 1), (self.foreign, 0)], product=self.product.pk
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.orders(), [0, 1, 2, 0])
+
+
+class ChunkedUploadTest(TestCase):
+    """Загрузка фото по частям с возобновлением и проверкой файла"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(
+            MEDIA_ROOT=directory.name,
+            CATALOG_UPLOAD_DIR=os.path.join(directory.name, 'uploads'),
+            CATALOG_UPLOAD_CHUNK_SIZE=64,
+        ))
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.product = Product.objects.create(
+            name='Товар', category=Category.objects.create(name='Книги'),
+            price=100,
+        )
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(buffer, 'PNG')
+        self.image = buffer.getvalue()
+
+    def start(self, data):
+        response = self.client.post('/api/product-photos/uploads/', {
+            'product': self.product.pk, 'filename': 'photo.png',
+            'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(),
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return f'/api/product-photos/uploads/{response.data["id"]}/'
+
+    def test_filename_validation(self):
+        data = {
+            'product': self.product.pk, 'size': len(self.image),
+            'sha256': hashlib.sha256(self.image).hexdigest(),
+        }
+        for filename in ('../../etc/photo.png', 'a\\b.png', '..', 'photo.svg'):
+            response = self.client.post('/api/product-photos/uploads/', {
+                **data, 'filename': filename,
+            }, format='json')
+            self.assertEqual(response.status_code, 400, filename)
+            self.assertIn('filename', response.json())
+
+        response = self.client.post('/api/product-photos/uploads/', {
+            **data, 'filename': 'фото товара (1).JPG',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['filename'], 'фото_товара_1.JPG')
+
+    def send(self, url, data, offset, **headers):
+        return self.client.patch(
+            url, data[offset:offset + 64],
+            content_type='application/octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset), **headers
+        )
+
+    def test_resume_and_complete(self):
+        url = self.start(self.image)
+        self.assertEqual(self.send(url, self.image, 0).data['offset'], 64)
+
+        # Повтор части, ответ на которую потерялся: сервер сообщает смещение
+        response = self.send(url, self.image, 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 64)
+        response = self.client.get(url)
+        self.assertEqual(response['Upload-Offset'], '64')
+
+        offset = 64
+        while offset < len(self.image):
+            offset = self.send(url, self.image, offset).data['offset']
+        response = self.client.post(f'{url}complete/')
+        self.assertEqual(response.status_code, 201)
+
+        photo = ProductPhoto.objects.get(pk=response.data['id'])
+        self.assertTrue(photo.is_main)
+        with photo.image.open('rb') as stored:
+            self.assertEqual(stored.read(), self.image)
+        self.assertFalse(PhotoUpload.objects.exists())
+        self.assertEqual(os.listdir(settings.CATALOG_UPLOAD_DIR), [])
+
+    def test_rejects_corrupted_data(self):
+        url = self.start(self.image)
+        response = self.send(
+            url, self.image, 0, HTTP_UPLOAD_CHECKSUM='sha256 ' + '0' * 64
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url).data['offset'], 0)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertEqual(os.listdir(settings.CATALOG_UPLOAD_DIR), [])
+
+        data = b'not an image'
+        url = self.start(data)
+        self.send(url, data, 0)
+        response = self.client.post(f'{url}complete/')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('изображением', response.data['error'])
+        self.assertFalse(ProductPhoto.objects.exists())
+
+    def test_purge_by_last_activity(self):
+        active = self.start(self.image)
+        self.send(active, self.image, 0)
+        abandoned = self.start(self.image)
+        self.send(abandoned, self.image, 0)
+        self.start(self.image)
+        PhotoUpload.objects.update(created_at=timezone.now() - timedelta(days=2))
+        old = time.time() - 2 * 24 * 3600
+        abandoned_id = abandoned.rstrip('/').rsplit('/', 1)[1]
+        os.utime(os.path.join(settings.CATALOG_UPLOAD_DIR, f'{abandoned_id}.part'), (old, old))
+
+        self.assertEqual(purge(timedelta(hours=24)), 2)
+        self.assertEqual(
+            [str(pk) for pk in PhotoUpload.objects.values_list('pk', flat=True)],
+            [active.rstrip('/').rsplit('/', 1)[1]],
+        )
+        self.assertEqual(self.send(active, self.image, 64).status_code, 200)
+        self.assertEqual(len(os.listdir(settings.CATALOG_UPLOAD_DIR)), 1)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class PhotoDerivativesTest(TestCase):
+    """Уменьшенные копии фото: построение, srcset и запись результата"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=directory.name))
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.product = Product.objects.create(
+            name='Товар', category=Category.objects.create(name='Книги'),
+            price=100,
+        )
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new('RGBA', (1800, 900), 'red').save(buffer, 'PNG')
+        self.name = default_storage.save(
+            'products/photo.png', ContentFile(buffer.getvalue())
+        )
+
+    def create_photo(self, **kwargs):
+        with mock.patch.object(image_pipeline, 'schedule') as schedule:
+            photo = ProductPhoto.objects.create(
+                product=self.product, image=self.name, **kwargs
+            )
+        schedule.assert_called_once_with(photo.pk, self.name)
+        return photo
+
+    def test_render_sizes_and_formats(self):
+        from PIL import Image
+
+        derivatives = render_derivatives(self.name)
+        self.assertEqual(derivatives['source'], self.name)
+        expected = {'thumbnail': (200, 100), 'card': (600, 300), 'zoom': (1600, 800)}
+        self.assertEqual(set(derivatives['sizes']), set(expected))
+        for size, formats in derivatives['sizes'].items():
+            self.assertEqual(formats, {
+                'webp': f'products/photo__{size}.webp',
+                'jpeg': f'products/photo__{size}.jpeg',
+            })
+            for extension, image_format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                with default_storage.open(formats[extension], 'rb') as fileobj:
+                    image = Image.open(fileobj)
+                    self.assertEqual(image.format, image_format)
+                    self.assertEqual(image.size, expected[size])
+
+    def test_srcset(self):
+        photo = self.create_photo(is_main=True)
+        store_derivatives(photo.pk, self.name, render_derivatives(self.name))
+        expected = {
+            size: {
+                extension: f'http://testserver/media/products/photo__{size}.{extension}'
+                for extension in ('webp', 'jpeg')
+            }
+            for size in ('thumbnail', 'card', 'zoom')
+        }
+        response = self.client.get(f'/api/product-photos/{photo.pk}/')
+        self.assertEqual(response.data['srcset'], expected)
+        for fast in (True, False):
+            with self.subTest(fast=fast), override_settings(CATALOG_FAST_LIST=fast):
+                response = self.client.get('/api/products/')
+                self.assertEqual(
+                    response.json()['results'][0]['main_photo_srcset'], expected
+                )
+
+    def test_pending_render_is_not_scheduled_again(self):
+        photo = self.create_photo()
+        self.assertEqual(photo.derivatives, {'pending': self.name})
+        photo.refresh_from_db()
+        self.assertEqual(photo.derivatives, {'pending': self.name})
+        self.assertEqual(
+            self.client.get(f'/api/product-photos/{photo.pk}/').data['srcset'], {}
+        )
+
+        with mock.patch.object(image_pipeline, 'schedule') as schedule:
+            photo.order = 1
+            photo.save()
+            self.client.patch(
+                f'/api/product-photos/{photo.pk}/', {'order': 2}, format='json'
+            )
+            schedule.assert_not_called()
+
+            photo.image = 'products/other.png'
+            photo.save()
+            schedule.assert_called_once_with(photo.pk, 'products/other.png')
+        self.assertEqual(photo.derivatives, {'pending': 'products/other.png'})
+
+    def test_store_discards_result_for_replaced_image(self):
+        photo = self.create_photo()
+        derivatives = render_derivatives(self.name)
+        ProductPhoto.objects.filter(pk=photo.pk).update(
+            image='products/other.png',
+            derivatives={'pending': 'products/other.png'},
+        )
+
+        store_derivatives(photo.pk, self.name, derivatives)
+        photo.refresh_from_db()
+        self.assertEqual(photo.derivatives, {'pending': 'products/other.png'})
+        for formats in derivatives['sizes'].values():
+            for path in formats.values():
+                self.assertFalse(default_storage.exists(path))
+
+    def test_failed_render_can_be_retried(self):
+        with mock.patch.object(image_pipeline, 'workers', 0):
+            with self.assertRaises(FileNotFoundError):
+                with self.captureOnCommitCallbacks(execute=True):
+                    photo = ProductPhoto.objects.create(
+                        product=self.product, image='products/missing.png'
+                    )
+        photo.refresh_from_db()
+        self.assertEqual(photo.derivatives, {})
+
+    def test_regenerate_keeps_bounded_window(self):
+        for _ in range(10):
+            ProductPhoto.objects.create(product=self.product, image=self.name)
+        stored = []
+
+        class Executor:
+            def __init__(self, **kwargs):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def submit(self, function, name):
+                future = Future()
+                future.set_result(function(name))
+                return future
+
+        def store(pk, name, derivatives):
+            stored.append(pk)
+
+        module = 'catalog.management.commands.regenerate_photo_derivatives'
+        window = []
+        with mock.patch(f'{module}.ProcessPoolExecutor', Executor), \
+                mock.patch(f'{module}.render_derivatives', lambda name: {}), \
+                mock.patch(f'{module}.store_derivatives', store), \
+                mock.patch(f'{module}.wait', lambda futures, **kwargs: (
+                    window.append(len(futures)) or ({next(iter(futures))}, set())
+                )):
+            call_command('regenerate_photo_derivatives', workers=1, stdout=StringIO())
+
+        self.assertEqual(sorted(stored), list(
+            ProductPhoto.objects.order_by('pk').values_list('pk', flat=True)
+        ))
+        self.assertEqual(max(window), TASKS_PER_WORKER)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class SparseFieldsetTest(TestCase):
+    """``?fields=``/``?expand=`` сокращают и ответ, и выборку"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        category = Category.objects.create(name='Электроника')
+        self.product = Product.objects.create(
+            name='Товар', description='Длинное описание',
+            category=category, price=1
+        )
+        ProductTab.objects.create(
+            product=self.product, title='Описание', content='Текст'
+        )
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        sql = ' '.join(query['sql'] for query in context.captured_queries)
+        return response, sql
+
+    def test_detail_fields(self):
+        response, sql = self.get(
+            f'/api/products/{self.product.pk}/?fields=id,name,tabs.title'
+        )
+        self.assertEqual(response.json(), {
+            'id': self.product.pk, 'name': 'Товар',
+            'tabs': [{'title': 'Описание'}],
+        })
+        self.assertNotIn('description', sql)
+        self.assertNotIn('content', sql)
+        self.assertNotIn('catalog_productphoto', sql)
+
+    def test_list_expand(self):
+        response, _ = self.get('/api/products/?expand=tabs')
+        item = response.json()['results'][0]
+        self.assertEqual(item['tabs'][0]['content'], 'Текст')
+        self.assertNotIn('description', item)
+
+        response, sql = self.get('/api/products/')
+        self.assertNotIn('tabs', response.json()['results'][0])
+        self.assertNotIn('description', sql)
+
+    def test_unknown_field(self):
+        response, _ = self.get('/api/products/?fields=id,secret')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('secret', response.json()['fields'])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class AsyncReadTest(TransactionTestCase):
+    """Асинхронное чтение отдает те же ответы, что и синхронное"""
+    # Чтение идет и с реплик, если они настроены
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('admin', is_staff=True)
+        self.root = Category.objects.create(name='Электроника')
+        self.category = Category.objects.create(
+            name='Смартфоны', parent=self.root
+        )
+        color = Filter.objects.create(name='Цвет', category=self.category)
+        value = FilterValue.objects.create(filter=color, value='Черный')
+        for index in range(3):
+            product = Product.objects.create(
+                name=f'Товар {index}', category=self.category, price=100
+            )
+            product.filter_values.add(value)
+            # bulk_create: без построения уменьшенных копий после коммита
+            ProductPhoto.objects.bulk_create([ProductPhoto(
+                product=product, image=f'products/{index}.jpg', is_main=True
+            )])
+            ProductTab.objects.create(
+                product=product, title='Описание', content='Текст'
+            )
+        self.product = product
+        self.sync_views = {item.name: item.callback for item in router.urls}
+        self.async_views = {
+            item.name: item.callback for item in async_patterns(router.urls)
+        }
+
+    def get(self, view, url, **kwargs):
+        request = APIRequestFactory().get(url)
+        force_authenticate(request, self.user)
+        response = view(request, **kwargs)
+        response.render()
+        return response
+
+    def assertSameResponse(self, name, url, **kwargs):
+        expected = self.get(self.sync_views[name], url, **kwargs)
+        actual = self.get(async_to_sync(self.async_views[name]), url, **kwargs)
+        self.assertEqual(actual.status_code, expected.status_code)
+        self.assertEqual(actual.content, expected.content)
+        self.assertEqual(actual.get('ETag'), expected.get('ETag'))
+
+    def test_same_responses(self):
+        pk = str(self.product.pk)
+        for parallel in (True, False):
+            with self.subTest(parallel=parallel), self.settings(
+                CATALOG_ASYNC_PARALLEL_QUERIES=parallel
+            ):
+                self.assertSameResponse('product-list', '/api/products/')
+                self.assertSameResponse(
+                    'product-list', '/api/products/?pagination=cursor&page_size=2'
+                )
+                self.assertSameResponse('product-list', '/api/products/?page=5')
+                self.assertSameResponse(
+                    'product-detail', f'/api/products/{pk}/', pk=pk
+                )
+                self.assertSameResponse(
+                    'product-detail', '/api/products/0/', pk='0'
+                )
+                self.assertSameResponse(
+                    'category-detail', f'/api/categories/{self.root.pk}/',
+                    pk=str(self.root.pk)
+                )
+                self.assertSameResponse('category-tree', '/api/categories/tree/')
+                self.assertSameResponse('filter-list', '/api/filters/')
+                self.assertSameResponse(
+                    'product-detail', f'/api/products/{pk}/?fields=id,tabs.title',
+                    pk=pk
+                )
+                self.assertSameResponse(
+                    'category-detail',
+                    f'/api/categories/{self.root.pk}/?fields=id,name',
+                    pk=str(self.root.pk)
+                )
+
+
+class PoolMetricsTest(TestCase):
+    """Статистика пулов соединений воркеров суммируется в /metrics"""
+
+    def test_pools_are_summed(self):
+        stats = {
+            'pool_max': 10, 'pool_size': 4, 'pool_available': 1, 'in_use': 3,
+            'requests_waiting': 2, 'requests_num': 50,
+            'requests_wait_ms': 1500,
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            registry = MetricsRegistry(directory)
+            snapshot = {
+                'routes': {}, 'pools': {'default': stats},
+                'flushed_at': time.time(),
+            }
+            for pid in (1, 2):
+                with open(registry.snapshot_path(pid), 'w') as fileobj:
+                    json.dump(snapshot, fileobj)
+            with mock.patch('catalog.metrics.is_alive', return_value=True):
+                routes, pools = registry.collect()
+
+        self.assertEqual(routes, {})
+        text = render_prometheus(routes, pools)
+        self.assertIn('catalog_db_pool_in_use{db="default"} 6\n', text)
+        self.assertIn('catalog_db_pool_requests_waiting{db="default"} 4\n', text)
+        self.assertIn('catalog_db_pool_wait_seconds_total{db="default"} 3.000\n', text)
+        # Без пула (SQLite в тестах) метрик пула нет
+        self.assertNotIn('catalog_db_pool', render_prometheus(*MetricsRegistry().collect()))
+
+    def test_totals_survive_worker_exit(self):
+        stats = {'pool_size': 4, 'pool_available': 1, 'in_use': 3, 'requests_num': 50}
+        worker = MetricsRegistry()
+        worker.observe('product-list', 'GET', 200, {'duration': 0.01}, 2)
+        snapshot = {
+            **worker.snapshot(), 'pools': {'default': stats},
+            'flushed_at': time.time(),
+        }
+
+        def totals(registry):
+            routes, pools = registry.collect()
+            return routes[('product-list', 'GET')].statuses, pools
+
+        with tempfile.TemporaryDirectory() as directory:
+            registry = MetricsRegistry(directory, flush_interval=5)
+            # Два воркера этого хоста и один воркер другого контейнера
+            for path in (
+                registry.snapshot_path(101), registry.snapshot_path(102),
+                registry.snapshot_path(101, host='other-host'),
+            ):
+                with open(path, 'w') as fileobj:
+                    json.dump(snapshot, fileobj)
+            with mock.patch('catalog.metrics.is_alive', return_value=True):
+                statuses, pools = totals(registry)
+            self.assertEqual(statuses, {'200': 3})
+            self.assertEqual(pools['default']['requests_num'], 150)
+            self.assertEqual(pools['default']['in_use'], 9)
+
+            # Воркер 101 этого хоста завершился: счетчики не уменьшаются,
+            # а его gauges пула больше не учитываются
+            def is_alive(pid):
+                return pid != 101
+
+            with mock.patch('catalog.metrics.is_alive', side_effect=is_alive):
+                for _ in range(2):
+                    statuses, pools = totals(registry)
+                    self.assertEqual(statuses, {'200': 3})
+                    self.assertEqual(pools['default']['requests_num'], 150)
+                    self.assertEqual(pools['default']['in_use'], 6)
+            self.assertFalse(os.path.exists(registry.snapshot_path(101)))
+            self.assertTrue(
+                os.path.exists(registry.snapshot_path(101, host='other-host'))
+            )
+
+    def test_stale_snapshot_keeps_counters(self):
+        stats = {'pool_size': 4, 'pool_available': 1, 'in_use': 3, 'requests_num': 50}
+        with tempfile.TemporaryDirectory() as directory:
+            registry = MetricsRegistry(directory, flush_interval=5)
+            with open(registry.snapshot_path(1, host='other-host'), 'w') as fileobj:
+                json.dump({
+                    'routes': {}, 'pools': {'default': stats},
+                    'flushed_at': time.time() - 60,
+                }, fileobj)
+            routes, pools = registry.collect()
+        self.assertEqual(pools, {'default': {'requests_num': 50}})
+
+    def test_token_required_in_production(self):
+        with override_settings(DEBUG=False, CATALOG_METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with override_settings(DEBUG=False, CATALOG_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            response = self.client.get(
+                '/metrics', HTTP_AUTHORIZATION='Bearer secret'
+            )
+            self.assertEqual(response.status_code, 200)
+
+
+@skipUnless(
+    settings.CATALOG_DB_REPLICAS,
+    'нужна реплика: DB_REPLICA_HOSTS (например, localhost)'
+)
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ReplicaRoutingTest(TransactionTestCase):
+    """Чтение - с реплики, после записи и в транзакции - с основной БД"""
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.replica = settings.CATALOG_DB_REPLICAS[0]
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user('admin', is_staff=True)
+        )
+        self.product = Product.objects.create(
+            name='Товар', category=Category.objects.create(name='Книги'),
+            price=100,
+        )
+
+    def request(self, method, url):
+        """Ответ и количество SQL-запросов к основной БД и к реплике"""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections[self.replica]) as replica:
+            response = getattr(self.client, method)(url)
+        self.assertEqual(response.status_code, 200)
+        return len(primary), len(replica)
+
+    def test_read_your_writes(self):
+        url = f'/api/products/{self.product.pk}/'
+        with override_settings(CATALOG_DB_REPLICAS=[self.replica]):
+            primary, replica = self.request('get', url)
+            self.assertEqual(primary, 0)
+            self.assertGreater(replica, 0)
+
+            self.request('post', f'{url}toggle_active/')
+            primary, replica = self.request('get', url)
+            self.assertGreater(primary, 0)
+            self.assertEqual(replica, 0)
+
+            # Окно CATALOG_REPLICA_PIN_SECONDS истекло
+            cache.clear()
+            primary, replica = self.request('get', url)
+            self.assertEqual(primary, 0)
+
+    def test_transaction_reads_primary(self):
+        token = read_alias.set(self.replica)
+        try:
+            with CaptureQueriesContext(connections[self.replica]) as replica:
+                with transaction.atomic():
+                    Product.objects.count()
+                self.assertEqual(len(replica), 0)
+                Product.objects.count()
+                self.assertEqual(len(replica), 1)
+        finally:
+            read_alias.reset(token)
@@ -0,0 +1,273 @@
+"""
+Загрузка фото товара по частям с возобновлением.
+
+Протокол (``ProductPhotoViewSet``):
+
+1. ``POST uploads/`` с товаром, именем файла, размером и SHA-256 файла
+   создает ``PhotoUpload``;
+2. ``PATCH uploads/<id>/`` с телом-частью и заголовком ``Upload-Offset``
+   (сколько байт уже принято) дописывает часть. Тело читается из потока
+   запроса блоками ``BLOCK_SIZE`` прямо в ``CATALOG_UPLOAD_DIR/<id>.part``
+   и не собирается в памяти. Необязательный заголовок
+   ``Upload-Checksum: sha256 <hex>`` проверяет саму часть: при
+   несовпадении она отбрасывается;
+3. после обрыва ``GET``/``HEAD uploads/<id>/`` возвращает принятое
+   смещение, и клиент продолжает с него;
+4. ``POST uploads/<id>/complete/`` сверяет размер и SHA-256 файла,
+   проверяет по заголовку файла формат и разрешение изображения (без
+   декодирования пикселей), сохраняет файл в хранилище медиа и создает
+   ``ProductPhoto`` в одной транзакции с удалением загрузки.
+
+Запросы к одной загрузке сериализуются блокировкой ``flock`` на ее
+файле: параллельный запрос получает 409. Разные загрузки, в том числе
+одного товара, идут параллельно; порядок фото назначается при
+завершении под блокировкой товара. Брошенные загрузки (без новых частей
+дольше заданного времени) удаляет команда ``purge_photo_uploads``.
+"""
+import fcntl
+import hashlib
+import os
+import re
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+
+from .models import PhotoUpload, ProductPhoto
+
+BLOCK_SIZE = 64 * 1024
+
+# Форматы, которые принимает пайплайн уменьшенных копий (catalog.images)
+IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+
+# Расширения имени файла для этих форматов
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+# Больше не принимаем: копии строятся из полностью декодированного оригинала
+MAX_PIXELS = 40 * 1000 * 1000
+
+CHECKSUM_RE = re.compile(r'sha256\s+([0-9a-fA-F]{64})')
+
+
+class UploadError(Exception):
+    """Ошибка загрузки; ``offset`` - принятое смещение для продолжения"""
+
+    def __init__(self, message, status_code=status.HTTP_400_BAD_REQUEST,
+                 offset=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.offset = offset
+
+
+def part_path(upload):
+    return os.path.join(settings.CATALOG_UPLOAD_DIR, f'{upload.pk}.part')
+
+
+def get_offset(upload):
+    """Сколько байт загрузки уже принято"""
+    try:
+        return os.path.getsize(part_path(upload))
+    except FileNotFoundError:
+        return 0
+
+
+@contextmanager
+def locked(upload):
+    """Файл загрузки, открытый на дозапись, под исключительной блокировкой"""
+    os.makedirs(settings.CATALOG_UPLOAD_DIR, exist_ok=True)
+    with open(part_path(upload), 'ab') as fileobj:
+        try:
+            fcntl.flock(fileobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError(
+                'Загрузка занята другим запросом, повторите позже',
+                status.HTTP_409_CONFLICT,
+            )
+        yield fileobj
+
+
+def parse_int_header(value, name):
+    if value is None or not value.isdigit():
+        raise UploadError(f'Требуется заголовок {name} (целое число байт)')
+    return int(value)
+
+
+def receive_chunk(upload, request):
+    """Дописать часть из тела запроса; возвращает новое смещение
+
+    Байты, принятые до обрыва соединения, сохраняются, и клиент
+    продолжает с нового смещения. Часть с ``Upload-Checksum`` принимается
+    только целиком.
+    """
+    offset = parse_int_header(request.headers.get('Upload-Offset'), 'Upload-Offset')
+    length = parse_int_header(request.headers.get('Content-Length'), 'Content-Length')
+    if not 0 < length <= settings.CATALOG_UPLOAD_CHUNK_SIZE:
+        raise UploadError(
+            f'Размер части должен быть от 1 до '
+            f'{settings.CATALOG_UPLOAD_CHUNK_SIZE} байт'
+        )
+    checksum = request.headers.get('Upload-Checksum')
+    if checksum is not None:
+        match = CHECKSUM_RE.fullmatch(checksum.strip())
+        if match is None:
+            raise UploadError('Заголовок Upload-Checksum: sha256 <hex>')
+        checksum = match.group(1).lower()
+
+    with locked(upload) as fileobj:
+        current = os.fstat(fileobj.fileno()).st_size
+        if offset != current:
+            raise UploadError(
+                'Смещение не совпадает с принятым',
+                status.HTTP_409_CONFLICT, offset=current,
+            )
+        if current + length > upload.size:
+            raise UploadError(
+                'Часть выходит за объявленный размер файла', offset=current
+            )
+
+        digest = hashlib.sha256()
+        remaining = length
+        try:
+            while remaining:
+                block = request.stream.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                fileobj.write(block)
+                digest.update(block)
+                remaining -= len(block)
+        finally:
+            if checksum is not None and remaining:
+                fileobj.truncate(current)
+
+        if remaining:
+            received = current if checksum is not None else fileobj.tell()
+            raise UploadError('Часть получена не полностью', offset=received)
+        if checksum is not None and digest.hexdigest() != checksum:
+            fileobj.truncate(current)
+            raise UploadError(
+                'Контрольная сумма части не совпадает', offset=current
+            )
+        return fileobj.tell()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def check_image(path):
+    """Проверить формат и разрешение по заголовку файла
+
+    ``Image.open`` читает только заголовок; пиксели не декодируются.
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            image_format, (width, height) = image.format, image.size
+    except (OSError, Image.DecompressionBombError):
+        raise UploadError('Файл не является изображением')
+    if image_format not in IMAGE_FORMATS:
+        raise UploadError('Поддерживаются изображения JPEG, PNG, WebP и GIF')
+    if width * height > MAX_PIXELS:
+        raise UploadError(
+            f'Разрешение изображения не должно превышать '
+            f'{MAX_PIXELS // 1000000} Мп'
+        )
+
+
+def complete(upload, create_photo):
+    """Проверить собранный файл, сохранить его в хранилище и создать фото
+
+    ``create_photo(name)`` создает ``ProductPhoto`` с изображением
+    ``name``; вызывается в транзакции вместе с удалением загрузки. Если
+    фото создать не удалось, файл удаляется из хранилища.
+    """
+    path = part_path(upload)
+    with locked(upload) as fileobj:
+        size = os.fstat(fileobj.fileno()).st_size
+        if size != upload.size:
+            raise UploadError(
+                'Файл загружен не полностью',
+                status.HTTP_409_CONFLICT, offset=size,
+            )
+        if file_sha256(path) != upload.sha256:
+            # Где испорчены данные, неизвестно: загрузка начинается заново
+            fileobj.truncate(0)
+            raise UploadError(
+                'Контрольная сумма файла не совпадает, загрузите файл заново',
+                offset=0,
+            )
+        check_image(path)
+
+        field = ProductPhoto._meta.get_field('image')
+        with open(path, 'rb') as source:
+            name = field.storage.save(
+                field.generate_filename(None, upload.filename), File(source)
+            )
+        try:
+            with transaction.atomic():
+                photo = create_photo(name)
+                upload.delete()
+        except Exception:
+            field.storage.delete(name)
+            raise
+        os.remove(path)
+    return photo
+
+
+def discard(upload):
+    """Отменить загрузку и удалить принятые байты"""
+    path = part_path(upload)
+    with locked(upload):
+        upload.delete()
+        os.remove(path)
+
+
+def purge(max_age):
+    """Удалить загрузки без активности дольше ``max_age`` и файлы без загрузки
+
+    Последняя активность - время изменения файла ``.part`` (его обновляет
+    каждая принятая часть), а до первой части - создание загрузки, поэтому
+    давно начатая, но продолжающаяся загрузка не удаляется. Возвращает
+    количество удаленных загрузок. Загрузка, часть которой принимается
+    прямо сейчас, пропускается.
+    """
+    idle_since = timezone.now() - max_age
+    expired = PhotoUpload.objects.filter(created_at__lt=idle_since)
+    count = 0
+    for upload in expired.iterator():
+        path = part_path(upload)
+        try:
+            with locked(upload) as fileobj:
+                # Пустой файл мог только что создать сам locked()
+                stat = os.fstat(fileobj.fileno())
+                if stat.st_size and stat.st_mtime >= idle_since.timestamp():
+                    continue
+                upload.delete()
+                os.remove(path)
+        except UploadError:
+            continue
+        count += 1
+    if not os.path.isdir(settings.CATALOG_UPLOAD_DIR):
+        return count
+
+    # Файлы загрузок, удаленных вместе с товаром. Свежие не трогаем:
+    # загрузка могла быть создана после выборки id
+    known = {
+        str(pk) for pk in PhotoUpload.objects.values_list('pk', flat=True)
+    }
+    stale_before = (timezone.now() - timedelta(hours=1)).timestamp()
+    for entry in os.scandir(settings.CATALOG_UPLOAD_DIR):
+        upload_id, ext = os.path.splitext(entry.name)
+        if ext == '.part' and upload_id not in known:
+            if entry.stat().st_mtime < stale_before:
+                os.remove(entry.path)
+    return count
@@ -1,11 +1,13 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework.authtoken.views import obtain_auth_token
 from .views import (
     CategoryViewSet, ProductViewSet, ProductPhotoViewSet,
     ProductTabViewSet, FilterViewSet, FilterValueViewSet,
-    CustomAuthToken
+    CustomAuthToken, CacheStatsView
 )
+from .async_views import async_patterns
 
 router = DefaultRouter()
 router.register(r'categories', CategoryViewSet, basename='category')
@@ -15,8 +17,14 @@ router.register(r'product-tabs', ProductTabViewSet, basename='product-tab')
 router.register(r'filters', FilterViewSet, basename='filter')
 router.register(r'filter-values', FilterValueViewSet, basename='filter-value')
 
+router_urls = router.urls
+if settings.CATALOG_ASYNC_VIEWS:
+    # Под ASGI чтение каталога выполняется асинхронно
+    router_urls = async_patterns(router_urls)
+
 urlpatterns = [
-    path('', include(router.urls)),
+    path('', include(router_urls)),
     path('auth/login/', CustomAuthToken.as_view(), name='api_login'),
+    path('cache/stats/', CacheStatsView.as_view(), name='cache_stats'),
 ]
 
@@ -1,23 +1,54 @@
+import hmac
+
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import transaction
-from django.db.models import Max
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.db.models import (
+    Case, IntegerField, Max, Prefetch, Subquery, Value, When
+)
+from django.db.models.query import normalize_prefetch_lookups
 from .models import (
     Category, Product, ProductPhoto, ProductTab,
-    Filter, FilterValue
+    Filter, FilterValue, PhotoUpload
 )
 from .serializers import (
-    CategorySerializer, CategoryListSerializer,
+    CategorySerializer, CategoryListSerializer, CategoryTreeSerializer,
     ProductSerializer, ProductListSerializer,
-    ProductPhotoSerializer, ProductTabSerializer,
+    ProductPhotoSerializer, ProductTabSerializer, PhotoUploadSerializer,
     FilterSerializer, FilterValueSerializer,
-    UserSerializer
+    UserSerializer, ReorderSerializer, SubtreeActiveSerializer,
+    SubtreeRepriceSerializer, group_by_parent
+)
+from . import exporters
+from .batch import ProductBatch
+from .fastlist import CategoryRowSerializer, ProductRowSerializer
+from .importers import FORMATS, ProductImporter, detect_format
+from .pagination import (
+    KeysetPaginationMixin, OrderedKeysetPagination, apaginate
 )
+from .metrics import registry as metrics_registry, render_prometheus
+from .replicas import ReplicaReadMixin
+from .search import search_products
 from .permissions import IsAdminUser
+from . import facets
+from . import fieldsets
+from . import async_db
+from . import caching
+from . import uploads
+from .caching import acached_response, cached_response
+from .conditional import ConditionalMixin, aconditional, conditional
 
 
 class CustomAuthToken(ObtainAuthToken):
@@ -45,16 +76,189 @@ class CustomAuthToken(ObtainAuthToken):
         })
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CatalogReadMixin(ReplicaReadMixin, ConditionalMixin):
+    """Кэширование и условные запросы для ``list``/``retrieve``/``update``
+
+    См. ``catalog.caching`` и ``catalog.conditional``; чтение идет с
+    реплик БД, если они настроены (``catalog.replicas``). Методы ``alist``,
+    ``aretrieve`` - асинхронные версии чтения для ASGI
+    (``catalog.async_views``); запросы с параметрами из
+    ``async_unsupported_params`` обрабатываются синхронно.
+
+    Действия чтения из ``fieldset_actions`` поддерживают ``?fields=`` и
+    ``?expand=`` (см. ``catalog.fieldsets``). Если задан
+    ``row_serializer_class``, ``list`` строит ответ из ``.values()`` без
+    экземпляров моделей (см. ``catalog.fastlist``).
+    """
+    async_unsupported_params = ()
+    fieldset_actions = ('list', 'retrieve')
+    row_serializer_class = None
+
+    def get_fieldset(self):
+        """Выбранные поля ответа или ``None``, если действие их не поддерживает"""
+        if (
+            self.request.method not in ('GET', 'HEAD') or
+            self.action not in self.fieldset_actions
+        ):
+            return None
+        return fieldsets.Fieldset.from_request(self.request)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        fieldset = self.get_fieldset()
+        if fieldset is not None:
+            context['fieldset'] = fieldset
+        return context
+
+    def get_row_serializer(self):
+        """Сериализатор строк списка или ``None`` для обычной сериализации"""
+        if self.row_serializer_class is None or not settings.CATALOG_FAST_LIST:
+            return None
+        # Поля курсора нужны пагинации, даже если не выводятся
+        ordering = getattr(self.paginator, 'ordering', ())
+        return self.row_serializer_class.for_serializer(
+            self.get_serializer(),
+            keep=[field.lstrip('-') for field in ordering],
+        )
+
+    @conditional
+    @cached_response
+    def list(self, request, *args, **kwargs):
+        rows = self.get_row_serializer()
+        if rows is None:
+            return super().list(request, *args, **kwargs)
+        queryset = rows.prepare(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(rows.to_representation(page))
+        return Response(rows.to_representation(queryset))
+
+    @conditional
+    @cached_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @conditional
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
+
+    @aconditional
+    @acached_response
+    async def alist(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = await self.apaginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(
+            await async_db.fetch(queryset), many=True
+        )
+        return Response(serializer.data)
+
+    @aconditional
+    @acached_response
+    async def aretrieve(self, request, *args, **kwargs):
+        instance = await self.aget_object()
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
+    async def apaginate_queryset(self, queryset):
+        if self.paginator is None:
+            return None
+        return await apaginate(self.paginator, queryset, self.request, self)
+
+    async def aget_object(self):
+        """Асинхронный ``get_object`` (с теми же ответами 404)"""
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            instance = await queryset.aget(**{
+                self.lookup_field: self.kwargs[lookup_url_kwarg]
+            })
+        except queryset.model.DoesNotExist:
+            raise Http404(
+                f'No {queryset.model._meta.object_name} matches the given query.'
+            )
+        except (TypeError, ValueError, DjangoValidationError):
+            raise Http404
+        self.check_object_permissions(self.request, instance)
+        return instance
+
+
+class CategoryViewSet(CatalogReadMixin, viewsets.ModelViewSet):
     """ViewSet для категорий"""
     queryset = Category.objects.all()
     permission_classes = [IsAdminUser]
+    modified_fields = ('updated_at',)
+    fieldset_actions = ('list', 'retrieve', 'tree')
+    row_serializer_class = CategoryRowSerializer
+
+    def get_queryset(self):
+        queryset = Category.objects.all()
+        if self.get_fieldset() is not None:
+            queryset = fieldsets.apply(queryset, self.get_serializer())
+        return queryset
+
+    def get_validator_queryset(self):
+        if not self.detail:
+            return super().get_validator_queryset()
+        # В деталях выводятся и подкатегории: валидатор по всему поддереву
+        path = Category.objects.filter(pk=self.kwargs['pk']).values('path')
+        return Category.objects.filter(path__startswith=Subquery(path[:1]))
 
     def get_serializer_class(self):
         if self.action == 'list':
             return CategoryListSerializer
+        if self.action == 'tree':
+            return CategoryTreeSerializer
         return CategorySerializer
 
+    @action(detail=False, methods=['get'])
+    @conditional
+    @cached_response
+    def tree(self, request):
+        """Полное дерево категорий с количеством товаров одним запросом"""
+        return self.build_tree(list(self.get_tree_queryset(request)))
+
+    @aconditional
+    @acached_response
+    async def atree(self, request):
+        categories = await async_db.fetch(self.get_tree_queryset(request))
+        return self.build_tree(categories)
+
+    def get_tree_queryset(self, request):
+        queryset = Category.objects.order_by('name')
+        is_active = request.query_params.get('is_active', None)
+        if is_active is not None and is_active.lower() == 'true':
+            # Неактивные ветки отсекаются целиком: их потомки
+            # недостижимы от корней при сборке дерева
+            queryset = queryset.filter(is_active=True)
+        # Дерево собирается по parent_id, даже если parent не выводится
+        return fieldsets.apply(queryset, self.get_serializer(), keep=('parent',))
+
+    def build_tree(self, categories):
+        children_map = group_by_parent(categories)
+        context = self.get_serializer_context()
+        context['children_map'] = children_map
+        serializer = self.get_serializer(
+            children_map.get(None, []), many=True, context=context
+        )
+        return Response(serializer.data)
+
+    @aconditional
+    @acached_response
+    async def aretrieve(self, request, *args, **kwargs):
+        category = await self.aget_object()
+        serializer = self.get_serializer(category)
+        if 'children' in serializer.fields:
+            # Поддерево выбирается заранее: из async-кода сериализатор
+            # не может сам обращаться к БД
+            descendants = await async_db.fetch(
+                category.get_descendants().filter(is_active=True)
+            )
+            serializer.context['children_map'] = group_by_parent(descendants)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def toggle_active(self, request, pk=None):
         """Включить/выключить категорию"""
@@ -64,22 +268,57 @@ class CategoryViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(category)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['post'])
+    def set_active(self, request, pk=None):
+        """Включить/выключить категорию с подкатегориями и их товарами
+
+        Body: ``{"is_active": false, "include_products": true, "dry_run": false}``.
+        Ответ - количество измененных категорий и товаров.
+        """
+        serializer = SubtreeActiveSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        category = self.get_object()
+        result = category.set_subtree_active(**serializer.validated_data)
+        return Response({**result, 'dry_run': serializer.validated_data['dry_run']})
+
+    @action(detail=True, methods=['post'])
+    def reprice(self, request, pk=None):
+        """Изменить цены товаров категории и подкатегорий
+
+        Body: ``{"percent": -10}`` или ``{"amount": "100.00"}``, а также
+        ``move_to_old_price``, ``only_active`` и ``dry_run``.
+        """
+        serializer = SubtreeRepriceSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        category = self.get_object()
+        try:
+            result = category.reprice_products(**serializer.validated_data)
+        except DjangoValidationError as error:
+            return Response(
+                {'error': error.messages[0]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({**result, 'dry_run': serializer.validated_data['dry_run']})
+
 
-class FilterViewSet(viewsets.ModelViewSet):
+class FilterViewSet(CatalogReadMixin, viewsets.ModelViewSet):
     """ViewSet для фильтров"""
     queryset = Filter.objects.all()
     serializer_class = FilterSerializer
     permission_classes = [IsAdminUser]
 
     def get_queryset(self):
-        queryset = Filter.objects.all()
+        if self.get_fieldset() is not None:
+            queryset = fieldsets.apply(Filter.objects.all(), self.get_serializer())
+        else:
+            queryset = Filter.objects.prefetch_related('values')
         category_id = self.request.query_params.get('category', None)
         if category_id:
             queryset = queryset.filter(category_id=category_id)
         return queryset
 
 
-class FilterValueViewSet(viewsets.ModelViewSet):
+class FilterValueViewSet(CatalogReadMixin, viewsets.ModelViewSet):
     """ViewSet для значений фильтров"""
     queryset = FilterValue.objects.all()
     serializer_class = FilterValueSerializer
@@ -93,10 +332,18 @@ class FilterValueViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(CatalogReadMixin, KeysetPaginationMixin,
+                     viewsets.ModelViewSet):
     """ViewSet для товаров"""
     queryset = Product.objects.all()
     permission_classes = [IsAdminUser]
+    # Название категории входит в ответ
+    modified_fields = ('updated_at', 'category__updated_at')
+    # Фасеты и поиск обращаются к индексам синхронно
+    async_unsupported_params = ('fv', 'facets', 'search')
+    # Сортировка по релевантности не выражается ключом курсора
+    keyset_unsupported_params = ('search',)
+    row_serializer_class = ProductRowSerializer
 
     def get_serializer_class(self):
         if self.action == 'list':
@@ -104,9 +351,29 @@ class ProductViewSet(viewsets.ModelViewSet):
         return ProductSerializer
 
     def get_queryset(self):
-        queryset = Product.objects.select_related('category').prefetch_related(
-            'photos', 'tabs', 'filter_values'
+        queryset = Product.objects.select_related('category').defer(
+            'search_vector'
         )
+        if self.get_fieldset() is not None:
+            # Только столбцы и связи выводимых полей; created_at нужен
+            # курсорной пагинации
+            serializer = self.get_serializer()
+            queryset = fieldsets.apply(
+                queryset, serializer, keep=('created_at',)
+            )
+            if {'main_photo', 'main_photo_srcset'} & set(serializer.fields):
+                # Для списка нужно только главное фото - отдельный prefetch
+                queryset = queryset.prefetch_related(Prefetch(
+                    'photos',
+                    queryset=ProductPhoto.objects.filter(is_main=True).only(
+                        'id', 'product', 'image', 'derivatives'
+                    ),
+                    to_attr='main_photos'
+                ))
+        else:
+            queryset = queryset.prefetch_related(
+                'photos', 'tabs', 'filter_values'
+            )
         category_id = self.request.query_params.get('category', None)
         is_active = self.request.query_params.get('is_active', None)
         
@@ -114,9 +381,215 @@ class ProductViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(category_id=category_id)
         if is_active is not None:
             queryset = queryset.filter(is_active=is_active.lower() == 'true')
+
+        if self.action == 'list':
+            queryset = self.filter_by_values(queryset, category_id, is_active)
+
+        search = self.request.query_params.get('search', None)
+        if search:
+            # Результаты упорядочены по релевантности
+            queryset = search_products(queryset, search)
         
         return queryset
 
+    def get_filter_value_ids(self):
+        """Разобрать ``?fv=1,2&fv=3`` в множество id значений фильтров"""
+        value_ids = set()
+        for raw in self.request.query_params.getlist('fv'):
+            for part in raw.split(','):
+                part = part.strip()
+                if not part:
+                    continue
+                if not part.isdigit():
+                    raise ValidationError(
+                        {'fv': 'Ожидается список id значений фильтров'}
+                    )
+                value_ids.add(int(part))
+        return value_ids
+
+    def filter_by_values(self, queryset, category_id, is_active):
+        """Фильтрация по значениям фильтров с подсчетом фасетов
+
+        Внутри одного фильтра значения объединяются по ИЛИ, между
+        фильтрами - по И. Если указана категория, выборка и фасеты
+        считаются по битовому индексу ее товаров в памяти, иначе - в SQL.
+        """
+        self.facets = None
+        value_ids = self.get_filter_value_ids()
+        want_facets = self.request.query_params.get('facets', '') == 'true'
+        if not value_ids and not want_facets:
+            return queryset
+
+        selected = facets.resolve_filters(value_ids)
+        # Несуществующее значение фильтра: не подходит ни один товар
+        unknown = len(selected) < len(value_ids)
+        if not category_id:
+            if want_facets:
+                self.facets = facets.build_facets(
+                    facets.count_values(queryset, selected), selected
+                )
+            if unknown:
+                return queryset.none()
+            return facets.filter_queryset(queryset, selected)
+
+        if not category_id.isdigit():
+            raise ValidationError({'category': 'Ожидается id категории'})
+        index = facets.registry.get(int(category_id))
+        if index is None:
+            return queryset.none()
+        if is_active is not None:
+            is_active = is_active.lower() == 'true'
+        result, counts = index.search(selected, is_active=is_active)
+        self.facets = facets.build_facets(counts, selected)
+        if unknown:
+            return queryset.none()
+        if not selected:
+            # Категория и активность уже в условиях запроса
+            return queryset
+        if result.bit_count() > facets.MAX_ID_LIST:
+            return facets.filter_queryset(queryset, selected)
+        return queryset.filter(pk__in=index.bits_to_ids(result))
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if getattr(self, 'facets', None) is not None:
+            response.data['facets'] = self.facets
+        return response
+
+    def get_validators(self, request):
+        # Названия фильтров и значений в фасетах не отслеживаются по updated_at
+        if request.query_params.get('facets', '') == 'true':
+            return None, None
+        return super().get_validators(request)
+
+    async def aget_object(self):
+        """Товар, его фото, вкладки и значения фильтров - одновременно
+
+        Связанные выборки не зависят от строки товара (только от id),
+        поэтому вместо последовательного ``prefetch_related`` все запросы
+        (только для выводимых связей) идут к БД параллельно.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        lookups = normalize_prefetch_lookups(queryset._prefetch_related_lookups)
+        queryset = queryset.prefetch_related(None)
+        pk = self.kwargs['pk']
+        names = [lookup.prefetch_to for lookup in lookups]
+        try:
+            stub = Product(pk=pk)
+            related = []
+            for lookup in lookups:
+                manager = getattr(stub, lookup.prefetch_to)
+                # Так же prefetch_related применяет Prefetch.queryset
+                # к связанному менеджеру
+                related.append(
+                    manager.all() if lookup.queryset is None
+                    else manager._apply_rel_filters(lookup.queryset)
+                )
+            products, *objects = await async_db.gather(
+                async_db.fetch(queryset.filter(pk=pk)),
+                *(async_db.fetch(items) for items in related),
+            )
+        except (TypeError, ValueError, DjangoValidationError):
+            raise Http404
+        if not products:
+            raise Http404(
+                f'No {Product._meta.object_name} matches the given query.'
+            )
+        product = products[0]
+        for name, items, values in zip(names, related, objects):
+            async_db.attach_prefetched(product, name, items, values)
+        self.check_object_permissions(self.request, product)
+        return product
+
+    @action(
+        detail=False,
+        methods=['post'],
+        url_path='import',
+        parser_classes=[MultiPartParser]
+    )
+    def import_products(self, request):
+        """Массовый импорт товаров из CSV/JSONL с upsert по external_id"""
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(
+                {'error': 'Файл не передан'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        file_format = request.data.get('format') or detect_format(upload.name)
+        if file_format not in FORMATS:
+            return Response(
+                {'error': 'Поддерживаются только форматы CSV и JSONL'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        result = ProductImporter().import_file(upload, file_format)
+        return Response(result.as_dict())
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """Пакетное создание, изменение и удаление товаров
+
+        Body: ``{"operations": [...], "atomic": true}`` (см. ``catalog.batch``).
+        В атомарном режиме при любой ошибке ничего не записывается и
+        возвращается 400.
+        """
+        operations = None
+        if isinstance(request.data, dict):
+            operations = request.data.get('operations')
+        if not isinstance(operations, list):
+            return Response(
+                {'error': 'Ожидается список операций в поле operations'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(operations) > settings.CATALOG_BATCH_MAX_OPERATIONS:
+            return Response(
+                {'error': (
+                    'Не более '
+                    f'{settings.CATALOG_BATCH_MAX_OPERATIONS} операций за запрос'
+                )},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        atomic = request.data.get('atomic', True)
+        if not isinstance(atomic, bool):
+            return Response(
+                {'error': 'atomic должен быть true или false'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        result = ProductBatch().run(operations, atomic=atomic)
+        return Response(
+            result.as_dict(),
+            status=(
+                status.HTTP_400_BAD_REQUEST if result.rejected
+                else status.HTTP_200_OK
+            )
+        )
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Потоковая выгрузка каталога в CSV/JSONL
+
+        Параметр ``?file_format=csv|jsonl`` (``format`` занят DRF),
+        поддерживаются фильтры ``category`` и ``is_active``.
+        """
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in exporters.FORMATS:
+            return Response(
+                {'error': 'Поддерживаются только форматы CSV и JSONL'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        exporter = exporters.CatalogExporter(
+            self.get_queryset(), request.build_absolute_uri('/')
+        )
+        response = StreamingHttpResponse(
+            exporter.stream(file_format),
+            content_type=exporters.CONTENT_TYPES[file_format]
+        )
+        filename = f"catalog-{timezone.now():%Y%m%d-%H%M%S}.{file_format}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
     @action(detail=True, methods=['post'])
     def toggle_active(self, request, pk=None):
         """Включить/выключить товар"""
@@ -127,11 +600,75 @@ class ProductViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class ProductPhotoViewSet(viewsets.ModelViewSet):
+class OrderedItemsMixin:
+    """Общая логика порядка для фото и вкладок товара"""
+
+    def reorder_items(self, request):
+        """Применить новый порядок одним UPDATE ... CASE
+
+        Все элементы должны существовать и принадлежать одному товару
+        (при переданном ``product`` - именно ему).
+        """
+        serializer = ReorderSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        orders = {
+            item['id']: item['order']
+            for item in serializer.validated_data['orders']
+        }
+        if not orders:
+            return Response({'success': True})
+
+        model = self.get_queryset().model
+        with transaction.atomic():
+            owners = dict(
+                model.objects.filter(pk__in=orders).values_list('id', 'product_id')
+            )
+            missing = sorted(set(orders) - set(owners))
+            if missing:
+                return Response(
+                    {'error': f'Элементы не найдены: {missing}'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            product_ids = set(owners.values())
+            expected = serializer.validated_data.get('product')
+            if len(product_ids) > 1 or (expected and product_ids != {expected}):
+                return Response(
+                    {'error': 'Все элементы должны принадлежать одному товару'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            product_id = product_ids.pop()
+            changes = {'order': Case(
+                *[When(pk=pk, then=Value(order)) for pk, order in orders.items()],
+                output_field=IntegerField()
+            )}
+            if any(field.name == 'updated_at' for field in model._meta.fields):
+                changes['updated_at'] = timezone.now()
+            model.objects.filter(
+                product_id=product_id, pk__in=orders
+            ).update(**changes)
+            # UPDATE обходит сигналы моделей
+            Product.touch([product_id])
+            caching.invalidate()
+        return Response({'success': True})
+
+    @staticmethod
+    def lock_product(product):
+        """Заблокировать строку товара до конца транзакции
+
+        Параллельные загрузки для одного товара выполняются по очереди,
+        поэтому ``Max('order')`` и проверка первого фото не гоняются.
+        """
+        Product.objects.select_for_update().filter(pk=product.pk).exists()
+
+
+class ProductPhotoViewSet(ReplicaReadMixin, OrderedItemsMixin,
+                          KeysetPaginationMixin, viewsets.ModelViewSet):
     """ViewSet для фото товаров"""
     queryset = ProductPhoto.objects.all()
     serializer_class = ProductPhotoSerializer
     permission_classes = [IsAdminUser]
+    keyset_pagination_class = OrderedKeysetPagination
 
     def get_queryset(self):
         queryset = ProductPhoto.objects.all()
@@ -144,33 +681,81 @@ class ProductPhotoViewSet(viewsets.ModelViewSet):
     def set_main(self, request, pk=None):
         """Установить главное фото"""
         photo = self.get_object()
-        
-        # Убираем главное фото у всех остальных фото этого товара
-        ProductPhoto.objects.filter(
-            product=photo.product
-        ).exclude(id=photo.id).update(is_main=False)
-        
-        # Устанавливаем главное фото
-        photo.is_main = True
-        photo.save()
-        
+
+        with transaction.atomic():
+            self.lock_product(photo.product)
+            # Сначала снимаем признак с остальных фото: главное фото
+            # у товара одно (photo_one_main_per_product)
+            self.unset_main(photo.product, exclude=photo)
+            photo.is_main = True
+            photo.save()
+
         serializer = self.get_serializer(photo)
         return Response(serializer.data)
 
     @action(detail=False, methods=['post'])
     def reorder(self, request):
         """Изменить порядок фото"""
-        photo_orders = request.data.get('orders', [])
-        # Формат: [{'id': 1, 'order': 0}, {'id': 2, 'order': 1}, ...]
-        
-        with transaction.atomic():
-            for item in photo_orders:
-                photo_id = item.get('id')
-                new_order = item.get('order')
-                if photo_id and new_order is not None:
-                    ProductPhoto.objects.filter(id=photo_id).update(order=new_order)
-        
-        return Response({'success': True})
+        # Формат: {'product': 1, 'orders': [{'id': 1, 'order': 0}, ...]}
+        return self.reorder_items(request)
+
+    @action(detail=False, methods=['post'], url_path='uploads')
+    def start_upload(self, request):
+        """Начать загрузку фото по частям (см. ``catalog.uploads``)"""
+        serializer = PhotoUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get', 'patch', 'delete'],
+            url_path=r'uploads/(?P<upload_id>[0-9a-f-]{36})')
+    def upload(self, request, upload_id=None):
+        """Состояние загрузки, прием очередной части (PATCH) или отмена"""
+        upload = get_object_or_404(PhotoUpload, pk=upload_id)
+        try:
+            if request.method == 'DELETE':
+                uploads.discard(upload)
+                return Response(status=status.HTTP_204_NO_CONTENT)
+            if request.method == 'PATCH':
+                offset = uploads.receive_chunk(upload, request)
+                return Response(
+                    {'offset': offset}, headers={'Upload-Offset': str(offset)}
+                )
+        except uploads.UploadError as exc:
+            return self.upload_error(exc)
+        data = PhotoUploadSerializer(upload).data
+        return Response(data, headers={'Upload-Offset': str(data['offset'])})
+
+    @action(detail=False, methods=['post'],
+            url_path=r'uploads/(?P<upload_id>[0-9a-f-]{36})/complete')
+    def complete_upload(self, request, upload_id=None):
+        """Проверить загруженный файл и создать фото"""
+        upload = get_object_or_404(
+            PhotoUpload.objects.select_related('product'), pk=upload_id
+        )
+
+        def create_photo(name):
+            return self.add_photo(
+                upload.product, upload.is_main,
+                lambda **fields: ProductPhoto.objects.create(**{
+                    'product': upload.product, 'image': name,
+                    'is_main': upload.is_main, **fields,
+                })
+            )
+
+        try:
+            photo = uploads.complete(upload, create_photo)
+        except uploads.UploadError as exc:
+            return self.upload_error(exc)
+        serializer = self.get_serializer(photo)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def upload_error(exc):
+        data = {'error': str(exc)}
+        if exc.offset is not None:
+            data['offset'] = exc.offset
+        return Response(data, status=exc.status_code)
 
     def perform_create(self, serializer):
         """Создание фото с автоматическим определением порядка"""
@@ -178,23 +763,71 @@ class ProductPhotoViewSet(viewsets.ModelViewSet):
         if not product:
             serializer.save()
             return
-        
-        # Если это первое фото, делаем его главным
-        if not product.photos.exists():
-            serializer.save(is_main=True)
-        else:
+        self.add_photo(
+            product, serializer.validated_data.get('is_main'), serializer.save
+        )
+
+    def add_photo(self, product, is_main, save):
+        """Добавить фото в конец фото товара
+
+        ``save(**fields)`` сохраняет фото с переданными полями и
+        возвращает его; первое фото товара становится главным.
+        """
+        with transaction.atomic():
+            self.lock_product(product)
+            # Если это первое фото, делаем его главным
+            if not product.photos.exists():
+                return save(is_main=True)
+            if is_main:
+                # Новое главное фото заменяет прежнее
+                self.unset_main(product)
             # Определяем максимальный порядок
             max_order = product.photos.aggregate(
                 max_order=Max('order')
             )['max_order'] or 0
-            serializer.save(order=max_order + 1)
+            return save(order=max_order + 1)
+
+    def perform_update(self, serializer):
+        if not serializer.validated_data.get('is_main'):
+            serializer.save()
+            return
+        product = serializer.validated_data.get(
+            'product', serializer.instance.product
+        )
+        with transaction.atomic():
+            self.lock_product(product)
+            self.unset_main(product, exclude=serializer.instance)
+            serializer.save()
+
+    @staticmethod
+    def unset_main(product, exclude=None):
+        """Снять признак главного с фото товара перед назначением другого"""
+        photos = ProductPhoto.objects.filter(product=product, is_main=True)
+        if exclude is not None:
+            photos = photos.exclude(pk=exclude.pk)
+        photos.update(is_main=False)
 
 
-class ProductTabViewSet(viewsets.ModelViewSet):
+class ProductTabViewSet(ReplicaReadMixin, OrderedItemsMixin, ConditionalMixin,
+                        KeysetPaginationMixin, viewsets.ModelViewSet):
     """ViewSet для вкладок товаров"""
     queryset = ProductTab.objects.all()
     serializer_class = ProductTabSerializer
     permission_classes = [IsAdminUser]
+    keyset_pagination_class = OrderedKeysetPagination
+    modified_fields = ('updated_at',)
+
+    @conditional
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @conditional
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
 
     def get_queryset(self):
         queryset = ProductTab.objects.all()
@@ -206,17 +839,8 @@ class ProductTabViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['post'])
     def reorder(self, request):
         """Изменить порядок вкладок"""
-        tab_orders = request.data.get('orders', [])
-        # Формат: [{'id': 1, 'order': 0}, {'id': 2, 'order': 1}, ...]
-        
-        with transaction.atomic():
-            for item in tab_orders:
-                tab_id = item.get('id')
-                new_order = item.get('order')
-                if tab_id and new_order is not None:
-                    ProductTab.objects.filter(id=tab_id).update(order=new_order)
-        
-        return Response({'success': True})
+        # Формат: {'product': 1, 'orders': [{'id': 1, 'order': 0}, ...]}
+        return self.reorder_items(request)
 
     def perform_create(self, serializer):
         """Создание вкладки с автоматическим определением порядка"""
@@ -224,9 +848,44 @@ class ProductTabViewSet(viewsets.ModelViewSet):
         if not product:
             serializer.save()
             return
-        
-        # Определяем максимальный порядок
-        max_order = product.tabs.aggregate(
-            max_order=Max('order')
-        )['max_order'] or 0
-        serializer.save(order=max_order + 1)
+
+        with transaction.atomic():
+            self.lock_product(product)
+            # Определяем максимальный порядок
+            max_order = product.tabs.aggregate(
+                max_order=Max('order')
+            )['max_order'] or 0
+            serializer.save(order=max_order + 1)
+
+
+class CacheStatsView(APIView):
+    """Эффективность кэша ответов каталога"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(caching.get_stats())
+
+    def delete(self, request):
+        """Обнулить счетчики попаданий/промахов"""
+        caching.reset_stats()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def metrics(request):
+    """Метрики производительности в формате Prometheus
+
+    Если задан ``CATALOG_METRICS_TOKEN``, требуется заголовок
+    ``Authorization: Bearer <токен>``. Без токена метрики открыты только
+    при ``DEBUG``: в продакшене ``/metrics`` отвечает 404.
+    """
+    token = settings.CATALOG_METRICS_TOKEN
+    if not token and not settings.DEBUG:
+        raise Http404
+    if token:
+        header = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(header, f'Bearer {token}'):
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(
+        render_prometheus(*metrics_registry.collect()),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )